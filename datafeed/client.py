@@ -1,13 +1,15 @@
-import errno
+import logging
 import marshal
 import socket
+import time
 import zlib
 
 import numpy as np
 
 from cStringIO import StringIO
 
-from datafeed.utils import json_decode
+from datafeed.utils import json_decode, pack_arrays
+from datafeed.utils import REPORT_DELTA_DTYPE, REPORT_SYMBOL_DTYPE
 
 
 __all__ = ['Client', 'ConnectionError']
@@ -17,40 +19,77 @@ class ConnectionError(Exception):
     pass
 
 
+def _encode_name(name):
+    '''utf-8 encoded name truncated on character boundary to fit
+    REPORT_SYMBOL_DTYPE.'''
+    size = REPORT_SYMBOL_DTYPE.fields['name'][0].itemsize
+    encoded = name.encode('utf-8')
+    if len(encoded) > size:
+        encoded = encoded[:size].decode('utf-8', 'ignore').encode('utf-8')
+    return encoded
+
+
 class Client(object):
     """Manages Tcp communication to and from a datafeed server.
+
+    Idempotent commands(GET_*) are retried on connection errors, with
+    exponential backoff: retry_delay, retry_delay * 2, retry_delay * 4...
+    Connection will be reestablished and authenticated transparently.
     """
 
     def __init__(self, host='localhost', port=8082,
-                 password=None, socket_timeout=None):
+                 password=None, socket_timeout=None,
+                 retries=3, retry_delay=0.5):
         self._host = host
         self._port = port
         self._password = password
         self._socket_timeout = socket_timeout
+        self._retries = retries
+        self._retry_delay = retry_delay
 
         self._sock = None
         self._fp = None
 
-    def connect(self):
+        # per connection state of put_report_deltas
+        self._connections = 0
+        self._report_symbols = {}
+        self._report_rows = {}
+        self._next_report_index = 0
+
+    def connect(self, timeout=None):
+        """
+        Arguments:
+          timeout: socket timeout of this connection till restored by
+                   caller, default to socket_timeout.
+        """
+        if timeout is None:
+            timeout = self._socket_timeout
         try:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
             sock.connect((self._host, self._port))
         except socket.error, e:
             # args for socket.error can either be (errno, "message")
             # or just "message"
             if len(e.args) == 1:
                 error_message = "Error connecting to %s:%s. %s." % \
-                    (self.host, self.port, e.args[0])
+                    (self._host, self._port, e.args[0])
             else:
                 error_message = "Error %s connecting %s:%s. %s." % \
                     (e.args[0], self._host, self._port, e.args[1])
             raise ConnectionError(error_message)
         sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-        sock.settimeout(self._socket_timeout)
         self._sock = sock
         self._fp = sock.makefile('rb')
 
+        # server forgets report symbols of the old connection
+        self._connections += 1
+        self._report_symbols = {}
+        self._report_rows = {}
+        self._next_report_index = 0
+
         if self._password:
+            # replay auth on every new connection
             self.auth()
 
     @property
@@ -70,31 +109,34 @@ class Client(object):
         self._sock = None
         self._fp = None
 
-    def reconnect(self):
+    def reconnect(self, timeout=None):
         self.disconnect()
-        self.connect()
+        self.connect(timeout)
+        return self.connected
 
-    def ensure_connected(self):
+    def ensure_connected(self, timeout=None):
         '''TODO: move to a closure?'''
         if not self.connected:
-            self.connect()
+            self.connect(timeout)
 
     def read(self, length=None):
         self.ensure_connected()
         try:
             if length is not None:
-                return self._fp.read(length)
+                data = self._fp.read(length)
+                if len(data) < length:
+                    raise socket.error("Connection closed while reading")
+                return data
             return self._fp.readline()
         except socket.error, e:
+            # half read response left connection in unknown state
             self.disconnect()
-            if e.args and e.args[0] == errno.EAGAIN:
-                raise StandardError("Error while reading from socket: %s" % \
-                                        e.args[1])
-        return ''
+            raise ConnectionError("Error while reading from socket: %s" % \
+                                      (e.args, ))
 
 
     #### COMMAND EXECUTION AND PROTOCOL PARSING ####
-    def execute_command(self, *args):
+    def execute_command(self, *args, **options):
         """Sends the command to the server and returns it's response.
 
         *<number of arguments> CR LF
@@ -114,33 +156,78 @@ class Client(object):
         mykey
         $7
         myvalue
+
+        Options:
+          timeout: socket timeout in seconds of this call, default to
+                   socket_timeout.
         """
-        return self._execute_command(args[0], args[-1], self._build_data(*args))
+        command = args[0]
+        data = self._build_data(*args)
+        timeout = options.get('timeout')
+
+        retries = 0
+        if self._is_idempotent(command):
+            retries = self._retries
+
+        attempt = 0
+        while True:
+            try:
+                return self._execute_command(command, args[-1], data, timeout)
+            except ConnectionError, e:
+                if attempt >= retries:
+                    raise
+                delay = self._retry_delay * (2 ** attempt)
+                attempt += 1
+                logging.warning("%s, retry %s in %.2fs (%d/%d)" % \
+                                    (e, command, delay, attempt, retries))
+                time.sleep(delay)
+
+    def _is_idempotent(self, command):
+        return command.upper().startswith('GET_')
 
     def _build_data(self, *args):
         cmds = ('$%s\r\n%s\r\n' % (len(arg), arg) for arg in args)
         return '*%s\r\n%s' % (len(args), ''.join(cmds))
 
-    def _execute_command(self, command, format, data):
-        self.send(data)
-        return self._parse_response(command, format)
+    def _execute_command(self, command, format, data, timeout=None):
+        if timeout is None:
+            self.send(data)
+            return self._parse_response(command, format)
+
+        if self.connected:
+            self._sock.settimeout(timeout)
+        try:
+            self.send(data, timeout)
+            return self._parse_response(command, format)
+        finally:
+            if self.connected:
+                self._sock.settimeout(self._socket_timeout)
     
-    def send(self, data):
-        self.ensure_connected()
+    def send(self, data, timeout=None):
+        """
+        Arguments:
+          timeout: socket timeout of new connection if not connected or
+                   reconnected, default to socket_timeout.
+        """
+        self.ensure_connected(timeout)
         try:
             self._sock.sendall(data)
         except socket.error, e:
-            if self.reconnect():
+            # server may restarted, data never reached, resend on a new
+            # connection.
+            try:
+                self.reconnect(timeout)
                 self._sock.sendall(data)
-            else:
-                raise StandardError("Error %s while writing to socket. %s." % \
-                                        e.args)
+            except socket.error, e:
+                self.disconnect()
+                raise ConnectionError("Error %s while writing to socket." % \
+                                          (e.args, ))
 
     def _parse_response(self, command, format):
         response = self.read()[:-2]  # strip last two characters (\r\n)
         if not response:
             self.disconnect()
-            raise StandardError("Socket closed on remote end")
+            raise ConnectionError("Socket closed on remote end")
 
         # server returned a null value
         if response in ('$-1', '*-1'):
@@ -168,7 +255,15 @@ class Client(object):
                 return json_decode(response)
             elif format == 'npy':
                 qdata = StringIO(response)
-                return np.load(qdata)
+                ret = np.load(qdata)
+                if qdata.tell() == length:
+                    return ret
+
+                # multiple arrays in one response
+                rets = [ret]
+                while qdata.tell() < length:
+                    rets.append(np.load(qdata))
+                return tuple(rets)
             else:
                 return response
 
@@ -177,70 +272,175 @@ class Client(object):
     def auth(self):
         self.execute_command('AUTH', self._password, 'plain')
 
-    def get_mtime(self):
-        return self.execute_command('GET_MTIME', 'plain')
+    def get_mtime(self, **options):
+        return self.execute_command('GET_MTIME', 'plain', **options)
 
-    def get_list(self, match='', format='json'):
-        return self.execute_command('GET_LIST', match, format)
+    def get_list(self, match='', format='json', **options):
+        return self.execute_command('GET_LIST', match, format, **options)
 
-    def get_report(self, symbol, format='json'):
-        return self.execute_command('GET_REPORT', symbol, format)
+    def get_report(self, symbol, format='json', **options):
+        return self.execute_command('GET_REPORT', symbol, format, **options)
 
     def get_reports(self, *args, **kwargs):
-        format = 'json'
-        if 'format' in kwargs:
-            format = kwargs['format']
+        format = kwargs.pop('format', 'json')
         args = args + (format,)
-        return self.execute_command('GET_REPORTS', *args)
+        return self.execute_command('GET_REPORTS', *args, **kwargs)
 
-    def get_minute(self, symbol, timestamp=0, format='npy'):
+    def get_minute(self, symbol, timestamp=0, format='npy', **options):
         """Get minute history data.
 
         timestamp: 0 for last day data.
         """
         assert isinstance(timestamp, int)
-        return self.execute_command('GET_MINUTE', symbol, str(timestamp), format)
+        return self.execute_command('GET_MINUTE', symbol, str(timestamp), format,
+                                   **options)
 
-    def get_1minute(self, symbol, date, format='npy'):
+    def get_1minute(self, symbol, date, format='npy', **options):
         """Get minute history data.
 
         date: specific day to retrieve.
         """
-        return self.execute_command('GET_1MINUTE', symbol, date, format)
+        return self.execute_command('GET_1MINUTE', symbol, date, format, **options)
 
-    def get_5minute(self, symbol, date, format='npy'):
+    def get_5minute(self, symbol, date, format='npy', **options):
         """Get minute history data.
 
         date: specific day to retrieve.
         """
-        return self.execute_command('GET_5MINUTE', symbol, date, format)
+        return self.execute_command('GET_5MINUTE', symbol, date, format, **options)
+
+    def get_day(self, symbol, length_or_date, format='npy', adjust='none',
+                **options):
+        """Get daily OHLCs.
 
-    def get_day(self, symbol, length_or_date, format='npy'):
-        assert isinstance(length_or_date, int) or len(length_or_date) == 8
-        return self.execute_command('GET_DAY', symbol, str(length_or_date), format)
+        length_or_date: last n quotes, date like 20101209 or (start, end)
+                        tuple of dates.
+        adjust: none, forward or backward, adjusted by dividends on server.
+        """
+        if isinstance(length_or_date, tuple):
+            length_or_date = '-'.join(
+                [isinstance(d, str) and d or d.strftime('%Y%m%d') \
+                     for d in length_or_date])
+        assert isinstance(length_or_date, int) or len(length_or_date) in (8, 17)
+        return self.execute_command('GET_DAY', symbol, str(length_or_date),
+                                    adjust, format, **options)
+
+    def get_panel(self, symbols, field='close', length_or_range=1,
+                  interval='day', **options):
+        """Get one field of multiple symbols aligned by time.
+
+        symbols: list of symbols.
+        field: OHLC field, eg: close.
+        length_or_range: last n quotes(day only), date like 20101209 or
+                         (start, end) tuple of dates.
+        interval: day, 1min or 5min.
+
+        Return tuple of time index and 2-D array of time x symbol, NaN for
+        missing quotes.
+        """
+        if isinstance(length_or_range, tuple):
+            length_or_range = '-'.join(
+                [isinstance(d, str) and d or d.strftime('%Y%m%d') \
+                     for d in length_or_range])
+        return self.execute_command('GET_PANEL', ','.join(symbols), field,
+                                    str(length_or_range), interval, 'npy',
+                                    **options)
+
+    def get_bar(self, symbol, interval='1min', format='npy', **options):
+        """Get last closed bar and forming bar of today.
+
+        interval: 1min or 5min.
+        """
+        return self.execute_command('GET_BAR', symbol, interval, format, **options)
 
-    def get_dividend(self, symbol, format='npy'):
-        return self.execute_command('GET_DIVIDEND', symbol, format)
+    def get_dividend(self, symbol, format='npy', **options):
+        return self.execute_command('GET_DIVIDEND', symbol, format, **options)
 
-    def get_fin(self, symbol, format='npy'):
-        return self.execute_command('GET_FIN', symbol, format)
+    def get_fin(self, symbol, format='npy', **options):
+        return self.execute_command('GET_FIN', symbol, format, **options)
 
-    def get_sector(self, name, format='json'):
-        return self.execute_command('GET_SECTOR', name, format)
+    def get_sector(self, name, format='json', **options):
+        return self.execute_command('GET_SECTOR', name, format, **options)
 
-    def get_stats(self):
-        return self.execute_command('GET_STATS', 'json')
+    def get_stats(self, **options):
+        return self.execute_command('GET_STATS', 'json', **options)
 
     def put_reports(self, adict):
         assert isinstance(adict, dict)
         data = zlib.compress(marshal.dumps(adict))
         return self.execute_command('PUT_REPORTS', data, 'zip')
 
+    def put_report_deltas(self, adict):
+        """Upload reports as fixed size binary rows.
+
+        Symbols and names are registered once per connection, then only
+        reports changed since last upload on this connection are sent, see
+        REPORT_DELTA_DTYPE. Names should be unicode.
+
+        adict: dict of report dicts keyed by symbol, as put_reports.
+        """
+        assert isinstance(adict, dict)
+        self.ensure_connected()
+        connections = self._connections
+
+        entries = []
+        registered = {}
+        rows = []
+        changed = {}
+        for symbol, report in adict.iteritems():
+            name = report['name']
+            index, known = self._report_symbols.get(symbol, (None, None))
+            if index is None:
+                # indexes are never reused, even if registering failed
+                index = self._next_report_index
+                self._next_report_index += 1
+            renamed = known != name
+            if renamed:
+                registered[symbol] = (index, name)
+                entries.append((index, symbol, _encode_name(name)))
+
+            row = (index, report['timestamp'], report['price'],
+                   report['open'], report['high'], report['low'],
+                   report['preclose'], report['volume'], report['amount'])
+            # row of renamed symbol is resent to update stored name
+            if renamed or self._report_rows.get(symbol) != row:
+                rows.append(row)
+                changed[symbol] = row
+
+        if entries:
+            table = np.array(entries, dtype=REPORT_SYMBOL_DTYPE)
+            self._put_report_array('PUT_REPORT_SYMBOLS', table, connections)
+            self._report_symbols.update(registered)
+
+        if not rows:
+            return 'OK'
+        data = np.array(rows, dtype=REPORT_DELTA_DTYPE)
+        ret = self._put_report_array('PUT_REPORT_DELTAS', data, connections)
+        self._report_rows.update(changed)
+        return ret
+
+    def _put_report_array(self, command, data, connections):
+        memfile = StringIO()
+        np.save(memfile, data)
+        ret = self.execute_command(command, memfile.getvalue(), 'npy')
+        if self._connections != connections:
+            # reconnected while sending, indexes are unknown to the server
+            raise ConnectionError("Connection reset while %s." % command)
+        return ret
+
     def put_minute(self, symbol, rawdata):
         memfile = StringIO()
         np.save(memfile, rawdata)
         return self.execute_command('PUT_MINUTE', symbol, memfile.getvalue(), 'npy')
 
+    def put_minutes(self, items):
+        """Bulk upload minute snapshots of multiple symbols in one request.
+
+        items: dict or sequence of (symbol, numpy data) pairs.
+        """
+        index, data = pack_arrays(items)
+        return self._put_packed('PUT_MINUTES', index, data)
+
     def put_1minute(self, symbol, rawdata):
         memfile = StringIO()
         np.save(memfile, rawdata)
@@ -251,10 +451,45 @@ class Client(object):
         np.save(memfile, rawdata)
         return self.execute_command('PUT_5MINUTE', symbol, memfile.getvalue(), 'npy')
 
+    def put_1minutes(self, items):
+        """Bulk upload 1min OHLCs of multiple symbols in one request.
+
+        items: dict or sequence of (symbol, numpy data) pairs.
+        """
+        index, data = pack_arrays(items)
+        return self._put_packed('PUT_1MINUTES', index, data)
+
+    def put_5minutes(self, items):
+        """Bulk upload 5min OHLCs of multiple symbols in one request.
+
+        items: dict or sequence of (symbol, numpy data) pairs.
+        """
+        index, data = pack_arrays(items)
+        return self._put_packed('PUT_5MINUTES', index, data)
+
     def put_day(self, symbol, rawdata):
         memfile = StringIO()
         np.save(memfile, rawdata)
         return self.execute_command('PUT_DAY', symbol, memfile.getvalue(), 'npy')
 
+    def put_days(self, items):
+        """Bulk upload daily OHLCs of multiple symbols in one request.
+
+        items: dict or sequence of (symbol, numpy data) pairs.
+        """
+        index, data = pack_arrays(items)
+        return self._put_packed('PUT_DAYS', index, data)
+
+    def _put_packed(self, command, index, data):
+        """Bulk upload arrays already packed by utils.pack_arrays."""
+        memfile = StringIO()
+        np.save(memfile, index)
+        np.save(memfile, data)
+        return self.execute_command(command, memfile.getvalue(), 'npy')
+
+    def bgsave(self):
+        """Snapshot server in memory stores to disk in background."""
+        return self.execute_command('BGSAVE', 'plain')
+
     def archive_minute(self):
         return self.execute_command('ARCHIVE_MINUTE')
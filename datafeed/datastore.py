@@ -24,9 +24,10 @@ convenience.
 
 Notice
 ======
-Every market has diffrenct open/close time, etc. For now, datastore only
-support one market, or several markets that have the same open/close time, then
-you could distinguish them by prefix.
+Every market has diffrenct open/close time, etc. Stores depend on trading
+sessions(minute snapshots, 1min/5min OHLC, forming bars) are held per market,
+symbols are distinguished by exchange prefix, markets that have the same
+open/close time could share one market, eg: SZ symbols in SH market.
 '''
 
 import atexit
@@ -43,17 +44,26 @@ import cPickle as pickle
 import numpy as np
 
 
+from datafeed.dividend import METHODS, apply_factors, compose_many
+from datafeed.exchange import SessionCalendar, StockExchange
 from datafeed.utils import *
 
 
-__all__ = ['Manager', 'Minute', 'Day', 'OneMinute', 'FiveMinute',
-           'DictStore', 'DictStoreNamespace', 'Report', 'MinuteSnapshotCache']
+__all__ = ['Manager', 'Market', 'Minute', 'Day', 'OneMinute', 'FiveMinute',
+           'DictStore', 'DictStoreNamespace', 'Report', 'AdjustFactor',
+           'MinuteSnapshotCache',
+           'MinuteRotation']
 
 def date2key(date):
     '''Return formatted key from date.'''
     return date.strftime('%Y%m%d')
 
 
+# keys of report dicts, in column order of Manager.update_report_rows
+_REPORT_KEYS = ('time', 'timestamp', 'price', 'amount', 'volume', 'symbol',
+                'name', 'open', 'high', 'low', 'close', 'preclose')
+
+
 class Manager(object):
     '''Manager of datastores.
 
@@ -61,30 +71,57 @@ class Manager(object):
       * Managing different stores.
       * Dispatching read/write dataflows(this may change).
       * Rotating daily minutes snapshot.
+
+    Stores depend on trading sessions are held per market, see Market.
+    Symbols are dispatched to markets by exchange prefix, eg: HK00001 goes
+    to market of HK(), symbols not prefixed by any other market go to the
+    first(primary) market, eg: SZ000001 goes to SH() of [SH(), HK()].
    '''
     def __init__(self, datadir, exchange):
+        """
+        Arguments:
+          exchange: StockExchange instance or list of them, the first one is
+                    the primary market.
+        """
         self.datadir = datadir
-        self.exchange = exchange
+        if isinstance(exchange, StockExchange):
+            exchange = [exchange]
 
         logging.debug("Loading h5file and memory store...")
         self._store = h5py.File(os.path.join(self.datadir, 'data.h5'))
         self._dstore = DictStore.open(os.path.join(self.datadir, 'dstore.dump'))
 
+        # Primary market keeps the layout of single market datastore,
+        # snapshot caches of other markets are namespaced by exchange.
+        self.markets = []
+        for i, ex in enumerate(exchange):
+            namespace = None if i == 0 else str(ex)
+            self.markets.append(Market(ex, self._store, self._dstore,
+                                       namespace=namespace))
+        self.exchange = self.markets[0].exchange
+
+        # longest prefix first, eg: NYSEARCA before NYSE
+        self._prefixes = sorted([(str(m.exchange), m) for m in self.markets[1:]],
+                                key=lambda x: len(x[0]), reverse=True)
+
         # Dict Store
         self._reportstore = None
         self._sectorstore = None
         self._divstore = None
-        self._minutestore = None
+        self._factorstore = None
 
         # HDF5 Store
         self._daystore = None
-        self._1minstore = None
-        self._5minstore = None
-
-        self._mtime = None
 
         atexit.register(self.close)
 
+    def get_market(self, symbol):
+        '''Return market of symbol or exchange name.'''
+        for prefix, market in self._prefixes:
+            if symbol.startswith(prefix):
+                return market
+        return self.markets[0]
+
     @property
     def divstore(self):
         '''Get dividend store instance or initialize if not present.
@@ -94,6 +131,19 @@ class Manager(object):
 
         return self._divstore
 
+    @property
+    def factorstore(self):
+        '''Get adjustment factor store or initialize if not present, factors
+        are built from dividends if never computed.
+        '''
+        if not self._factorstore:
+            self._factorstore = AdjustFactor(self._dstore)
+            if len(self._factorstore) == 0 and len(self.divstore) > 0:
+                logging.info("Building adjustment factors...")
+                self._factorstore.update_dividends(self.divstore.to_dict())
+
+        return self._factorstore
+
     @property
     def reportstore(self):
         '''Get report instance or initialize if not present.
@@ -133,6 +183,425 @@ class Manager(object):
 
         return self._daystore
 
+    @property
+    def minutestore(self):
+        '''Minute store of primary market, see Market.minutestore.'''
+        return self.markets[0].minutestore
+
+    def get_minutestore_at(self, timestamp, memory=None):
+        '''Minute store of primary market, see Market.get_minutestore_at.'''
+        return self.markets[0].get_minutestore_at(timestamp, memory=memory)
+
+    @property
+    def oneminstore(self):
+        '''1min ohlcs store of primary market.'''
+        return self.markets[0].oneminstore
+
+    @property
+    def fiveminstore(self):
+        '''5min ohlcs store of primary market.'''
+        return self.markets[0].fiveminstore
+
+    def rotate_minute_store(self):
+        '''Rotate minute stores of all markets, return minute store of
+        primary market.
+        '''
+        for market in self.markets:
+            market.rotate_minute_store()
+        return self.minutestore
+
+    @property
+    def rotating(self):
+        '''True if any market has cached snapshots of past days to rotate.'''
+        return any([market.rotating for market in self.markets])
+
+    def rotate_step(self, count=100):
+        '''Rewrite next count of symbols of pending rotations, one market
+        at a time.
+
+        Return:
+          True if rotations still pending.
+        '''
+        for market in self.markets:
+            if market.rotating:
+                market.rotate_step(count)
+                break
+        return self.rotating
+
+    def rotation_progress(self):
+        progress = []
+        for market in self.markets:
+            progress.extend(market.rotation_progress())
+        return progress
+
+    @property
+    def mtime(self):
+        "Modify time, latest report time of all markets."
+        mtimes = [m.mtime for m in self.markets if m.mtime is not None]
+        if not mtimes:
+            return None
+        return max(mtimes)
+
+    def set_mtime(self, ts):
+        '''Set modify time of primary market.'''
+        self.markets[0].set_mtime(ts)
+    
+    @property
+    def last_quote_time(self):
+        logging.warning("Deprecated, using mtime instead.")
+        return self.mtime
+    
+    def get_report(self, symbol):
+        """Get report by symbol."""
+        return self.reportstore[symbol]
+        
+    def get_reports(self, *args):
+        """Get reports by symbols.
+
+        Return:
+          dict iterator
+        """
+        if len(args) > 0:
+            store = self.reportstore
+            ret = dict([(symbol, store.get(symbol)) for symbol in args if store.has_key(symbol) ])
+        else:
+            ret = self.reportstore.iteritems()
+            
+        return ret
+
+    def get_market_reports(self, market):
+        """Get reports of symbols belongs to market.
+
+        Return:
+          dict iterator
+        """
+        reports = self.reportstore.iteritems()
+        if len(self.markets) == 1:
+            return reports
+        return ((symbol, report) for symbol, report in reports \
+                    if self.get_market(symbol) is market)
+
+    def get_panel(self, symbols, field, length_or_range, interval='day'):
+        """Get one field of multiple symbols aligned by trading sessions.
+
+        Rows are trading days(day) or bar times(1min, 5min) of the market of
+        first symbol, so days every symbol suspended are kept as NaN rows.
+
+        Arguments:
+          symbols: list of symbols.
+          field: OHLC field, eg: close.
+          length_or_range: last n trading days(day only), or (start, end)
+                           dates.
+          interval: one of day, 1min, 5min.
+
+        Return:
+          tuple of (time index, 2-D float array of time x symbol), missing
+          quotes and unknown symbols filled with NaN.
+        """
+        if interval not in ('day', '1min', '5min'):
+            raise ValueError("Unknown interval: %s" % interval)
+
+        if field not in OHLC.DTYPE.names or field == 'time':
+            raise ValueError("Unknown field: %s" % field)
+
+        if len(symbols) == 0:
+            raise ValueError("No symbols.")
+
+        if isinstance(length_or_range, tuple):
+            start, end = length_or_range
+            length = None
+        elif interval == 'day':
+            length = int(length_or_range)
+            if length <= 0:
+                raise ValueError("Length should be positive: %s" % length)
+        else:
+            raise ValueError("Date range required for %s quotes." % interval)
+
+        ys = []
+        for symbol in symbols:
+            if interval == 'day':
+                store = self.daystore
+            else:
+                store = self.get_market(symbol).get_ohlcstore(interval)
+            try:
+                if length:
+                    y = store.get(symbol, length)
+                else:
+                    y = store.get_range(symbol, start, end)
+            except KeyError:
+                y = []
+            if len(y) == 0:
+                y = np.zeros(0, dtype=store.DTYPE)
+            ys.append(y)
+
+        if length:
+            # last n trading days till latest quote
+            last = max([y['time'].max() for y in ys if len(y) > 0] or [0])
+            if last == 0:
+                return np.zeros(0, dtype='i4'), np.zeros((0, len(symbols)))
+            end = datetime.date.fromtimestamp(last)
+            start = end - datetime.timedelta(days=length * 7 // 5 + 7)
+
+        times = self._session_times(self.get_market(symbols[0]), interval,
+                                    start, end)
+        if length:
+            times = times[-length:]
+
+        values = np.empty((len(times), len(symbols)))
+        values.fill(np.nan)
+        for i, y in enumerate(ys):
+            y = y[np.in1d(y['time'], times)]
+            values[np.searchsorted(times, y['time']), i] = y[field]
+
+        return times, values
+
+    def _session_times(self, market, interval, start, end):
+        """Row times of trading sessions from start to end dates.
+
+        Intraday rows are labelled by bar end time like resampled bars, see
+        resample.bar_times.
+        """
+        from datafeed.resample import bar_times
+
+        days = market.calendar.trading_days(start, end)
+        if interval == 'day':
+            return days.astype('i4')
+
+        step = int(interval[:-3])
+        if len(days) == 0:
+            return np.zeros(0, dtype='i4')
+        return np.concatenate([bar_times(market.exchange, step, int(day)) \
+                                   for day in days])
+
+    def update_reports(self, data):
+        if len(data) == 0:
+            return
+        self.reportstore.update(data)
+
+        if len(self.markets) == 1:
+            self.markets[0].update_reports(data)
+            return
+
+        groups = {}
+        for symbol, report in data.iteritems():
+            market = self.get_market(symbol)
+            groups.setdefault(market, {})[symbol] = report
+        for market, reports in groups.iteritems():
+            market.update_reports(reports)
+
+    def update_report_rows(self, symbols, names, rows):
+        '''Update reports from fixed size rows at once.
+
+        Arguments:
+          symbols: symbol of each row.
+          names: name of each row.
+          rows: numpy rows, see utils.REPORT_DELTA_DTYPE.
+        '''
+        if len(rows) == 0:
+            return
+
+        symbols = list(symbols)
+        timestamps, inverse = np.unique(rows['timestamp'], return_inverse=True)
+        times = np.array([datetime.datetime.fromtimestamp(t).strftime(
+                    '%Y-%m-%d %H:%M:%S') for t in timestamps.tolist()],
+                         dtype=object)
+        prices = rows['price'].tolist()
+        columns = [times[inverse].tolist(), rows['timestamp'].tolist(),
+                   prices, rows['amount'].tolist(), rows['volume'].tolist(),
+                   symbols, list(names), rows['open'].tolist(),
+                   rows['high'].tolist(), rows['low'].tolist(), prices,
+                   rows['preclose'].tolist()]
+        self.reportstore.update(dict(zip(symbols, [
+                        dict(zip(_REPORT_KEYS, values)) \
+                            for values in zip(*columns)])))
+
+        values = np.column_stack((rows['price'], rows['volume'],
+                                  rows['amount']))
+        if len(self.markets) == 1:
+            self.markets[0].update_report_rows(symbols, rows['timestamp'],
+                                               values)
+            return
+
+        markets = np.array([self.get_market(symbol) for symbol in symbols],
+                           dtype=object)
+        for market in self.markets:
+            mask = markets == market
+            if mask.any():
+                market.update_report_rows(
+                    [s for s, m in zip(symbols, mask) if m],
+                    rows['timestamp'][mask], values[mask])
+
+    def get_bar(self, symbol, interval='1min'):
+        '''Get last closed bar and forming bar aggregated from reports.
+
+        Raise:
+          ValueError: if interval not supported.
+          KeyError: if no reports of symbol received.
+        '''
+        try:
+            aggregator = self.get_market(symbol).bars[interval]
+        except KeyError:
+            raise ValueError("Unsupported interval: %s" % interval)
+        return aggregator.get(symbol)
+
+    def update_minute(self, symbol, data):
+        # determine datastore first
+        for minute in data:
+            timestamp = minute['time']
+            break
+        store = self.get_market(symbol).get_minutestore_at(timestamp)
+        store.update(symbol, data)
+    
+    def update_minutes(self, index, data):
+        '''Update minute snapshots of multiple symbols at once.
+
+        Arguments:
+          index: symbol/offset index, see utils.pack_arrays.
+          data: concatenated numpy minute data.
+        '''
+        stores = {}
+        for symbol, y in unpack_arrays(index, data):
+            if len(y) == 0:
+                continue
+            market = self.get_market(symbol)
+            store = market.get_minutestore_at(y[0]['time'])
+            store.update(symbol, y)
+            stores[store.pathname] = store
+
+        for store in stores.itervalues():
+            # memory cache persistent on close, no need to dump it here.
+            if not isinstance(store.handle, MinuteSnapshotCache):
+                store.flush()
+
+    def update_day(self, symbol, data):
+        self.daystore.update(symbol, data)
+
+    def update_days(self, index, data):
+        '''Update daily OHLCs of multiple symbols with single flush.
+
+        Arguments:
+          index: symbol/offset index, see utils.pack_arrays.
+          data: concatenated numpy OHLCs data.
+        '''
+        store = self.daystore
+        for symbol, y in unpack_arrays(index, data):
+            if len(y) == 0:
+                continue
+            store.update(symbol, y, flush=False)
+        store.flush()
+
+    def update_ohlcs(self, interval, index, data):
+        '''Update 1min or 5min OHLCs of multiple symbols with single flush
+        per market.
+
+        Arguments:
+          interval: 1min or 5min.
+          index: symbol/offset index, see utils.pack_arrays.
+          data: concatenated numpy OHLCs data.
+        '''
+        stores = {}
+        for symbol, y in unpack_arrays(index, data):
+            if len(y) == 0:
+                continue
+            store = self.get_market(symbol).get_ohlcstore(interval)
+            store.update(symbol, y)
+            stores[id(store)] = store
+
+        for store in stores.itervalues():
+            store.flush()
+
+    def adjust_day(self, symbol, y, method='forward'):
+        '''Return dividend adjusted copy of daily OHLCs.
+
+        Arguments:
+          method: one of dividend.METHODS.
+        '''
+        if method not in METHODS:
+            raise ValueError("Unknown adjust method: %s" % method)
+        try:
+            factors = self.factorstore[symbol]
+        except KeyError:
+            return y.copy()
+        return apply_factors(y, factors, method)
+
+    def update_dividend(self, symbol, data):
+        if len(data) == 0:
+            return
+
+        if self.divstore.has_key(symbol) and \
+                np.array_equal(self.divstore[symbol], data):
+            # no new records, factors unchanged
+            return
+        
+        try:
+            self.divstore[symbol] = data
+        except ValueError:
+            del self.divstore[symbol]
+            self.divstore[symbol] = data
+
+    def bgsave(self):
+        '''Snapshot DictStore to disk in background, see DictStore.bgsave.'''
+        return self._dstore.bgsave()
+
+    def bgsave_poll(self):
+        return self._dstore.bgsave_poll()
+
+    def save_stats(self):
+        return self._dstore.stats()
+
+    def close(self):
+        logging.debug("datastore shutdown, saving data.")
+        self._dstore.close()
+
+
+class Market(object):
+    '''Stores of one exchange which depend on its trading sessions.
+
+    Minute snapshots and 1min/5min ohlcs are sized by market minutes of the
+    exchange, forming bars are laid on its sessions, minute store rotates
+    when report time of this market crossed a day.
+
+    HDF5 datasets are keyed by symbol, so all markets share one file.
+    '''
+    def __init__(self, exchange, store, dstore, namespace=None):
+        """
+        Arguments:
+          namespace: namespace of minute snapshot cache in DictStore.
+        """
+        self.exchange = exchange
+        self.calendar = exchange.calendar()
+        self.market_minutes = self.calendar.market_minutes
+        self.namespace = namespace
+
+        self._store = store
+        self._dstore = dstore
+
+        self._minutestore = None
+        self._1minstore = None
+        self._5minstore = None
+
+        self._mtime = None
+
+        # Forming bars aggregated from reports, keyed by interval
+        self._bars = None
+
+        # Background minute store rotations, keyed by date
+        self._rotations = {}
+
+    def __repr__(self):
+        return 'Market(%s)' % self.exchange
+
+    @property
+    def bars(self):
+        '''Get bar aggregators of 1min and 5min or initialize if not present.
+        '''
+        if not self._bars:
+            from datafeed.resample import BarAggregator
+            self._bars = {'1min': BarAggregator(self.exchange, 1),
+                          '5min': BarAggregator(self.exchange, 5)}
+
+        return self._bars
+
     @property
     def minutestore(self):
         '''Return instance of last minutestore which should contains minute
@@ -142,7 +611,8 @@ class Manager(object):
             Minute instance.
         '''
         if not self._minutestore:
-            logging.info("Loading minutestore at %d...", self.mtime)
+            logging.info("Loading %s minutestore at %d...",
+                         self.exchange, self.mtime)
             self._minutestore = self.get_minutestore_at(self.mtime,
                                                         memory=True)
 
@@ -167,6 +637,11 @@ class Manager(object):
     def _minutestore_at(self, date, memory=None):
         '''Return minute store at the given date.'''
         today = datetime.date.today()
+        if memory == None and date != today:
+            # not yet rotated
+            memory = date in MinuteSnapshotCache.cached_dates(self._dstore,
+                                                              self.namespace)
+
         if memory or (memory == None and date == today):
             # Known issue:
             # Suppose server crashes, we restart it after couple of hours, then
@@ -174,10 +649,10 @@ class Manager(object):
             # we may ends up with junk data, eg: SH600000 got suspended,
             # no fresh data for today, so minute store will holding some old
             # snapshots.
-            f = MinuteSnapshotCache(self._dstore, date)
+            f = MinuteSnapshotCache(self._dstore, date, self.namespace)
         else:
             f = self._store
-        return Minute(f, date, self.exchange.market_minutes)
+        return Minute(f, date, self.market_minutes)
 
     @property
     def oneminstore(self):
@@ -187,7 +662,8 @@ class Manager(object):
             OneMinute instance.
         '''
         if not self._1minstore:
-            self._1minstore = OneMinute(self._store, self.exchange.market_minutes)
+            self._1minstore = OneMinute(self._store, self.market_minutes,
+                                        self.calendar)
 
         return self._1minstore
 
@@ -199,96 +675,153 @@ class Manager(object):
             FiveMinute instance.
         '''
         if not self._5minstore:
-            self._5minstore = FiveMinute(self._store, self.exchange.market_minutes)
+            self._5minstore = FiveMinute(self._store, self.market_minutes,
+                                         self.calendar)
 
         return self._5minstore
 
+    def get_ohlcstore(self, interval):
+        '''Return ohlcs store of interval, one of 1min, 5min.'''
+        if interval == '1min':
+            return self.oneminstore
+        elif interval == '5min':
+            return self.fiveminstore
+        raise ValueError("Unknown interval: %s" % interval)
+
     def rotate_minute_store(self):
         ''' Rotate minute store when new trading day data flowed in.
+
+        Cached snapshots are rewritten to HDF5 in background by rotate_step,
+        new day snapshots go to a fresh cache immediately.
         '''
+        if not self.mtime:
+            return None
+
         date = datetime.datetime.fromtimestamp(self.mtime).date()
         if self._minutestore and date != self._minutestore.date:
-            logging.info("==> Ratate minute store...")
+            logging.info("==> Ratate %s minute store...", self.exchange)
             # _minutestore was always stored in cache,
             # we need to rewrite it to Minute store for persistent.
-            tostore = self._minutestore_at(self._minutestore.date, memory=False)
-            self._minutestore.store.rotate(tostore)
+            self._start_rotation(self._minutestore.date)
             self._minutestore = None
 
         return self.minutestore
 
     @property
-    def mtime(self):
-        "Modify time, updated we report data received."
-        return self._mtime
+    def rotating(self):
+        '''True if there are cached snapshots of past days to rotate.'''
+        self._resume_rotations()
+        return len(self._rotations) > 0
 
-    def set_mtime(self, ts):
-        if ts > self.mtime:
-            self._mtime = ts
-    
-    @property
-    def last_quote_time(self):
-        logging.warning("Deprecated, using mtime instead.")
-        return self.mtime
-    
-    def get_report(self, symbol):
-        """Get report by symbol."""
-        return self.reportstore[symbol]
-        
-    def get_reports(self, *args):
-        """Get reports by symbols.
+    def rotate_step(self, count=100):
+        '''Rewrite next count of symbols of pending rotations.
 
         Return:
-          dict iterator
-        """
-        if len(args) > 0:
-            store = self.reportstore
-            ret = dict([(symbol, store.get(symbol)) for symbol in args if store.has_key(symbol) ])
-        else:
-            ret = self.reportstore.iteritems()
-            
-        return ret
+          True if rotations still pending.
+        '''
+        self._resume_rotations()
+        for key in sorted(self._rotations.keys()):
+            rotation = self._rotations[key]
+            rotation.step(count)
+            if rotation.finished:
+                del self._rotations[key]
+            break
+        return len(self._rotations) > 0
+
+    def rotation_progress(self):
+        progress = []
+        for key in sorted(self._rotations.keys()):
+            p = self._rotations[key].progress()
+            p['market'] = str(self.exchange)
+            progress.append(p)
+        return progress
+
+    def _start_rotation(self, date):
+        key = date2key(date)
+        if key not in self._rotations:
+            cache = MinuteSnapshotCache(self._dstore, date, self.namespace)
+            tostore = self._minutestore_at(date, memory=False)
+            self._rotations[key] = MinuteRotation(cache, tostore,
+                                                  callback=self.resample_minute)
+
+    def resample_minute(self, symbol, data):
+        '''Resample minute snapshots to 1min and 5min bars.
+
+        Bars from external feeds(put_1minute, put_5minute) are preferred,
+        symbols already have bars at that date are skipped.
+        '''
+        from datafeed.resample import resample
 
-    def update_reports(self, data):
         if len(data) == 0:
             return
-        time = data[data.keys()[0]]['timestamp']
-        self.set_mtime(time)
-        self.reportstore.update(data)
+        date = datetime.datetime.fromtimestamp(data[0]['time']).date()
+        for store, interval in ((self.oneminstore, 1), (self.fiveminstore, 5)):
+            if store.has_date(symbol, date):
+                continue
+            bars = resample(data, self.exchange, interval)
+            if len(bars) > 0:
+                store.update_date(symbol, date, bars)
+
+    def _resume_rotations(self):
+        '''Resume rotations of past days, eg: server crashed while rotating.'''
+        if self._minutestore:
+            current = self._minutestore.date
+        elif self.mtime:
+            current = datetime.datetime.fromtimestamp(self.mtime).date()
+        else:
+            return
 
-    def update_minute(self, symbol, data):
-        # determine datastore first
-        for minute in data:
-            timestamp = minute['time']
-            break
-        store = self.get_minutestore_at(timestamp)
-        store.update(symbol, data)
-    
-    def update_day(self, symbol, data):
-        self.daystore.update(symbol, data)
+        for date in MinuteSnapshotCache.cached_dates(self._dstore,
+                                                     self.namespace):
+            if date < current:
+                self._start_rotation(date)
 
-    def update_dividend(self, symbol, data):
-        if len(data) == 0:
-            return
-        
-        try:
-            self.divstore[symbol] = data
-        except ValueError:
-            del self.divstore[symbol]
-            self.divstore[symbol] = data
+    @property
+    def mtime(self):
+        "Modify time, updated we report data of this market received."
+        return self._mtime
 
-    def close(self):
-        logging.debug("datastore shutdown, saving data.")
-        self._dstore.close()
+    def set_mtime(self, ts):
+        if ts > self.mtime:
+            self._mtime = ts
+
+    def update_reports(self, data):
+        '''Update forming bars by reports of this market.'''
+        ts = data[data.keys()[0]]['timestamp']
+        self.set_mtime(ts)
+        for aggregator in self.bars.itervalues():
+            aggregator.update(data)
+
+    def update_report_rows(self, symbols, timestamps, values):
+        '''Update forming bars by aligned symbols, timestamps and
+        (price, volume, amount) values of this market.'''
+        self.set_mtime(int(timestamps.max()))
+        for aggregator in self.bars.itervalues():
+            aggregator.update_array(symbols, timestamps, values)
 
 
 class DictStore(dict):
+    '''Dict persistent by pickle.
+
+    Snapshots are written to a temporary file then renamed to filename, a
+    crash while saving never corrupts the last snapshot.
+    '''
 
     def __init__(self, filename, odict):
         self.filename = filename
         self.closed = False
         super(DictStore, self).__init__(odict)
 
+        self._bgsave_pid = None
+        self._bgsave_start = None
+
+        self.saves = 0
+        self.failures = 0
+        self.last_save = None
+        self.last_status = None
+        self.last_duration = None
+        self.last_size = None
+
     def require_group(self, key):
         if not self.has_key(key):
             self.__setitem__(key, dict())
@@ -302,11 +835,114 @@ class DictStore(dict):
         return cls(filename, data)
 
     def close(self):
+        if self.bgsave_in_progress:
+            self.bgsave_poll(block=True)
         self.flush()
         self.closed = True
 
     def flush(self):
-        pickle.dump(self.items(), open(self.filename, 'wb+'), -1)
+        start_time = time.time()
+        self._dump()
+        self._saved(start_time, True)
+
+    @property
+    def bgsave_in_progress(self):
+        return self._bgsave_pid is not None
+
+    def bgsave(self):
+        '''Snapshot to disk in a forked child process.
+
+        Child process pickles its copy-on-write view of memory, the serving
+        process returns immediately. Fallback to flush if fork is not
+        supported.
+
+        Return:
+          pid of child process, None if a snapshot already in progress.
+        '''
+        if self.bgsave_in_progress and self.bgsave_poll():
+            return None
+
+        if not hasattr(os, 'fork'):
+            self.flush()
+            return None
+
+        start_time = time.time()
+        pid = os.fork()
+        if pid == 0:
+            # child, never returns
+            status = 0
+            try:
+                self._dump()
+            except Exception:
+                logging.exception("Background saving failed.")
+                status = 1
+            os._exit(status)
+
+        logging.info("Background saving started by pid %d." % pid)
+        self._bgsave_pid = pid
+        self._bgsave_start = start_time
+        return pid
+
+    def bgsave_poll(self, block=False):
+        '''Reap finished snapshot child process.
+
+        Return:
+          True if snapshot still in progress.
+        '''
+        if not self.bgsave_in_progress:
+            return False
+
+        options = 0 if block else os.WNOHANG
+        try:
+            pid, status = os.waitpid(self._bgsave_pid, options)
+        except OSError:
+            # child reaped by others
+            pid, status = self._bgsave_pid, -1
+
+        if pid == 0:
+            return True
+
+        self._bgsave_pid = None
+        # child finished writing at snapshot mtime, not when we reaped it
+        end_time = None
+        if status == 0:
+            end_time = os.path.getmtime(self.filename)
+        self._saved(self._bgsave_start, status == 0, end_time)
+        return False
+
+    def stats(self):
+        return {'bgsave_in_progress': self.bgsave_in_progress,
+                'saves': self.saves,
+                'failures': self.failures,
+                'last_save': self.last_save,
+                'last_status': self.last_status,
+                'last_duration': self.last_duration,
+                'last_size': self.last_size}
+
+    def _dump(self):
+        tmpfile = '%s.%d.tmp' % (self.filename, os.getpid())
+        f = open(tmpfile, 'wb')
+        try:
+            pickle.dump(self.items(), f, -1)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmpfile, self.filename)
+
+    def _saved(self, start_time, ok, end_time=None):
+        self.last_duration = (end_time or time.time()) - start_time
+        if ok:
+            self.saves += 1
+            self.last_save = time.time()
+            self.last_status = 'ok'
+            self.last_size = os.path.getsize(self.filename)
+            logging.info("DictStore saved in %.2fs, %d bytes." % \
+                             (self.last_duration, self.last_size))
+        else:
+            self.failures += 1
+            self.last_status = 'err'
+            logging.error("DictStore saving failed.")
 
 
 class DictStoreNamespace(object, UserDict.DictMixin):
@@ -326,6 +962,12 @@ class DictStoreNamespace(object, UserDict.DictMixin):
     def flush(self):
         self.store.flush()
 
+    def replace(self, data):
+        '''Replace all items by data dict at once.'''
+        assert not self.store.closed
+        self.store[self.__class__.__name__.lower()] = data
+        self.handle = data
+
     def keys(self):
         assert not self.store.closed
         return self.handle.keys()
@@ -368,19 +1010,56 @@ class Sector(DictStoreNamespace):
     pass
 
 class Dividend(DictStoreNamespace):
-    pass
+    '''Dividend records keyed by symbol.
+
+    Adjustment factors of a symbol are recomputed when its records changed.
+    '''
+
+    @property
+    def factors(self):
+        return AdjustFactor(self.store)
+
+    def replace(self, data):
+        old = self.handle
+        changed = dict([(symbol, divs) for symbol, divs in data.iteritems() \
+                            if symbol not in old or \
+                            not np.array_equal(old[symbol], divs)])
+        super(Dividend, self).replace(data)
+
+        factors = self.factors
+        for symbol in old.keys():
+            if symbol not in data:
+                factors.pop(symbol, None)
+        factors.update_dividends(changed)
+
+    def __setitem__(self, key, value):
+        super(Dividend, self).__setitem__(key, value)
+        self.factors.update_dividends({key: value})
+
+    def __delitem__(self, key):
+        super(Dividend, self).__delitem__(key)
+        self.factors.pop(key, None)
+
+class AdjustFactor(DictStoreNamespace):
+    '''Cumulative adjustment factors keyed by symbol, see
+    dividend.compose_factors.
+    '''
+
+    def update_dividends(self, dividends):
+        '''Recompute factors of symbols from dict of dividend records.'''
+        if len(dividends) > 0:
+            self.handle.update(compose_many(dividends))
 
 
 class OHLC(object):
     '''OHLC data archive.'''
 
-    DTYPE = np.dtype({'names': ('time', 'open', 'high', 'low', 'close', 'volume', 'amount'),
-                      'formats': ('i4', 'f4', 'f4', 'f4', 'f4', 'f4', 'f4')})
+    DTYPE = OHLC_DTYPE
 
     time_interval = 60 # default to 60 seconds(1min)
     _handle = None
 
-    def __init__(self, store, market_minutes=None):
+    def __init__(self, store, market_minutes=None, calendar=None):
         '''Init day store from handle.
 
         Handle should be in each implementors namespace, eg:
@@ -390,6 +1069,7 @@ class OHLC(object):
           5min: /5min
         '''
         self.store = store
+        self.calendar = calendar or SessionCalendar()
 
         self.shape_x = None
         self.market_minutes = market_minutes
@@ -420,9 +1100,48 @@ class OHLC(object):
         key = self._key(symbol, date)
         return self.handle[key][:]
 
+    def has_date(self, symbol, date):
+        return self._key(symbol, date) in self.handle
+
+    def update_date(self, symbol, date, quotes):
+        """Write quotes of the date from the first slot of dataset, override
+        if dataset exists, remaining slots left empty.
+        """
+        ds = self._require_dataset(symbol, date, quotes.shape)
+        if len(ds) == len(quotes):
+            ds[:] = quotes
+        else:
+            newdata = np.zeros(ds.shape, dtype=self.DTYPE)
+            newdata[:len(quotes)] = quotes[:len(newdata)]
+            ds[:] = newdata
+
+    def get_range(self, symbol, start, end):
+        """Get quotes data between start date and end date, both inclusive.
+
+        Empty slots of fixed shape datasets are dropped.
+
+        Raise:
+          KeyError: if symbol not exists.
+        """
+        self.handle[symbol] # test symbol existence
+
+        datas = []
+        date = start
+        while date <= end:
+            try:
+                y = self.get(symbol, date)
+                datas.append(y[y['time'] > 0])
+            except KeyError:
+                pass
+            date += datetime.timedelta(days=1)
+
+        if len(datas) == 0:
+            return np.zeros(0, dtype=self.DTYPE)
+        return np.concatenate(datas)
+
     def update(self, symbol, quotes):
         """Archive daily ohlcs, override if datasets exists."""
-        assert quotes['time'][0] < quotes['time'][1], \
+        assert len(quotes) < 2 or quotes['time'][0] < quotes['time'][1], \
             'Data are not chronological ordered.'
 
         # FIXME: disable update_multi for markets like SH
@@ -439,21 +1158,13 @@ class OHLC(object):
           symbol: Stock instrument.
           quotes: numpy quotes data.
         """
-        i = 0
-        pre_ts = 0
-        indexes = []
-        for q in quotes:
-            # 2 hours interval should be safe for seperate daily quotes
-            if pre_ts and (q['time'] - pre_ts) > 7200:
-                indexes.append(i)
-            pre_ts = q['time']
-            i += 1
-        indexes.append(i)
-
-        pre_index = 0
-        for i in indexes:
-            sliced_qs = quotes[pre_index:i]
-            date = datetime.datetime.fromtimestamp(sliced_qs[0]['time']).date()
+        for day, i0, i1 in self._split_days(quotes):
+            sliced_qs = quotes[i0:i1]
+            date = datetime.date.fromordinal(day)
+            if self.shape_x and len(sliced_qs) != self.shape_x:
+                # partial day, eg: DZH got 240 bars of SH
+                self.update_date(symbol, date, sliced_qs)
+                continue
             try:
                 ds = self._require_dataset(symbol, date, sliced_qs.shape)
             except TypeError, e:
@@ -463,7 +1174,6 @@ class OHLC(object):
                 else:
                     raise e
             ds[:] = sliced_qs
-            pre_index = i
 
     def _update_multi(self, symbol, quotes):
         """Archive multiday ohlcs, override if datasets exists.
@@ -472,43 +1182,36 @@ class OHLC(object):
           symbol: Stock instrument.
           quotes: numpy quotes data.
         """
-        i = 0
-        pre_day = None
-        indexes = []
-        indexes.append([0, len(quotes)])
-        for row in quotes:
-            day = datetime.datetime.fromtimestamp(row['time']).day
-            if pre_day and pre_day != day:
-                # found next day boundary
-                indexes[-1][1] = i
-                indexes.append([i, len(quotes)])
-            i += 1
-            pre_day = day
-
-        for i0, i1 in indexes:
-            t0, t1 = quotes[i0]['time'], quotes[i1-1]['time']
-            dt = datetime.datetime.fromtimestamp(t0)
-            dsi0, dsi1 = self.timestamp_to_index(dt, t0), self.timestamp_to_index(dt, t1)
+        indexes = self.timestamp_to_index(quotes['time'])
 
+        for day, i0, i1 in self._split_days(quotes):
             sliced = quotes[i0:i1]
-            ds = self._require_dataset(symbol, dt.date(), sliced.shape)
+            dsi = indexes[i0:i1]
+            ds = self._require_dataset(symbol, datetime.date.fromordinal(day),
+                                       sliced.shape)
 
-            if dsi0 != 0:
-                dsi1 = dsi1 + 1
+            dsi0, dsi1 = dsi[0], dsi[-1] + 1
             logging.debug("ds[%d:%d] = quotes[%d:%d]" % (dsi0, dsi1, i0, i1))
-            try:
+            if dsi1 - dsi0 == len(sliced):
                 ds[dsi0:dsi1] = sliced
-            except TypeError:
-                logging.debug("data may have holes")
-                for row in sliced:
-                    r_dsi = self.timestamp_to_index(dt, row['time'])
-                    # logging.debug("r_dsi: %d" % r_dsi)
-                    ds[r_dsi] = row
-
-    def timestamp_to_index(self, dt, ts):
-        day_start = time.mktime((dt.year, dt.month, dt.day,
-                                 0, 0, 0, 0, 0, 0))
-        return int((ts - day_start) / self.time_interval)
+            else:
+                # data may have holes
+                data = ds[:]
+                data[dsi] = sliced
+                ds[:] = data
+
+    def _split_days(self, quotes):
+        """Return list of (day ordinal, start, end) of each day in quotes.
+        """
+        days = self.calendar.day_ids(quotes['time'])
+        bounds = np.flatnonzero(np.diff(days)) + 1
+        starts = np.append(0, bounds)
+        ends = np.append(bounds, len(quotes))
+        return zip(days[starts].tolist(), starts.tolist(), ends.tolist())
+
+    def timestamp_to_index(self, ts):
+        '''Dataset indexes of timestamp or array of timestamps.'''
+        return self.calendar.time_index(ts, self.time_interval)
 
     def _require_dataset(self, symbol, date, shape=None):
         '''Require dateset for a specific symbol on the given date.'''
@@ -582,19 +1285,43 @@ class Day(OHLC):
                 data = np.append(ydata, data)
         return data[-length:]
 
+    def get_range(self, symbol, start, end):
+        """Get OHLCs between start date and end date, both inclusive.
+
+        Raise:
+          KeyError: if symbol not exists.
+        """
+        self.handle[symbol] # test symbol existence
+
+        t0 = time.mktime(start.timetuple())
+        t1 = time.mktime(end.timetuple())
+
+        ydatas = []
+        for year in xrange(start.isocalendar()[0], end.isocalendar()[0] + 1):
+            try:
+                ydata = self._get_year_data(symbol, year)
+            except KeyError:
+                continue
+            ydatas.append(ydata[(ydata['time'] >= t0) & (ydata['time'] <= t1)])
+
+        if len(ydatas) == 0:
+            return np.zeros(0, dtype=self.DTYPE)
+        return np.concatenate(ydatas)
+
     def get_by_date(self, symbol, date):
         year = date.isocalendar()[0]
         ds = self._dataset(symbol, year)
         index = self._index_of_day(date)
         return ds[index]
 
-    def update(self, symbol, data):
+    def update(self, symbol, data, flush=True):
         """append daily history data to daily archive.
 
         Arguments
         =========
         - `symbol`: symbol.
         - `npydata`: data of npy file.
+        - `flush`: flush to disk after updated, disable it on batch updates.
         """
         prev_year = None
         ds = None
@@ -620,7 +1347,8 @@ class Day(OHLC):
         if ds != None and newdata != None:
             ds[:] = newdata
 
-        self.flush()
+        if flush:
+            self.flush()
         return True
     
     def _get_year_data(self, symbol, year):
@@ -691,8 +1419,7 @@ class FiveMinute(OHLC):
 class Minute(object):
     '''Snapshot of daily minute quotes history.
     '''
-    DTYPE = np.dtype({'names': ('time', 'price', 'volume', 'amount'),
-                      'formats': ('i4', 'f4', 'f4', 'f4')})
+    DTYPE = MINUTE_DTYPE
 
     def __init__(self, store, date, shape_x):
         assert isinstance(date, datetime.date)
@@ -819,14 +1546,60 @@ class MinuteSnapshotCache(DictStoreNamespace):
     '''Mock for basic h5py interface.
 
     This is only used to enhance performance of minute store.
+
+    Snapshots are grouped by date, so new day snapshots could flow in while
+    last day snapshots are rotating.
     '''
-    def __init__(self, store, date):
+    def __init__(self, store, date, namespace=None):
+        """
+        Arguments:
+          namespace: market namespace, eg: HK, default to primary market.
+        """
         assert isinstance(store, DictStore)
         assert isinstance(date, datetime.date)
 
         super(MinuteSnapshotCache, self).__init__(store)
         self.date = date
+        self.group = self._group(store, namespace)
+        self.handle = self.group.setdefault(self.pathname, {})
 
+    @classmethod
+    def _group(cls, store, namespace=None):
+        key = cls.__name__.lower()
+        if namespace:
+            key = '%s/%s' % (key, namespace)
+        group = store.require_group(key)
+        cls._migrate(group)
+        return group
+
+    @classmethod
+    def _migrate(cls, group):
+        '''Move snapshots cached before grouped by date under date of their
+        last snapshot time, so they are rotated as usual.'''
+        symbols = [key for key, value in group.iteritems() \
+                       if not isinstance(value, dict)]
+        if len(symbols) == 0:
+            return
+
+        for symbol in symbols:
+            data = group.pop(symbol)
+            times = data['time'][data['time'] > 0]
+            if len(times) == 0:
+                # nothing received
+                continue
+            date = datetime.date.fromtimestamp(int(times.max()))
+            group.setdefault(date2key(date), {})[symbol] = data
+        logging.info("==> Migrated %d cached min snapshots to date groups." % \
+                         len(symbols))
+
+    @classmethod
+    def cached_dates(cls, store, namespace=None):
+        '''Return sorted dates which have snapshots cached.'''
+        group = cls._group(store, namespace)
+        dates = [datetime.datetime.strptime(key, '%Y%m%d').date() \
+                     for key, value in group.iteritems() \
+                     if isinstance(value, dict)]
+        return sorted(dates)
 
     def __repr__(self):
         return self.__class__.__name__
@@ -860,19 +1633,83 @@ class MinuteSnapshotCache(DictStoreNamespace):
         self.__setitem__(symbol, np.zeros(shape, dtype))
         return self.__getitem__(symbol)
 
+    def drop(self):
+        '''Remove all snapshots of this date from cache.'''
+        self.handle.clear()
+        self.group.pop(self.pathname, None)
+
     def rotate(self, tostore):
+        '''Rewrite all snapshots to tostore at once.'''
+        rotation = MinuteRotation(self, tostore)
+        while not rotation.finished:
+            rotation.step()
+
+
+class MinuteRotation(object):
+    '''Incremental rewrite of cached minute snapshots to HDF5 Minute store.
+
+    Snapshots are rewritten by slices, cache of the date is dropped only
+    after all symbols rewritten and flushed, so a crashed rotation could
+    be resume from start by rotating the cache again.
+    '''
+    def __init__(self, cache, tostore, callback=None):
+        """
+        Arguments:
+          callback: called with symbol and snapshots after each symbol
+                    rewritten, eg: resampling bars.
+        """
         assert not isinstance(tostore.store, MinuteSnapshotCache)
-        assert tostore.date == self.date
-
-        logging.info("==> Rotating %s min snapshots." % self.pathname)
-        self._rewrite(tostore)
-
-    def _rewrite(self, tostore):
-        if self.__len__() > 0:
-            for key in self.keys():
-                try:
-                    tostore.update(key, self.__getitem__(key))
-                except AssertionError:
-                    logging.error("Inconsistent data for %s, ignoring." % key)
-                self.__delitem__(key)
-            tostore.flush()
+        assert tostore.date == cache.date
+
+        self.cache = cache
+        self.tostore = tostore
+        self.callback = callback
+        self.date = cache.date
+
+        self._keys = cache.keys()
+        self.total = len(self._keys)
+        self.done = 0
+        self.failed = 0
+        self.start_time = time.time()
+
+        logging.info("==> Rotating %s min snapshots, %d symbols." % \
+                         (cache.pathname, self.total))
+
+    @property
+    def finished(self):
+        return self.done >= self.total and self.cache is None
+
+    def step(self, count=100):
+        '''Rewrite next count of symbols.'''
+        for key in self._keys[self.done:self.done + count]:
+            # one bad symbol should never block rotation of the others
+            try:
+                data = self.cache[key]
+                self.tostore.update(key, data)
+                if self.callback:
+                    self.callback(key, data)
+            except AssertionError:
+                self.failed += 1
+                logging.error("Inconsistent data for %s, ignoring." % key)
+            except Exception:
+                self.failed += 1
+                logging.exception("Rotating %s failed, ignoring." % key)
+            self.done += 1
+
+        if self.done >= self.total and self.cache is not None:
+            self._finish()
+
+    def progress(self):
+        return {'date': date2key(self.date),
+                'total': self.total,
+                'done': self.done,
+                'failed': self.failed,
+                'elapsed': time.time() - self.start_time}
+
+    def _finish(self):
+        if self.total > 0:
+            self.tostore.flush()
+        self.cache.drop()
+        self.cache = None
+        logging.info("==> Rotated %s min snapshots in %.2fs." % \
+                         (date2key(self.date), time.time() - self.start_time))
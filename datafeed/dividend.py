@@ -3,14 +3,45 @@
 #
 # Copyright 2011 yinhm
 
+'''Dividend adjustment of OHLCs.
+
+Each dividend maps prices before its ex-dividend date by:
+
+  x -> (x - cash_afterward) / share_afterward
+
+quotes are adjusted by composition of all dividends after them in
+chronological order. Compositions of every dividend are precomputed as
+x -> a * x + b by reverse cumulative sums, then each quote finds its first
+dividend by searchsorted, so adjustment costs O((dividends + rows) log n)
+instead of one pass over all rows per dividend.
+'''
+
 import datetime
+import time
+
 import numpy as np
 
-from pandas import DataFrame
-from pandas import TimeSeries
-from pandas import DatetimeIndex
+from datafeed.exchange import SessionCalendar
+
+
+__all__ = ['Dividend', 'FACTOR_DTYPE', 'METHODS',
+           'compose_factors', 'compose_many', 'apply_factors',
+           'adjust_factors', 'adjust_quotes', 'adjust_many', 'adjust']
+
+
+# Cumulative adjustment factors, row k maps prices before time(ex-dividend
+# date of dividend k) by x -> a * x + b, composed with all later dividends.
+FACTOR_DTYPE = np.dtype({'names': ('time', 'a', 'b'),
+                         'formats': ('i4', 'f8', 'f8')})
+
+# forward: adjusted to latest shares, backward: adjusted to first shares.
+METHODS = ('forward', 'backward')
+
+
+# local midnight of ex-dividend time
+_calendar = SessionCalendar()
+
 
-    
 class Dividend(object):
 
     def __init__(self, div):
@@ -26,8 +57,8 @@ class Dividend(object):
         self._npd = div
 
     def adjust(self, frame):
-        '''Adjust price, volume of quotes data.
-    
+        '''Adjust adjclose column of quotes data by this dividend.
+
         Paramaters
         ----------
         frame: DataFrame of OHLCs.
@@ -38,44 +69,12 @@ class Dividend(object):
         if self.ex_date > datetime.date.today(): # not mature
             return True
 
-        self._divide(frame)
-        self._split(frame)
-
-    def _divide(self, frame):
-        """divided close price to adjclose column
-
-        WARNING
-        =======
-        frame should be chronological ordered otherwise wrong backfill.
-        """
-        if self.cash_afterward == 0:
-            return
-
-        cashes = [self.cash_afterward, 0.0]
-        adj_day = self.ex_date - datetime.timedelta(days=1)
-        indexes = []
-        indexes.append(self.d2t(adj_day))
-        indexes.append(self.d2t(datetime.date.today()))
-        
-        cashes = TimeSeries(cashes, index=indexes)
-        ri_cashes = cashes.reindex(frame.index, method='backfill')
-
-        frame['adjclose'] = frame['adjclose'] - ri_cashes
-
-    def _split(self, frame):
-        if self.share_afterward == 1:
-            return
-
-        splits = [self.share_afterward, 1.0]
-        adj_day = self.ex_date - datetime.timedelta(days=1)
-        indexes = []
-        indexes.append(self.d2t(adj_day))
-        indexes.append(self.d2t(datetime.date.today()))
-        
-        splits = TimeSeries(splits, index=indexes)
-        ri_splits = splits.reindex(frame.index, method='backfill')
-
-        frame['adjclose'] = frame['adjclose'] / ri_splits
+        before = np.array([t.date() < self.ex_date for t in frame.index])
+        adjclose = np.asarray(frame['adjclose'])
+        frame['adjclose'] = np.where(
+            before,
+            (adjclose - self.cash_afterward) / self.share_afterward,
+            adjclose)
 
     @property
     def ex_date(self):
@@ -84,13 +83,241 @@ class Dividend(object):
     @property
     def cash_afterward(self):
         return self._npd['dividend'] - self._npd['purchase'] * self._npd['purchase_price']
-        
+
     @property
     def share_afterward(self):
         return 1 + self._npd['purchase'] + self._npd['split']
 
-    def d2t(self, date):
-        return datetime.datetime.combine(date, datetime.time())
+
+def _compose(groups, ex_times, divs):
+    '''Compose dividends of each group to x -> a * x + b.
+
+    Arguments:
+      groups: group id(eg: symbol id) of each dividend.
+      ex_times: local midnight of ex-dividend date of each dividend.
+      divs: numpy dividend data.
+
+    Return:
+      tuple of (keys, a, b) sorted by keys, a and b at k compose dividend k
+      and all dividends after it in the same group.
+    '''
+    order = np.lexsort((ex_times, groups))
+    groups = groups[order]
+    divs = divs[order]
+    keys = (groups.astype('i8') << 32) + ex_times[order]
+
+    share = 1.0 + divs['purchase'].astype('f8') + divs['split']
+    cash = divs['dividend'] - divs['purchase'].astype('f8') * divs['purchase_price']
+
+    # first index of next group
+    ends = np.searchsorted(groups, groups, side='right')
+
+    def suffix_sum(values):
+        total = np.append(np.cumsum(values[::-1])[::-1], 0)
+        return total[:-1] - total[ends]
+
+    a = np.exp(suffix_sum(-np.log(share)))
+    b = -suffix_sum(a * cash)
+    return keys, a, b
+
+
+def _valid(divs):
+    '''Mask of non-empty dividend records.'''
+    shares = divs['purchase'] + divs['split']
+    cash = divs['dividend'] - divs['purchase'] * divs['purchase_price']
+    return (shares != 0) | (cash != 0)
+
+
+def compose_factors(divs):
+    '''Return cumulative adjustment factors of dividends of a symbol.
+
+    Dividends are not filtered by maturity, see apply_factors.
+    '''
+    return compose_many({None: divs})[None]
+
+
+def compose_many(dividends):
+    '''Return cumulative adjustment factors of multiple symbols at once.
+
+    Arguments:
+      dividends: dict of numpy dividend data keyed by symbol.
+
+    Return:
+      dict of numpy factors keyed by symbol, see FACTOR_DTYPE.
+    '''
+    symbols = []
+    arrays = []
+    for symbol, divs in dividends.iteritems():
+        symbols.append(symbol)
+        arrays.append(divs)
+
+    ret = dict((symbol, np.zeros(0, dtype=FACTOR_DTYPE)) for symbol in symbols)
+    if sum([len(divs) for divs in arrays]) == 0:
+        return ret
+
+    groups = np.repeat(np.arange(len(arrays)), [len(divs) for divs in arrays])
+    divs = np.concatenate(arrays)
+    valid = _valid(divs)
+    groups, divs = groups[valid], divs[valid]
+    ex_times = _calendar.day_start(divs['time'].astype('i8'))
+
+    keys, a, b = _compose(groups, ex_times, divs)
+    groups = keys >> 32
+    factors = np.zeros(len(keys), dtype=FACTOR_DTYPE)
+    factors['time'] = keys & 0xffffffff
+    factors['a'] = a
+    factors['b'] = b
+
+    starts = np.searchsorted(groups, np.arange(len(arrays)), side='left')
+    ends = np.searchsorted(groups, np.arange(len(arrays)), side='right')
+    for i, symbol in enumerate(symbols):
+        ret[symbol] = factors[starts[i]:ends[i]]
+    return ret
+
+
+def _apply_factors(times, closes, factors, method='forward', today=None):
+    '''Adjusted closes of rows by cumulative factors.'''
+    assert method in METHODS, "Unknown adjust method %s." % method
+    closes = np.asarray(closes, dtype='f8')
+    if today is None:
+        today = time.time()
+
+    # dividends after m are not mature
+    m = np.searchsorted(factors['time'], _calendar.day_start(int(today)),
+                        side='right')
+    if m == 0:
+        return closes.copy()
+
+    a = np.append(factors['a'], 1.0)
+    b = np.append(factors['b'], 0.0)
+
+    # x -> (x - b[m]) / a[m] removes dividends not mature, rows after all
+    # mature dividends get k == m, which is identity.
+    k = np.searchsorted(factors['time'][:m], times, side='right')
+    adjclose = (a[k] * closes + b[k] - b[m]) / a[m]
+
+    if method == 'backward':
+        a0 = a[0] / a[m]
+        b0 = (b[0] - b[m]) / a[m]
+        adjclose = (adjclose - b0) / a0
+    return adjclose
+
+
+def apply_factors(y, factors, method='forward', today=None):
+    '''Return adjusted copy of OHLCs data by cumulative factors.
+
+    Arguments:
+      y: numpy OHLCs.
+      factors: cumulative factors, see compose_factors.
+      method: one of METHODS.
+      today: timestamp, dividends after today are not mature.
+    '''
+    closes = y['close'].astype('f8')
+    adjclose = _apply_factors(y['time'], closes, factors, method, today)
+    return _apply(y, _factors(adjclose, closes))
+
+
+def _adjusted_close(groups, times, closes, div_groups, divs, today=None):
+    '''Adjusted closes of rows, rows are identified by (group, time).'''
+    closes = np.asarray(closes, dtype='f8')
+    if len(divs) == 0 or len(times) == 0:
+        return closes.copy()
+
+    if today is None:
+        today = time.time()
+    ex_times = _calendar.day_start(divs['time'].astype('i8'))
+
+    # skip empty records and dividends not mature
+    valid = _valid(divs) & (ex_times <= _calendar.day_start(int(today)))
+    if not valid.any():
+        return closes.copy()
+
+    keys, a, b = _compose(div_groups[valid], ex_times[valid], divs[valid])
+
+    row_keys = (groups.astype('i8') << 32) + times
+    k = np.searchsorted(keys, row_keys, side='right')
+    found = k < len(keys)
+    k[~found] = 0
+    # first dividend after row should be in the same group
+    found &= (keys[k] >> 32) == groups
+
+    return np.where(found, a[k] * closes + b[k], closes)
+
+
+def adjust_factors(times, closes, divs, today=None):
+    '''Return adjustment factor of each row, adjusted close / close.
+
+    Arguments:
+      times: timestamps of quotes.
+      closes: close prices of quotes.
+      divs: numpy dividend data, see DzhDividend.
+      today: timestamp, dividends after today are not mature.
+    '''
+    closes = np.asarray(closes, dtype='f8')
+    adjclose = _apply_factors(times, closes, compose_factors(divs),
+                              today=today)
+    return _factors(adjclose, closes)
+
+
+def _factors(adjclose, closes):
+    factors = np.ones(len(closes))
+    nonzero = closes != 0
+    factors[nonzero] = adjclose[nonzero] / closes[nonzero]
+    return factors
+
+
+def _apply(y, factors):
+    y = y.copy()
+    for field in ('open', 'high', 'low', 'close'):
+        y[field] = y[field] * factors
+    y['volume'] = y['volume'] / factors
+    return y
+
+
+def adjust_quotes(y, divs, today=None):
+    '''Return fully adjusted copy of OHLCs data base on dividends.
+
+    Amount is left unadjusted.
+    '''
+    factors = adjust_factors(y['time'], y['close'], divs, today)
+    return _apply(y, factors)
+
+
+def adjust_many(index, data, dividends, today=None):
+    '''Adjust OHLCs of multiple symbols at once.
+
+    Arguments:
+      index: symbol/offset index, see utils.pack_arrays.
+      data: concatenated numpy OHLCs data.
+      dividends: dict of numpy dividend data keyed by symbol.
+
+    Return:
+      adjusted copy of data, ordered as index.
+    '''
+    if len(index) == 0:
+        return data.copy()
+
+    groups = np.repeat(np.arange(len(index)), index['length'])
+    rows = np.concatenate([np.arange(o, o + l) for o, l in \
+                               zip(index['offset'], index['length'])])
+    y = data[rows]
+
+    div_groups = []
+    divs = []
+    for i, symbol in enumerate(index['symbol']):
+        if symbol in dividends and len(dividends[symbol]) > 0:
+            div_groups.append(np.repeat(i, len(dividends[symbol])))
+            divs.append(dividends[symbol])
+    if len(divs) == 0:
+        return data.copy()
+
+    adjclose = _adjusted_close(groups, y['time'].astype('i8'), y['close'],
+                               np.concatenate(div_groups),
+                               np.concatenate(divs), today)
+
+    ret = data.copy()
+    ret[rows] = _apply(y, _factors(adjclose, y['close'].astype('f8')))
+    return ret
 
 
 def adjust(y, divs, capitalize=False):
@@ -103,23 +330,15 @@ def adjust(y, divs, capitalize=False):
     Return:
     DataFrame objects
     """
+    from pandas import DataFrame
+    from pandas import DatetimeIndex
+
+    factors = adjust_factors(y['time'], y['close'], divs)
+    adjusted = _apply(y, factors)
+
     index = DatetimeIndex([datetime.datetime.fromtimestamp(v) for v in y['time']])
-    y = DataFrame.from_records(y, index=index, exclude=['time'])
-    y['adjclose'] = y['close']
-
-    for div in divs:
-        if div['split'] + div['purchase'] + div['dividend'] == 0:
-            continue
-        d = Dividend(div)
-        d.adjust(y)
-
-    factor = y['adjclose'] / y['close']
-    frame = y.copy()
-    frame['open'] = frame['open'] * factor
-    frame['high'] = frame['high'] * factor
-    frame['low'] = frame['low'] * factor
-    frame['close'] = frame['close'] * factor
-    frame['volume'] = frame['volume'] * (1 / factor)
+    frame = DataFrame.from_records(adjusted, index=index, exclude=['time'])
+    frame['adjclose'] = frame['close']
 
     if capitalize:
         columns = [k.capitalize() for k in frame.columns]
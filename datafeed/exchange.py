@@ -6,15 +6,141 @@
 import sys
 import time
 
-from datetime import datetime
+from datetime import date, datetime
 
+import numpy as np
 
-__all__ = ['StockExchange',
+
+__all__ = ['SessionCalendar', 'StockExchange',
            'AMEX', 'LON', 'NASDAQ',
            'NYSE', 'HK', 'SH', 'SZ', 'TYO',
            'YahooNA', 'Security']
 
 
+class SessionCalendar(object):
+    '''Trading sessions calendar, maps timestamps to trading days and
+    in-session minute indexes.
+
+    Local midnights are precomputed per day, so arrays of timestamps are
+    mapped with numpy in one call, no mktime/fromtimestamp per timestamp.
+
+    Minute indexes are laid out like Minute snapshots, the first minute of
+    each session followed by every minute till session end, eg: SH has 242
+    minutes, 09:30 ... 11:30 is 0 ... 120, 13:00 ... 15:00 is 121 ... 241.
+    Minutes before open are -1, minutes in break or after close are clamped
+    to the last minute of the previous session.
+    '''
+
+    def __init__(self, sessions=(((0, 0), (23, 59)), )):
+        """
+        Arguments:
+          sessions: sequence of ((hour, minute), (hour, minute)) of sessions.
+        """
+        self.sessions = [(h0 * 60 + m0, h1 * 60 + m1) \
+                             for (h0, m0), (h1, m1) in sessions]
+
+        # minute of day of every in-session minute index
+        self.minutes = np.concatenate([np.arange(start, end + 1) \
+                                           for start, end in self.sessions])
+        self.market_minutes = len(self.minutes)
+
+        # minute of day -> minute index
+        self._table = np.searchsorted(self.minutes, np.arange(24 * 60),
+                                      side='right') - 1
+
+        self._first_day = None
+        self._midnights = np.zeros(0, dtype='i8')
+        self._day_lengths = np.zeros(0, dtype='i8')
+
+    def day_start(self, ts):
+        '''Local midnight of timestamps.'''
+        ts = np.asarray(ts)
+        i = self._day_offset(ts)
+        return self._result(ts, self._midnights[i])
+
+    def day_ids(self, ts):
+        '''Trading day ids(date ordinals) of timestamps.'''
+        ts = np.asarray(ts)
+        i = self._day_offset(ts)
+        return self._result(ts, self._first_day + i)
+
+    def minute_index(self, ts):
+        '''In-session minute indexes of timestamps.'''
+        ts = np.asarray(ts)
+        i = self._day_offset(ts)
+        minute = self._seconds(ts, i) // 60
+        return self._result(ts, self._table[minute])
+
+    def time_index(self, ts, interval=60):
+        '''Indexes of interval seconds since local midnight.'''
+        ts = np.asarray(ts)
+        i = self._day_offset(ts)
+        return self._result(ts, self._seconds(ts, i) // interval)
+
+    def trading_days(self, start, end):
+        '''Local midnights of trading days from start to end dates, inclusive.
+
+        Holidays are not known, every weekday is taken as a trading day.
+        '''
+        days = [date.fromordinal(o) for o in \
+                    xrange(start.toordinal(), end.toordinal() + 1)]
+        return np.array([time.mktime((d.year, d.month, d.day,
+                                      0, 0, 0, 0, 0, -1)) \
+                             for d in days if d.weekday() < 5], dtype='i8')
+
+    def change_time(self, hour, minute, now):
+        return self.day_start(now) + hour * 3600 + minute * 60
+
+    def minute_times(self, now):
+        '''Timestamps of all in-session minute indexes of the day of now.'''
+        return self.day_start(now) + self.minutes * 60
+
+    def _seconds(self, ts, i):
+        '''Wall clock seconds since local midnight of timestamps of day i.
+
+        Days of DST change are 23 or 25 hours long, their timestamps are
+        mapped by localtime.
+        '''
+        seconds = np.array(ts - self._midnights[i])
+        changed = self._day_lengths[i] != 86400
+        if np.any(changed):
+            seconds[changed] = [t.tm_hour * 3600 + t.tm_min * 60 + t.tm_sec \
+                                    for t in map(time.localtime,
+                                                 ts[changed].tolist())]
+        return seconds
+
+    def _day_offset(self, ts):
+        if ts.size == 0:
+            return np.zeros(ts.shape, dtype=int)
+        self._ensure_days(int(ts.min()), int(ts.max()))
+        return np.searchsorted(self._midnights, ts, side='right') - 1
+
+    def _ensure_days(self, t0, t1):
+        first = date.fromtimestamp(t0).toordinal() - 1
+        last = date.fromtimestamp(t1).toordinal() + 1
+        if self._first_day is not None and first >= self._first_day and \
+                last < self._first_day + len(self._midnights):
+            return
+
+        if self._first_day is not None:
+            first = min(first, self._first_day)
+            last = max(last, self._first_day + len(self._midnights) - 1)
+        # a year ahead, avoid rebuilding every day
+        last = max(last, first + 366)
+
+        days = (date.fromordinal(o) for o in xrange(first, last + 1))
+        self._midnights = np.array([time.mktime((d.year, d.month, d.day,
+                                                 0, 0, 0, 0, 0, -1)) \
+                                        for d in days], dtype='i8')
+        self._day_lengths = np.append(np.diff(self._midnights), 86400)
+        self._first_day = first
+
+    def _result(self, ts, value):
+        if ts.ndim == 0:
+            return value[()]
+        return value
+
+
 class StockExchange(object):
     '''Major stock exchanges, see:
     - http://en.wikipedia.org/wiki/Stock_exchange
@@ -25,6 +151,7 @@ class StockExchange(object):
     _market_break_session = None
     
     _instances = dict()
+    _calendars = dict()
     
     def __new__(cls, *args, **kwargs):
         klass = cls.__name__
@@ -32,11 +159,27 @@ class StockExchange(object):
             cls._instances[klass] = super(StockExchange, cls).__new__(
                 cls, *args, **kwargs)
         return cls._instances[klass]
+
+    @classmethod
+    def calendar(cls):
+        '''SessionCalendar of continuous trading sessions.'''
+        klass = cls.__name__
+        if not cls._calendars.has_key(klass):
+            if not cls._market_session:
+                calendar = SessionCalendar()
+            elif not cls._market_break_session:
+                calendar = SessionCalendar((cls._market_session, ))
+            else:
+                calendar = SessionCalendar(
+                    ((cls._market_session[0], cls._market_break_session[0]),
+                     (cls._market_break_session[1], cls._market_session[1])))
+            cls._calendars[klass] = calendar
+        return cls._calendars[klass]
     
     @classmethod
     def change_time(cls, hour, minute, day=None, now=None):
         if now:
-            day = datetime.fromtimestamp(now)
+            return float(cls.calendar().change_time(hour, minute, now))
         if not day:
             day = datetime.today()
         t = time.mktime((day.year, day.month, day.day,
@@ -46,6 +189,9 @@ class StockExchange(object):
     
     @classmethod
     def pre_open_time(cls, **kwargs):
+        if not cls._pre_market_session:
+            # no pre-market session
+            return cls.open_time(**kwargs)
         return cls.change_time(cls._pre_market_session[0][0],
                                cls._pre_market_session[0][1],
                                **kwargs)
@@ -68,6 +214,22 @@ class StockExchange(object):
                                cls._market_session[1][1],
                                **kwargs)
 
+    @classmethod
+    def trading_sessions(cls, **kwargs):
+        '''Return list of (start, end) timestamps of continuous trading
+        sessions, morning and afternoon if market has a break.
+        '''
+        open_time = cls.open_time(**kwargs)
+        close_time = cls.close_time(**kwargs)
+        if not cls._market_break_session:
+            return [(open_time, close_time)]
+
+        break_time = cls.break_time(**kwargs)
+        resume_time = cls.change_time(cls._market_break_session[1][0],
+                                      cls._market_break_session[1][1],
+                                      **kwargs)
+        return [(open_time, break_time), (resume_time, close_time)]
+
     def __repr__(self):
         return self.__class__.__name__
     __str__ = __repr__
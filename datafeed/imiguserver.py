@@ -7,12 +7,17 @@
 '''
 
 import datetime
+import functools
 import logging
+import threading
 import time
 
 import numpy as np
 
+from tornado import ioloop
+
 from datafeed.providers.dzh import DzhDividend, DzhSector
+from datafeed.scheduler import Scheduler, TaskQueue
 from datafeed.server import *
 from datafeed.utils import *
 
@@ -27,32 +32,231 @@ class SnapshotIndexError(KeyError):
 
 class ImiguApplication(Application):
 
-    def __init__(self, datadir, exchange):
-        self.archive_minute_time = 0
-        self.archive_day_time = 0
+    def __init__(self, datadir, exchange, task_budget=0.005, bgsave_interval=300):
+        """
+        Arguments:
+          exchange: StockExchange instance or list of them, see
+                    datastore.Manager.
+        """
+        # last archive time keyed by exchange
+        self.archive_minute_times = {}
+        self.archive_day_times = {}
         self.crontab_time = 0
+        self.bgsave_interval = bgsave_interval
+        self.bgsave_mtime = None
         
-        self._tasks = []
+        self._tasks = TaskQueue(budget=task_budget)
+        self._rotation_task = None
+        self._syncing = set()
+        self.scheduler = None
+        self.io_loop = None
         
         super(ImiguApplication, self).__init__(datadir, exchange, handler=ImiguHandler)
 
-        # last quote time reset to SH000001's timestamp
-        try:
-            r = self.dbm.get_report("SH000001")
-            self.dbm.set_mtime(r['timestamp'])
-        except KeyError:
-            self.dbm.set_mtime(time.time())
+        # last quote time of each market reset to its latest report
+        for symbol, report in self.dbm.get_reports():
+            if 'timestamp' in report:
+                self.dbm.get_market(symbol).set_mtime(report['timestamp'])
+        for market in self.dbm.markets:
+            if market.mtime is None:
+                market.set_mtime(time.time())
+
+        # resume rotations interrupted by last shutdown
+        self.rotation_add()
+
+    def start_scheduler(self, io_loop=None):
+        """Schedule periodic jobs on IOLoop, replacement of periodic_job.
+        """
+        self.io_loop = io_loop
+        self.scheduler = Scheduler(io_loop=io_loop)
+        for market in self.dbm.markets:
+            exchange = market.exchange
+            self.scheduler.add_job(
+                'archive_minute:%s' % exchange,
+                functools.partial(self._run_archive_minute, exchange),
+                functools.partial(self.next_archive_minute_time,
+                                  exchange=exchange))
+            self.scheduler.add_job(
+                'archive_day:%s' % exchange,
+                functools.partial(self._run_archive_day, exchange),
+                functools.partial(self.next_archive_day_time,
+                                  exchange=exchange))
+        self.scheduler.add_job('crontab_daily',
+                               self._run_crontab_daily,
+                               self.next_crontab_daily_time)
+        self.scheduler.add_job('run_task',
+                               self._run_task,
+                               self.next_task_time)
+        self.scheduler.add_job('bgsave',
+                               self._run_bgsave,
+                               self.next_bgsave_time)
+        self.scheduler.add_job('bgsave_check',
+                               self.dbm.bgsave_poll,
+                               self.next_bgsave_check_time)
+        self.scheduler.start()
+        return self.scheduler
+
+    @property
+    def archive_minute_time(self):
+        return self.archive_minute_times.get(str(self.exchange), 0)
+
+    @archive_minute_time.setter
+    def archive_minute_time(self, ts):
+        self.archive_minute_times[str(self.exchange)] = ts
+
+    @property
+    def archive_day_time(self):
+        return self.archive_day_times.get(str(self.exchange), 0)
+
+    @archive_day_time.setter
+    def archive_day_time(self, ts):
+        self.archive_day_times[str(self.exchange)] = ts
+
+    def next_archive_minute_time(self, now, exchange=None):
+        """Every minute in session, until 5 minutes after market closed.
+        """
+        exchange = exchange or self.exchange
+        open_time = exchange.open_time(now=now)
+        close_time = exchange.close_time(now=now)
+
+        ts = (int(now) // 60 + 1) * 60
+        if ts < open_time:
+            return open_time
+        if ts <= close_time + 60 * 5:
+            return ts
+        return exchange.open_time(now=now + 86400)
+
+    def next_archive_day_time(self, now, exchange=None):
+        """3 minutes after market closed, recheck every minute if no market
+        data archived yet.
+        """
+        exchange = exchange or self.exchange
+        close_time = exchange.close_time(now=now)
+        archive_time = close_time + 60 * 3 + 1
+
+        if now < archive_time:
+            return archive_time
+
+        day_end = exchange.change_time(23, 59, now=now)
+        archived = self.archive_day_times.get(str(exchange), 0)
+        if archived < close_time and now + 60 < day_end:
+            return now + 60
+
+        return exchange.close_time(now=now + 86400) + 60 * 3 + 1
+
+    def next_crontab_daily_time(self, now):
+        """Daily at 08:00.
+        """
+        ts = self.exchange.change_time(8, 0, now=now)
+        if ts > now:
+            return ts
+        return self.exchange.change_time(8, 0, now=now + 86400)
+
+    def next_task_time(self, now):
+        if len(self._tasks) > 0:
+            return now
+        return None
+
+    def next_bgsave_time(self, now):
+        return now + self.bgsave_interval
+
+    def next_bgsave_check_time(self, now):
+        """Every second until background saving process exited.
+        """
+        if self.dbm.save_stats()['bgsave_in_progress']:
+            return now + 1
+        return None
+
+    def bgsave(self):
+        """Snapshot DictStore in background, skip if no new data.
+        """
+        if self.dbm.bgsave_poll():
+            return None
+
+        self.bgsave_mtime = self.dbm.mtime
+        pid = self.dbm.bgsave()
+        if pid and self.scheduler:
+            self.scheduler.wakeup('bgsave_check')
+        return pid
+
+    def _run_bgsave(self):
+        if self.dbm.mtime != self.bgsave_mtime:
+            self.bgsave()
+
+    def sync(self, name, io, store, callback=None):
+        """Replace store by data of provider io without blocking IOLoop.
+
+        Data is fetched by async http client, parsed in a worker thread,
+        then swapped into store at once on IOLoop thread.
+        """
+        if name in self._syncing:
+            logging.warning("Sync %s already in progress." % name)
+            return False
+        self._syncing.add(name)
+
+        io_loop = self.io_loop or ioloop.IOLoop.current()
+        timings = [time.time()]
+
+        def on_fetched(error):
+            if error:
+                self._syncing.discard(name)
+                logging.error("Sync %s failed: %r" % (name, error))
+                return
+            timings.append(time.time())
+            worker = threading.Thread(target=parse, name='sync_%s' % name)
+            worker.daemon = True
+            worker.start()
+
+        def parse():
+            try:
+                data = dict(io.read())
+            except Exception:
+                logging.exception("Sync %s failed on parsing." % name)
+                io_loop.add_callback(self._syncing.discard, name)
+                return
+            timings.append(time.time())
+            io_loop.add_callback(apply, data)
+
+        def apply(data):
+            store.replace(data)
+            self._syncing.discard(name)
+            timings.append(time.time())
+            durations = [t1 - t0 for t0, t1 in zip(timings, timings[1:])]
+            logging.info("Synced %d %s: fetch %.2fs, parse %.2fs, apply %.2fs." % \
+                             ((len(data), name) + tuple(durations)))
+            if callback:
+                callback()
+
+        io.fetch_async(on_fetched, io_loop=io_loop)
+        return True
+
+    def _run_archive_minute(self, exchange):
+        self.__call__(Request(None, 'archive_minute', str(exchange)))
+
+    def _run_archive_day(self, exchange):
+        today = datetime.datetime.today()
+        if self.scheduled_archive_day(today, exchange=exchange):
+            self.__call__(Request(None, 'archive_day', str(exchange)))
+
+    def _run_crontab_daily(self):
+        self.__call__(Request(None, 'crontab_daily'))
+
+    def _run_task(self):
+        logging.debug("tasks left: %s" % len(self._tasks))
+        self.__call__(Request(None, 'run_task'))
 
     def periodic_job(self):
         today = datetime.datetime.today()
 
-        if self.scheduled_archive_minute(today):
-            request = Request(None, 'archive_minute')
-            self.__call__(request)
+        for market in self.dbm.markets:
+            exchange = market.exchange
+            if self.scheduled_archive_minute(today, exchange=exchange):
+                request = Request(None, 'archive_minute', str(exchange))
+                self.__call__(request)
 
-        if self.scheduled_archive_day(today):
-            request = Request(None, 'archive_day')
-            self.__call__(request)
+            if self.scheduled_archive_day(today, exchange=exchange):
+                request = Request(None, 'archive_day', str(exchange))
+                self.__call__(request)
 
         if self.scheduled_crontab_daily(today):
             request = Request(None, 'crontab_daily')
@@ -63,18 +267,19 @@ class ImiguApplication(Application):
             request = Request(None, 'run_task')
             self.__call__(request)
 
-    def scheduled_archive_minute(self, today):
+    def scheduled_archive_minute(self, today, exchange=None):
         """Test is archive minute scheduled.
         """
+        exchange = exchange or self.exchange
         now = time.time()
 
-        market_open_at = self.exchange.open_time(now=now)
+        market_open_at = exchange.open_time(now=now)
         if now < market_open_at:
             # Should not archive any data if market not open yet.
             logging.debug("market not open yet")
             return False        
 
-        market_closing_at = self.exchange.close_time(now=now)
+        market_closing_at = exchange.close_time(now=now)
         if now > (market_closing_at + 60 * 5):
             # Do not archive if time passed 15:05.
             # Should be archived already. If not, something is broken.
@@ -86,26 +291,29 @@ class ImiguApplication(Application):
         #     return False
 
         # in session, we run it every 60 sec or greater
-        if today.second == 0 or (now - self.archive_minute_time) > 60:
+        archived = self.archive_minute_times.get(str(exchange), 0)
+        if today.second == 0 or (now - archived) > 60:
             return True
 
         return False
 
-    def scheduled_archive_day(self, today):
+    def scheduled_archive_day(self, today, exchange=None):
         """Test is daily archive scheduled.
         """
+        exchange = exchange or self.exchange
+        mtime = self.dbm.get_market(str(exchange)).mtime
         now = time.time()
-        close_time = self.exchange.close_time(now=now)
+        close_time = exchange.close_time(now=now)
 
         if now < close_time:
             logging.debug("market not closed yet.")
             return False
 
-        if self.dbm.mtime < close_time:
+        if mtime < close_time:
             logging.debug("No market data: Weekday or holiday or datafeed receiver broken.")
             return False
 
-        if self.dbm.mtime < self.archive_day_time:
+        if mtime < self.archive_day_times.get(str(exchange), 0):
             logging.debug("Already archived.")
             return False
 
@@ -129,11 +337,23 @@ class ImiguApplication(Application):
 
         return False
 
-    def task_add(self, task):
-        self._tasks.append(task)
+    def task_add(self, task, priority=TaskQueue.PRIORITY_NORMAL):
+        self._tasks.put(task, priority)
+        if self.scheduler:
+            self.scheduler.wakeup('run_task')
     
+    def rotation_add(self):
+        """Queue background minute store rotation if not queued yet."""
+        if self._rotation_task is None and self.dbm.rotating:
+            self._rotation_task = RotationTask(self)
+            self.task_add(self._rotation_task, TaskQueue.PRIORITY_LOW)
+
     def task_reserve(self):
-        return self._tasks.pop(0)
+        return self._tasks.reserve()
+
+    def task_run(self):
+        """Run queued tasks within time budget."""
+        return self._tasks.run()
     
 class ImiguHandler(Handler):
 
@@ -147,14 +367,21 @@ class ImiguHandler(Handler):
 
 
     ###### periodic jobs ######
+
+    def _get_market(self, args):
+        '''Market of exchange name in args, default to primary market.'''
+        if len(args) > 0:
+            return self.dbm.get_market(args[0])
+        return self.dbm.markets[0]
     
     def archive_day(self, *args):
-        """Archive daily data from report datastore.
+        """Archive daily data of a market from report datastore.
         """
-        dt = datetime.datetime.fromtimestamp(self.dbm.mtime).date()
+        market = self._get_market(args)
+        dt = datetime.datetime.fromtimestamp(market.mtime).date()
 
         store = self.dbm.daystore
-        reports = self.dbm.get_reports()
+        reports = self.dbm.get_market_reports(market)
         for symbol, report in reports:
             if 'timestamp' not in report:
                 continue
@@ -173,33 +400,31 @@ class ImiguHandler(Handler):
             data = np.array([row], dtype=store.DTYPE)
             store.update(symbol, data)
         
-        self.application.archive_day_time = time.time()
-        logging.info("daily data archived.")
+        self.application.archive_day_times[str(market.exchange)] = time.time()
+        logging.info("%s daily data archived." % market.exchange)
 
         if self.request.connection:
             self.request.write("+OK\r\n")
 
     def archive_minute(self, *args):
-        '''Archive minute data from report datastore.
+        '''Archive minute data of a market from report datastore.
         '''
-        logging.info("starting archive minute...")
-        self.application.archive_minute_time = time.time()
+        market = self._get_market(args)
+        logging.info("starting archive %s minute..." % market.exchange)
+        self.application.archive_minute_times[str(market.exchange)] = time.time()
 
         dbm = self.dbm
-        pre_open_time = dbm.exchange.pre_open_time(now=dbm.mtime)
-        open_time = dbm.exchange.open_time(now=dbm.mtime)
-        break_time = dbm.exchange.break_time(now=dbm.mtime)
-        close_time = dbm.exchange.close_time(now=dbm.mtime)
+        calendar = market.calendar
 
-        try:
-            report = dbm.get_report('SH000001')
-            rts = report['timestamp']
-        except KeyError:
-            logging.error("No SH000001 data.")
+        rts = market.mtime
+        if not rts:
+            logging.error("No %s data." % market.exchange)
             if not self.request.connection:
                 return
             return self.request.write("-ERR No data yet.\r\n")
 
+        pre_open_time = market.exchange.pre_open_time(now=rts)
+
         if rts < pre_open_time:
             logging.error("wrong report time: %s." % \
                               (datetime.datetime.fromtimestamp(rts), ))
@@ -207,39 +432,27 @@ class ImiguHandler(Handler):
                 return
             return self.request.write("-ERR No data yet.\r\n")
 
-        mintime, index = ImiguHandler.get_snapshot_index(open_time, rts)
+        mintime, index = ImiguHandler.get_snapshot_index(calendar, rts)
 
         if index < 0:
             raise SnapshotIndexError
 
         # Rotate when we sure there is new data coming in.
-        dbm.rotate_minute_store()
-        store = dbm.minutestore
-
-        snapshot_time = mintime
+        market.rotate_minute_store()
+        self.application.rotation_add()
+        store = market.minutestore
+
+        # sometimes we received report within market break or after market
+        # closed, eg: 11:31 - 12:59, after 15:00, calendar clamps them to the
+        # last minute of previous session, reset to 11:30 or 15:00
+        snapshot_time = int(calendar.minute_times(mintime)[index])
         cleanup_callback = lambda r: r
-        if index > 120 and index < 210:
-            # sometimes we received report within 11:31 - 12:59
-            # reset to 11:30
-            snapshot_time = break_time
+        if snapshot_time != mintime:
             def cleanup_callback(r):
-                r['timestamp'] = break_time
-                r['time'] = str(datetime.datetime.fromtimestamp(break_time))
-
-            index = 120
-        elif index >= 210 and index <= 330:
-            index = index - 89  # subtract 11:31 - 12:59
-        elif index > 330:
-            # sometimes we received report after 15:00
-            # reset to 15:00
-            snapshot_time = close_time
-            def cleanup_callback(r):
-                r['timestamp'] = close_time
-                r['time'] = str(datetime.datetime.fromtimestamp(close_time))
-
-            index = 241
+                r['timestamp'] = snapshot_time
+                r['time'] = str(datetime.datetime.fromtimestamp(snapshot_time))
 
-        reports = dbm.get_reports()
+        reports = dbm.get_market_reports(market)
         for key, report in reports:
             if 'timestamp' not in report:
                 # Wrong data
@@ -263,41 +476,42 @@ class ImiguHandler(Handler):
         self.request.write_ok()
 
     @classmethod
-    def get_snapshot_index(cls, open_time, report_time):
-        ts = time.time()
-        d = datetime.datetime.fromtimestamp(ts)
-        mintime = time.mktime((d.year, d.month, d.day,
-                               d.hour, d.minute,
-                               0, 0, 0, 0))
-        index = int((mintime - open_time) / 60)
+    def get_snapshot_index(cls, calendar, report_time):
+        mintime = int(time.time()) // 60 * 60
+        index = int(calendar.minute_index(mintime))
         logging.info("minute data at %i (index of %i)." % (mintime, index))
-        return (int(mintime), index)
+        return (mintime, index)
                           
+    def bgsave(self, *args):
+        if self.application.bgsave() is None and self.dbm.bgsave_poll():
+            return self.request.write_error("Background save already in progress")
+        self.request.write_ok()
+
+    def get_stats(self, *args):
+        stats = dict(self.request.connection.stats)
+        if self.application.scheduler:
+            stats['jobs'] = self.application.scheduler.stats()
+        stats['tasks'] = self.application._tasks.stats()
+        stats['rotation'] = self.dbm.rotation_progress()
+        stats['snapshot'] = self.dbm.save_stats()
+        self._write_response(json_encode(stats))
+
     def crontab_daily(self, *args):
         self.application.crontab_time = time.time()
         self.sync_dividend()
         self.sync_sector()
 
     def sync_dividend(self, *args):
-        io = DzhDividend()
-        for symbol, data in io.read():
-            self.dbm.update_dividend(symbol, data)
-        self.dbm.divstore.flush()
+        self.application.sync('dividend', DzhDividend(), self.dbm.divstore,
+                              callback=self.application.bgsave)
         self.request.write_ok()
 
     def sync_sector(self, *args):
-        io = DzhSector()
-        for sector, options in io.read():
-            self.dbm.sectorstore[sector] = options
+        self.application.sync('sector', DzhSector(), self.dbm.sectorstore)
         self.request.write_ok()
 
     def run_task(self):
-        for i in xrange(300):
-            try:
-                task = self.application.task_reserve()
-            except IndexError:
-                break
-            task.run()
+        self.application.task_run()
         
 
 class Task(object):
@@ -311,3 +525,26 @@ class Task(object):
 
     def run(self):
         self.store.set(self.key, self.index, self.data)
+
+
+class RotationTask(object):
+    """Rewrite a slice of cached minute snapshots to HDF5, requeue itself
+    until all rotations finished.
+    """
+    __slots__ = ['application', 'count']
+
+    def __init__(self, application, count=100):
+        self.application = application
+        self.count = count
+
+    def run(self):
+        try:
+            pending = self.application.dbm.rotate_step(self.count)
+        except Exception:
+            self.application._rotation_task = None
+            raise
+
+        if pending:
+            self.application.task_add(self, TaskQueue.PRIORITY_LOW)
+        else:
+            self.application._rotation_task = None
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 yinhm
+
+'''Bulk import of DZH history files into the archive.
+
+Symbols of a file are sharded across a process pool for parsing, parsed
+shards are written by a single writer in the main process, either directly
+into the datastore(StoreWriter) or by bulk upload over the protocol
+(ClientWriter).
+
+Imported shards are recorded in an optional journal, an interrupted import
+resumes from the first shard not recorded.
+'''
+
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+
+from datafeed.providers.dzh import DzhDay, DzhMinute, DzhFiveMinute
+from datafeed.utils import pack_arrays
+
+
+__all__ = ['PARSERS', 'StoreWriter', 'ClientWriter', 'Journal', 'DzhImporter']
+
+
+PARSERS = {'day': DzhDay,
+           '1min': DzhMinute,
+           '5min': DzhFiveMinute}
+
+
+def _parse_shard(task):
+    '''Parse symbols[start:stop] of file into packed index and data.
+
+    Module level function, so it can be pickled to pool workers.
+    '''
+    kind, filename, market, start, stop = task
+    io = PARSERS[kind]()
+    index, data = pack_arrays(io.read(filename, market, start, stop))
+    return task, index, data
+
+
+class StoreWriter(object):
+    '''Write OHLCs directly into datastore.
+
+    data.h5 should not be opened by a running server.
+    '''
+
+    def __init__(self, dbm):
+        self.dbm = dbm
+
+    def write(self, kind, index, data):
+        if kind == 'day':
+            self.dbm.update_days(index, data)
+        else:
+            self.dbm.update_ohlcs(kind, index, data)
+
+
+class ClientWriter(object):
+    '''Upload OHLCs to server by bulk put commands.'''
+
+    _COMMANDS = {'day': 'PUT_DAYS',
+                 '1min': 'PUT_1MINUTES',
+                 '5min': 'PUT_5MINUTES'}
+
+    def __init__(self, client):
+        self.client = client
+
+    def write(self, kind, index, data):
+        # shards come packed from workers, send as is
+        self.client._put_packed(self._COMMANDS[kind], index, data)
+
+
+class Journal(object):
+    '''Keys of imported shards, one per line.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._keys = set()
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self._keys = set([line.strip() for line in f if line.strip()])
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def add(self, key):
+        with open(self.filename, 'a') as f:
+            f.write(key + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._keys.add(key)
+
+
+class DzhImporter(object):
+
+    def __init__(self, writer, processes=None, chunksize=200, journal=None):
+        '''
+        Arguments:
+          writer: StoreWriter or ClientWriter.
+          processes: number of parsing processes, default to cpu count,
+                     1 parses in current process.
+          chunksize: number of symbols of each shard.
+          journal: Journal of imported shards, for resuming.
+        '''
+        self.writer = writer
+        self.processes = processes or multiprocessing.cpu_count()
+        self.chunksize = chunksize
+        self.journal = journal
+
+    def run(self, filename, kind, market):
+        '''Import DZH file of kind(day, 1min or 5min) for market.
+
+        Return:
+          dict of stats: symbols/rows imported, skipped symbols, seconds and
+          rows_per_second.
+        '''
+        filename = os.path.abspath(filename)
+        total = PARSERS[kind]().count(filename)
+
+        done = self._done(kind, filename, market, total)
+        skipped = int(done.sum())
+
+        tasks = []
+        for start, stop in self._ranges(~done):
+            for i in xrange(start, stop, self.chunksize):
+                tasks.append((kind, filename, market, i,
+                              min(i + self.chunksize, stop)))
+
+        if skipped:
+            logging.info("%s %s: resuming, %d/%d symbols done.",
+                         kind, market, skipped, total)
+
+        stats = {'symbols': 0, 'rows': 0, 'skipped': skipped}
+        start_time = time.time()
+
+        pool = None
+        if self.processes > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(self.processes)
+            results = pool.imap_unordered(_parse_shard, tasks)
+        else:
+            results = itertools.imap(_parse_shard, tasks)
+
+        try:
+            for task, index, data in results:
+                if len(index) > 0:
+                    self.writer.write(kind, index, data)
+                if self.journal:
+                    self.journal.add(self._key(task))
+
+                stats['symbols'] += len(index)
+                stats['rows'] += int(index['length'].sum())
+                self._update_rate(stats, start_time)
+                logging.info("%s %s: %d/%d symbols, %d rows, %.0f rows/s",
+                             kind, market, skipped + stats['symbols'], total,
+                             stats['rows'], stats['rows_per_second'])
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        self._update_rate(stats, start_time)
+        return stats
+
+    def _update_rate(self, stats, start_time):
+        stats['seconds'] = time.time() - start_time
+        stats['rows_per_second'] = stats['rows'] / max(stats['seconds'], 0.001)
+
+    def _done(self, kind, filename, market, total):
+        '''Mask of symbols imported, shards may be of other chunksize.'''
+        done = np.zeros(total, dtype=bool)
+        if not self.journal:
+            return done
+
+        prefix = self._key((kind, filename, market)) + ':'
+        for key in self.journal:
+            if key.startswith(prefix):
+                start, stop = key[len(prefix):].split(':')
+                done[int(start):int(stop)] = True
+        return done
+
+    def _ranges(self, mask):
+        '''List of (start, stop) of contiguous True runs in mask.'''
+        edges = np.diff(np.concatenate(([0], mask.astype('i1'), [0])))
+        return zip(np.flatnonzero(edges == 1).tolist(),
+                   np.flatnonzero(edges == -1).tolist())
+
+    def _key(self, task):
+        return ':'.join([str(v) for v in task])
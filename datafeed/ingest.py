@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 yinhm
+
+'''Polling ingestion of provider quotes into datafeed server.
+
+ReportIngester polls a report fetcher(eg: SinaReportFetcher) for the whole
+universe on a shared io_loop, converts quotes to report dicts, and sends
+only symbols whose price or volume changed since last poll, in batches of
+put_report_deltas.
+'''
+
+import datetime
+import functools
+import logging
+import time
+
+import numpy as np
+
+from datafeed.providers.sina import parse_array
+
+
+__all__ = ['ReportIngester', 'to_reports']
+
+
+def to_reports(quotes, encoding='gbk'):
+    '''Convert quotes array(see sina.REPORT_DTYPE) to dict of report dicts
+    keyed by symbol, as put_reports expects.
+    '''
+    ret = {}
+    for q in quotes:
+        timestamp = int(q['time'])
+        symbol = str(q['symbol'])
+        ret[symbol] = {
+            'time'     : datetime.datetime.fromtimestamp(timestamp).strftime(
+                '%Y-%m-%d %H:%M:%S'),
+            'timestamp': timestamp,
+            'price'    : float(q['price']),
+            'amount'   : float(q['amount']),
+            'volume'   : float(q['volume']),
+            'symbol'   : symbol,
+            'name'     : q['name'].decode(encoding, 'ignore'),
+            'open'     : float(q['open']),
+            'high'     : float(q['high']),
+            'low'      : float(q['low']),
+            'close'    : float(q['price']),
+            'preclose' : float(q['preclose'])
+            }
+    return ret
+
+
+class ReportIngester(object):
+
+    def __init__(self, fetcher, securities, client, interval=5,
+                 batch_size=500, parse=parse_array, encoding='gbk'):
+        '''
+        Arguments:
+          fetcher: report fetcher on a shared io_loop.
+          securities: universe to poll.
+          client: datafeed client to send reports.
+          interval: seconds between start of polls.
+          parse: parse response body into quotes array.
+          encoding: encoding of quote names.
+        '''
+        self.fetcher = fetcher
+        self.securities = list(securities)
+        self.client = client
+        self.interval = interval
+        self.batch_size = batch_size
+        self.parse = parse
+        self.encoding = encoding
+
+        # symbol -> (price, volume) last sent
+        self._last = {}
+        self._running = False
+
+        self.polls = 0
+        self.last_metrics = None
+
+    def start(self):
+        self._running = True
+        self.poll(self._schedule)
+
+    def stop(self):
+        self._running = False
+
+    def _schedule(self, metrics):
+        if not self._running:
+            return
+        delay = max(0, self.interval - metrics['total'])
+        self.fetcher.io_loop.add_timeout(time.time() + delay,
+                                          functools.partial(self.poll,
+                                                            self._schedule))
+
+    def poll(self, callback=None):
+        '''Run one poll cycle, callback is called with cycle metrics.'''
+        start_time = time.time()
+        futures = self.fetcher.fetch_async(*self.securities)
+        if len(futures) == 0:
+            return self._on_fetched(start_time, futures, callback)
+
+        pending = [len(futures)]
+        def on_done(future):
+            pending[0] -= 1
+            if pending[0] == 0:
+                self._on_fetched(start_time, futures, callback)
+
+        for future in futures:
+            self.fetcher.io_loop.add_future(future, on_done)
+
+    def _on_fetched(self, start_time, futures, callback):
+        fetched_time = time.time()
+
+        errors = 0
+        arrays = []
+        for future in futures:
+            response = future.result()
+            if response.error:
+                errors += 1
+                continue
+            try:
+                arrays.append(self.parse(response.body))
+            except StandardError:
+                errors += 1
+                logging.exception("Wrong data format.")
+        parsed_time = time.time()
+
+        quotes = self._changed(arrays)
+        batches = self.send(quotes)
+        end_time = time.time()
+
+        self.polls += 1
+        metrics = {
+            'fetch': fetched_time - start_time,
+            'parse': parsed_time - fetched_time,
+            'send': end_time - parsed_time,
+            'total': end_time - start_time,
+            'quotes': sum([len(a) for a in arrays]),
+            'changed': len(quotes),
+            'batches': batches,
+            'errors': errors,
+            }
+        self.last_metrics = metrics
+        logging.info("poll %d: %d quotes, %d changed, %d errors, "
+                     "fetch %.3fs, parse %.3fs, send %.3fs",
+                     self.polls, metrics['quotes'], metrics['changed'],
+                     errors, metrics['fetch'], metrics['parse'],
+                     metrics['send'])
+        if callback:
+            callback(metrics)
+
+    def _changed(self, arrays):
+        '''Quotes with price or volume changed since last sent.'''
+        if len(arrays) == 0:
+            return np.zeros(0)
+        quotes = np.concatenate(arrays)
+        # suspended or invalid
+        quotes = quotes[quotes['price'] > 0]
+
+        last = self._last
+        changed = [i for i, key in enumerate(zip(quotes['symbol'],
+                                                 quotes['price'],
+                                                 quotes['volume'])) \
+                       if last.get(key[0]) != key[1:]]
+        return quotes[changed]
+
+    def send(self, quotes):
+        '''Send quotes in batches, return number of batches.'''
+        batches = 0
+        for i in xrange(0, len(quotes), self.batch_size):
+            batch = quotes[i:i + self.batch_size]
+            try:
+                self.client.put_report_deltas(to_reports(batch, self.encoding))
+            except StandardError:
+                # not marked as sent, retry on next poll
+                logging.exception("Sending reports failed.")
+                continue
+            for q in batch:
+                self._last[q['symbol']] = (q['price'], q['volume'])
+            batches += 1
+        return batches
@@ -26,26 +26,26 @@ $DZH/data/sh/day.dat
 
 """
 
+import logging
+import mmap
 import os
 import ConfigParser
 import urllib2
 
 from collections import OrderedDict
 from cStringIO import StringIO
-from struct import *
 
 import h5py
 import numpy as np
 
+from tornado.httpclient import AsyncHTTPClient
+
 
 __all__ = ['DzhDay', 'DzhDividend',
            'DzhMinute', 'DzhFiveMinute',
            'DzhSector']
 
 
-class EndOfIndexError(StandardError):
-    pass
-
 class FileNotFoundError(StandardError):
     pass
 
@@ -58,13 +58,21 @@ def gb2utf(value, ignore=True):
 
     
 class DzhDay(object):
-    """大智慧日线数据"""
+    """大智慧日线数据
+
+    File is memory mapped, index table is decoded by INDEX_DTYPE at once,
+    data blocks are viewed as (blocks x records per block) array, each
+    symbol's rows are gathered from its blocks by fancy indexing.
+    """
 
     _COUNT_SDTART = int('0x0c', 16)
     _INDEX_START  = int('0x18', 16)
     _BLOCK_START  = int('0x41000', 16) # OHLCs
     _BLOCK_SIZE   = 256 * 32
 
+    # seconds added to raw time
+    _TIME_OFFSET  = 0
+
     _DTYPE = [('time', '<i4'),
               ('open', '<f4'),
               ('high', '<f4'),
@@ -72,70 +80,56 @@ class DzhDay(object):
               ('close', '<f4'),
               ('volume', '<f4'),
               ('amount', '<f4')]
-    
-    
-    def read(self, filename, market):
+
+    # 0x18起每64byte为一组索引数据, 块号为-1(0xffff)表示未分配
+    INDEX_DTYPE = np.dtype([('symbol', 'S10'),
+                            ('count', '<i4'),
+                            ('blocks', '<i2', (25, ))])
+
+    # 32 bytes ohlc record, rise/fall counts skipped
+    RECORD_DTYPE = np.dtype({'names': [name for name, _ in _DTYPE],
+                             'formats': [fmt for _, fmt in _DTYPE],
+                             'offsets': range(0, 28, 4),
+                             'itemsize': 32})
+
+    def read(self, filename, market, start=0, stop=None):
         """Generator of 日线数据读取
 
-        Block read each symbols data.
+        Arguments:
+          start, stop: slice of symbols in index table to read.
 
-        Parameters
-        ----------
-        store : hdf5 store
+        Yield:
+          tuple of (symbol, numpy ohlcs), invalid rows dropped.
         """
-        self.f = open(filename, 'r')
-        
+        buf = self._open(filename)
         try:
-            i = 0
-            while True:
-                self.f.seek(self._INDEX_START + 64 * i, 0)
-                index = self.read_index()
-
-                symbol = market + index[0]
-
-                timestamps = []
-                ohlcs = []
-                for block in index[2]:
-                    self.read_block(block=block, timestamps=timestamps, ohlcs=ohlcs)
-
-                ohlcs = np.array(ohlcs)
-                ohlcs = np.rec.fromarrays([timestamps,
-                                           ohlcs[:, 0],
-                                           ohlcs[:, 1],
-                                           ohlcs[:, 2],
-                                           ohlcs[:, 3],
-                                           ohlcs[:, 4],
-                                           ohlcs[:, 5]],
-                                          dtype=self._DTYPE)
-
-                yield symbol, ohlcs
-            
-                i += 1
-        except (EOFError, EndOfIndexError):
-            raise StopIteration
-        # except Exception as e:
-        #     '''locks like we got some duplicated data, eg:
-
-        #     sz399004
-        #     --------
-
-        #     block 8846 has 4 of those:
-        #     2010-05-10
-        #     2010-05-11
-        #     2010-05-12
-        #     2010-05-13
-
-        #     How do we fix this?
-        #     '''
+            index = self.read_index(buf)[start:stop]
+            records = self.read_blocks(buf)
+            for symbol, blocks in zip(index['symbol'], index['blocks']):
+                yield (market + symbol.replace('\x00', ''),
+                       self.gather(records, blocks))
         finally:
-            self.f.close()
-        
-    def read_index(self):
-        """索引记录格式
+            # views of buf must be released before closing
+            index = records = None
+            buf.close()
 
-        数据块大小
-        ---------
-        0x18起每64byte为一组索引数据
+    def count(self, filename):
+        """Return number of symbols in file."""
+        buf = self._open(filename)
+        try:
+            return len(self.read_index(buf))
+        finally:
+            buf.close()
+
+    def _open(self, filename):
+        f = open(filename, 'rb')
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+    def read_index(self, buf):
+        """索引记录格式
 
         数据库结构
         ---------
@@ -145,40 +139,23 @@ class DzhDay(object):
         28 - 29   06 00                   第二个记录块号 short
         56 - 57                           第25个记录块号short
 
-        Return tuple of index
-
-        Examples
-        --------
-        >>> index = read_index(f)
-        >>> index
-        ('000001', 4767, [0, 1132, 1135])
-        
+        Return numpy index records until the first empty symbol.
         """
-        symbol = unpack('10s', self.f.read(10))[0].replace('\x00', '')
+        size = min(len(buf), self._BLOCK_START) - self._INDEX_START
+        count = max(size, 0) // self.INDEX_DTYPE.itemsize
+        index = np.frombuffer(buf, dtype=self.INDEX_DTYPE, count=count,
+                              offset=self._INDEX_START)
 
-        if symbol == '':
-            raise EOFError
-        
-        count =  unpack('i', self.f.read(4))[0]
-
-        blocks = []
-
-        for i in range(25):
-            block_id = unpack('h',  self.f.read(2))[0]
-            if block_id != -1: # 0xff 0xff
-                blocks.append(block_id)
-            
-        return (symbol, count, blocks)
+        empty = np.flatnonzero(index['symbol'] == '')
+        if len(empty) > 0:
+            index = index[:empty[0]]
+        return index.copy()
 
-    def read_block(self, block, timestamps, ohlcs):
-        """read ohlc data rows for a symbol
+    def read_blocks(self, buf):
+        """ohlc记录格式
 
-        data length
-        -----------
-        8KB each symbol, 256 * 32bytes
+        8KB each block, 256 * 32bytes
 
-        ohlc记录格式
-        -----------
         41000 - 41003 80 47 B2 2B         日期           int
         41004 - 41007 B9 1E 25 41         开盘价         float
         41008 - 4100B CD CC 4C 41         最高价         float
@@ -190,40 +167,39 @@ class DzhDay(object):
         4101E - 4101F 00 00               下跌家数       short
         日期为unixtime.
 
-        Returns
-        -------
-        True on success or Error raised
+        Return (blocks x records per block) view of data blocks.
         """
-        try:
-            self.f.seek(self._BLOCK_START + self._BLOCK_SIZE * block, 0) # reseek to block head
-        except:
-            print "wrong block size? %d" % block
-
-        for i in range(256):
-            rawdata = self.f.read(4)
-
-            if rawdata == '':
-                raise EOFError
-            
-            timestamp = unpack('i', rawdata)[0]
-            if timestamp <= 0:
-                # invalid: \x00 * 4 || \xff * 4
-                self.f.seek(24, 1)
-            else:
-                ohlc = np.frombuffer(self.f.read(24), dtype=np.float32)
-
-                timestamps.append(timestamp)
-                ohlcs.append(ohlc)
-
-            self.f.seek(4, 1) # skip 2*2short for rasie/up count
-
-        return True
+        per_block = self._BLOCK_SIZE // self.RECORD_DTYPE.itemsize
+        nblocks = max(len(buf) - self._BLOCK_START, 0) // self._BLOCK_SIZE
+        records = np.frombuffer(buf, dtype=self.RECORD_DTYPE,
+                                count=nblocks * per_block,
+                                offset=min(self._BLOCK_START, len(buf)))
+        return records.reshape(nblocks, per_block)
+
+    def gather(self, records, blocks):
+        """Gather valid rows of blocks as numpy ohlcs."""
+        blocks = blocks[blocks >= 0]
+        missing = blocks >= len(records)
+        if missing.any():
+            logging.warning("wrong block ids %s" % blocks[missing])
+            blocks = blocks[~missing]
+
+        rows = records[blocks].ravel()
+        # invalid: \x00 * 4 || \xff * 4
+        rows = rows[rows['time'] > 0].astype(self._DTYPE)
+        if self._TIME_OFFSET:
+            rows['time'] += self._TIME_OFFSET
+        return rows
 
 
 class DzhMinute(DzhDay):
-    """大智慧1分钟数据"""
+    """大智慧1分钟数据
+
+    Time fixed by -8 hours, see DzhFiveMinute.
+    """
     _BLOCK_START  = int('0x41000', 16)
     _BLOCK_SIZE   = 384 * 32
+    _TIME_OFFSET  = -8 * 3600
 
 
 class DzhFiveMinute(DzhDay):
@@ -231,15 +207,11 @@ class DzhFiveMinute(DzhDay):
 
     IMPORTANT:
 
-    大智慧五分钟数据时区处理有误，导致time数据相差8小时。
-    数据读取未对原始数据做任何改动，实际使用中，需手工修正，eg:
-
-        for symbol, ohlcs in io.read('MIN1.DAT', 'SH'):
-            for ohlc in ohlcs:
-                ohlc['time'] = ohlc['time'] - 8 * 3600
+    大智慧五分钟数据时区处理有误，导致time数据相差8小时，读取时已修正。
     """
     #_BLOCK_START  = int('0x41000', 16)
     #_BLOCK_SIZE   = 384 * 32
+    _TIME_OFFSET  = -8 * 3600
 
 
 class DzhFetcher(object):
@@ -251,7 +223,7 @@ class DzhFetcher(object):
         self._fetched = False
 
     def fetch_next_server(self):
-        self.ips.pop
+        self.ips.pop()
         if len(self.ips) == 0:
             raise FileNotFoundError
         return self.fetch()
@@ -259,11 +231,35 @@ class DzhFetcher(object):
     def fetch(self):
         try:
             r = urllib2.urlopen(self.data_url())
-            data = r.read()
-            self.f = StringIO(data)
-            self._fetched = True
-        except URLError:
+            self.load(r.read())
+        except urllib2.URLError:
             return self.fetch_next_server()
+
+    def fetch_async(self, callback, io_loop=None, timeout=60):
+        """Fetch without blocking io_loop, try next server on error.
+
+        callback: called with None after fetched, or with exception if all
+                  servers failed.
+        """
+        def on_response(response):
+            if response.error:
+                logging.warning("Fetching %s: %s" % (response.request.url,
+                                                     response.error))
+                self.ips.pop()
+                if len(self.ips) == 0:
+                    return callback(FileNotFoundError(self._PATH))
+                return self.fetch_async(callback, io_loop, timeout)
+
+            self.load(response.body)
+            callback(None)
+
+        http = AsyncHTTPClient(io_loop=io_loop)
+        http.fetch(self.data_url(), on_response, request_timeout=timeout)
+
+    def load(self, data):
+        """Load fetched raw data for reading."""
+        self.f = StringIO(data)
+        self._fetched = True
     
     def data_url(self):
         assert self._PATH, "No file path."
@@ -278,6 +274,16 @@ class DzhDividend(DzhFetcher):
     '''大智慧除权数据'''
     _PATH = '/platform/download/PWR/full.PWR'
 
+    _HEAD_SIZE = 12
+    _SYMBOL_SIZE = 16
+    _SENTINEL = -1 # \xff * 4
+
+    DTYPE = np.dtype([('time', np.int32),
+                      ('split', np.float32),
+                      ('purchase', np.float32),
+                      ('purchase_price', np.float32),
+                      ('dividend', np.float32)])
+
     def read(self):
         """Generator of 大智慧除权数据
         
@@ -289,49 +295,54 @@ class DzhDividend(DzhFetcher):
                       :purchase => 0.000,
                       :purchase_price => 0.000,
                       :dividend => 0.200 }... ]
+
+        dividends are read only views of fetched data.
         """
         if self._fetched == False:
             self.fetch()
-        
-        # skip head
-        self.f.seek(12, 0)
 
         try:
-            while True:
-                yield self._read_symbol()
-        except EOFError:
-            raise StopIteration
+            for symbol, dividends in self.decode(self.f.getvalue()):
+                yield symbol, dividends
         finally:
             self.f.close()
-        #except Exception as e:
-        #    print(e)
 
-    def _read_symbol(self):
-        dividends = []
+    def decode(self, data):
+        """Decode PWR data to list of (symbol, dividends).
 
-        rawsymbol = self.f.read(16)
-        if rawsymbol == '':
-            raise EOFError
-        
-        symbol = unpack('16s', rawsymbol)[0].replace('\x00', '')
-
-        rawdate = self.f.read(4)
-
-        dt = np.dtype([('time', np.int32),
-                       ('split', np.float32),
-                       ('purchase', np.float32),
-                       ('purchase_price', np.float32),
-                       ('dividend', np.float32)])
-        while (rawdate) != "\xff" * 4:
-            dividend = np.frombuffer(rawdate + self.f.read(16), dtype=dt)
-            dividends.append(dividend)
-            
-            rawdate = self.f.read(4)
-            if rawdate == '':
+        Each symbol is a 16 bytes header followed by 20 bytes records, ends
+        with \xff * 4 or end of data. All fields are 4 bytes, so sentinels
+        are searched in one pass over data viewed as int32, candidates not
+        on a record boundary are field values and skipped.
+        """
+        words = np.frombuffer(data, dtype='<i4',
+                              count=max(len(data) - self._HEAD_SIZE, 0) // 4,
+                              offset=min(self._HEAD_SIZE, len(data)))
+        sentinels = np.flatnonzero(words == self._SENTINEL)
+        sentinels = np.append(sentinels, len(words)).tolist()
+
+        header_words = self._SYMBOL_SIZE // 4
+        record_words = self.DTYPE.itemsize // 4
+
+        ret = []
+        start = 0 # header of current symbol
+        for end in sentinels:
+            first = start + header_words
+            if end < first or (end - first) % record_words != 0:
+                if end < len(words):
+                    continue
+            if start + header_words > len(words):
                 break
 
-        return (symbol, np.fromiter(dividends, dtype=dt))
+            offset = self._HEAD_SIZE + start * 4
+            symbol = data[offset:offset + self._SYMBOL_SIZE].replace('\x00', '')
+            count = max(end - first, 0) // record_words
+            dividends = np.frombuffer(data, dtype=self.DTYPE, count=count,
+                                      offset=offset + self._SYMBOL_SIZE)
+            ret.append((symbol, dividends))
+            start = end + 1
 
+        return ret
 
 
 _SECTORS = ('行业', '概念', '地域',
@@ -371,17 +382,7 @@ if __name__ == '__main__':
 
     client = Client()
 
-    # path = os.path.join(os.path.realpath(os.path.dirname(__file__)),
-    #                     '../../var')
-
-    # filename = os.path.join(path, "/dzh/sh/DAY.DAT")
-    # io = DzhDay()
-    # for symbol, ohlcs in io.read(filename, 'SH') :
-    #     memfile = StringIO()
-    #     np.save(memfile, ohlcs)
-    #     client.put('DayHistory', symbol, memfile.getvalue())
-        
-
+    # see dzh_import.py for DAY/MIN files
     io = DzhDividend()
     for data in io.read():
         memfile = StringIO()
@@ -11,7 +11,7 @@ from datafeed.bidict import Bidict
 from datafeed.exchange import *
 from datafeed.quote import *
 from datafeed.providers.http_fetcher import *
-from datafeed.utils import json_decode
+from datafeed.utils import OHLC_DTYPE, json_decode, parse_ohlc_csv
 
 __all__ = ['GoogleSecurity', 'currency2float',
            'GoogleReport', 'GoogleReportFetcher',
@@ -159,17 +159,27 @@ class GoogleDay(Day):
         r.next() # skip header
         return (GoogleDay(security, line) for line in r)
 
+    @staticmethod
+    def parse_array(rawdata):
+        """Parse csv into numpy OHLCs ordered by time, ready for put_day."""
+        return parse_ohlc_csv(rawdata, OHLC_DTYPE)
+
 
 class GoogleReportFetcher(Fetcher):
 
+    # requests per second
+    _RATE_LIMIT = 5
+
     # Maximum number of stocks we'll batch fetch.
     _MAX_REQUEST_SIZE = 100
     
     def __init__(self, base_url='http://www.google.com/finance/info',
-                 time_out=20, max_clients=10, request_size=100):
+                 time_out=20, max_clients=10, request_size=100,
+                 io_loop=None):
         assert request_size <= self._MAX_REQUEST_SIZE
         
-        super(GoogleReportFetcher, self).__init__(base_url, time_out, max_clients)
+        super(GoogleReportFetcher, self).__init__(base_url, time_out, max_clients,
+                                                  io_loop)
         self._request_size = request_size
 
     def _fetching_urls(self, *args, **kwargs):
@@ -208,9 +218,13 @@ class GoogleReportFetcher(Fetcher):
 
 class GoogleDayFetcher(DayFetcher):
 
+    # requests per second
+    _RATE_LIMIT = 5
+
     def __init__(self, base_url='http://www.google.com/finance/historical',
-                 time_out=20, max_clients=10):
-        super(GoogleDayFetcher, self).__init__(base_url, time_out, max_clients)
+                 time_out=20, max_clients=10, io_loop=None):
+        super(GoogleDayFetcher, self).__init__(base_url, time_out, max_clients,
+                                               io_loop)
 
     def _make_url(self, security, **kwargs):
         """Generate url to fetch.
@@ -235,8 +249,10 @@ class GoogleNewsFetcher(Fetcher):
     # Maximum number of stocks we'll batch fetch.
     _MAX_REQUEST_SIZE = 100
     
-    def __init__(self, base_url=_BASE_URL, time_out=10, max_clients=5):
-        super(GoogleNewsFetcher, self).__init__(base_url, time_out, max_clients)
+    def __init__(self, base_url=_BASE_URL, time_out=10, max_clients=5,
+                 io_loop=None):
+        super(GoogleNewsFetcher, self).__init__(base_url, time_out, max_clients,
+                                                io_loop)
 
     def _fetching_urls(self, *args, **kwargs):
         return (self._make_url(str(security)) for security in args)
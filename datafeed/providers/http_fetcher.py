@@ -1,11 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import collections
 import functools
 import logging
+import random
 import sys
+import time
+import urlparse
 
-from tornado.curl_httpclient import CurlAsyncHTTPClient as AsyncHTTPClient 
+try:
+    from tornado.curl_httpclient import CurlAsyncHTTPClient as AsyncHTTPClient
+except ImportError:
+    # pycurl is optional, simple client has no keep-alive.
+    from tornado.simple_httpclient import SimpleAsyncHTTPClient as AsyncHTTPClient
 from tornado import ioloop
+from tornado.concurrent import Future
 
  
 try:
@@ -28,13 +37,106 @@ except ImportError:
                 pass
 
 
-__all__ = ['Fetcher', 'DayFetcher', 'zip_slice']
+__all__ = ['Fetcher', 'DayFetcher', 'TokenBucket', 'zip_slice']
+
+
+class TokenBucket(object):
+    """Token bucket rate limit, rate tokens per second up to burst."""
+
+    def __init__(self, rate, burst=None):
+        assert rate > 0
+        self.rate = float(rate)
+        self.burst = burst or max(1.0, self.rate)
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def consume(self, now=None):
+        """Take a token, return seconds to wait if bucket is empty."""
+        now = now or time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class _Host(object):
+    """Adaptive concurrency of a host.
+
+    Concurrency increases additively while latency stays within twice the
+    best latency seen, halves on errors.
+    """
+
+    def __init__(self, concurrency, ceiling, bucket=None):
+        self.concurrency = float(concurrency)
+        self.ceiling = ceiling
+        self.bucket = bucket
+        self.active = 0
+        self.pending = collections.deque()
+        self.scheduled = False
+
+        self.latency = None # moving average
+        self.baseline = None
+
+    def available(self):
+        return self.active < int(self.concurrency)
+
+    def on_success(self, latency):
+        if self.latency is None:
+            self.latency = self.baseline = latency
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * latency
+            self.baseline = min(self.baseline, latency)
+
+        if self.latency <= 2 * self.baseline:
+            self.concurrency = min(self.ceiling,
+                                   self.concurrency + 1.0 / self.concurrency)
+
+    def on_error(self):
+        self.concurrency = max(1.0, self.concurrency / 2)
+
+
+class _Request(object):
+
+    def __init__(self, url, future, callback):
+        self.url = url
+        self.future = future
+        self.callback = callback
+        self.attempts = 0
+        self.start_time = None
 
 
 class Fetcher(object):
+    """Base of http fetchers.
+
+    Fetcher owns a private io_loop by default, fetch blocks until all
+    responses handled. Passing a shared io_loop(eg: server's
+    IOLoop.instance()) enables fetch_async, which returns futures without
+    blocking.
+
+    HTTP client is created once per io_loop, pooled connections are reused
+    across fetches.
+
+    Requests are dispatched per host with adaptive concurrency, starting
+    from max_clients up to _MAX_CONCURRENCY. Connection errors, 429 and 5xx
+    responses are retried with jittered exponential backoff. Providers may
+    set _RATE_LIMIT(requests per second) for a token bucket rate limit, the
+    bucket of a host is shared by all fetcher instances.
+    """
     _MAX_CLIENTS = 10
+    _MAX_CONCURRENCY = 50
+
+    _RATE_LIMIT = None
+    _RETRIES = 3
+    _RETRY_DELAY = 0.5
+
+    # host -> TokenBucket
+    _BUCKETS = {}
 
-    def __init__(self, base_url=None, time_out=20, max_clients=10):
+    def __init__(self, base_url=None, time_out=20, max_clients=10,
+                 io_loop=None):
         assert isinstance(base_url, basestring)
         assert isinstance(time_out, int)
         assert isinstance(max_clients, int)
@@ -44,28 +146,185 @@ class Fetcher(object):
         self._time_out = time_out
         self._max_clients = max_clients
 
-        self._io_loop = ioloop.IOLoop()
+        self._shared = io_loop is not None
+        self._io_loop = io_loop or ioloop.IOLoop()
+        self._http = None
+
+        # host -> _Host
+        self._hosts = {}
+        # host -> request stats, see latencies
+        self._stats = {}
 
         self.queue_len = 0
 
     def fetch(self, *args, **kwargs):
+        """Fetch and block until all responses handled by callback."""
+        assert not self._shared, "Use fetch_async on shared io_loop."
+
         ret = []
         if not len(args) > 0:
             return ret
-        
+
+        self._fetch(args, kwargs)
+        self._io_loop.start()
+        return ret
+
+    def fetch_async(self, *args, **kwargs):
+        """Fetch without blocking io_loop.
+
+        Callback in kwargs is called as each response arrives, same as fetch.
+
+        Return:
+          list of Future of HTTPResponse, one for each url.
+        """
+        return self._fetch(args, kwargs)
+
+    def latencies(self):
+        """Return dict of per host stats: count, errors, retries, average and
+        max latency in seconds, current concurrency.
+        """
+        ret = {}
+        for host, stats in self._stats.iteritems():
+            ret[host] = dict(stats)
+            ret[host]['average'] = stats['total'] / max(stats['count'], 1)
+            ret[host]['concurrency'] = int(self._hosts[host].concurrency)
+        return ret
+
+    @property
+    def io_loop(self):
+        return self._io_loop
+
+    @property
+    def http_client(self):
+        if not self._http:
+            # one client per io_loop, shared by fetchers on the loop
+            self._http = AsyncHTTPClient(io_loop=self._io_loop,
+                                         max_clients=self._MAX_CONCURRENCY)
+        return self._http
+
+    def _fetch(self, args, kwargs):
+        futures = []
         urls = self._fetching_urls(*args, **kwargs)
 
-        http = AsyncHTTPClient(self._io_loop)
         i = 0
         for url in urls:
-            callback = self._callback(args[i], **kwargs)
+            callback = None
+            if 'callback' in kwargs:
+                callback = self._callback(args[i], **kwargs)
+            future = Future()
             logging.info("start urlfetch %s" % url)
-            http.fetch(url, callback)
             self.queue_len = self.queue_len + 1
+            self._enqueue(_Request(url, future, callback))
+            futures.append(future)
             i += 1
+        return futures
 
-        self._io_loop.start()
-        return ret
+    def _host(self, url):
+        name = urlparse.urlparse(url).netloc
+        if name not in self._hosts:
+            self._hosts[name] = _Host(self._max_clients,
+                                      self._MAX_CONCURRENCY,
+                                      self._bucket(name))
+            self._stats[name] = {'count': 0, 'errors': 0, 'retries': 0,
+                                 'total': 0.0, 'max': 0.0}
+        return name, self._hosts[name]
+
+    def _bucket(self, name):
+        if not self._RATE_LIMIT:
+            return None
+        if name not in self._BUCKETS:
+            self._BUCKETS[name] = TokenBucket(self._RATE_LIMIT)
+        return self._BUCKETS[name]
+
+    def _enqueue(self, request):
+        name, host = self._host(request.url)
+        host.pending.append(request)
+        self._dispatch(host)
+
+    def _dispatch(self, host):
+        while host.pending and host.available():
+            if host.bucket:
+                wait = host.bucket.consume()
+                if wait > 0:
+                    if not host.scheduled:
+                        host.scheduled = True
+                        self._io_loop.add_timeout(
+                            time.time() + wait,
+                            functools.partial(self._wakeup, host))
+                    return
+
+            request = host.pending.popleft()
+            host.active += 1
+            request.start_time = time.time()
+            self.http_client.fetch(request.url,
+                                   functools.partial(self._on_response,
+                                                     host, request),
+                                   request_timeout=self._time_out)
+
+    def _wakeup(self, host):
+        host.scheduled = False
+        self._dispatch(host)
+
+    def _on_response(self, host, request, response):
+        try:
+            self._handle_response(host, request, response)
+        finally:
+            # queued requests of host go on even if callback failed
+            self._dispatch(host)
+
+    def _handle_response(self, host, request, response):
+        name, _ = self._host(request.url)
+        stats = self._stats[name]
+        latency = time.time() - request.start_time
+        host.active -= 1
+        stats['count'] += 1
+        stats['total'] += latency
+        stats['max'] = max(stats['max'], latency)
+
+        if response.error:
+            stats['errors'] += 1
+        if self._should_retry(response):
+            # throttled or overloaded
+            host.on_error()
+        elif not response.error:
+            host.on_success(latency)
+
+        if self._should_retry(response) and request.attempts < self._RETRIES:
+            request.attempts += 1
+            stats['retries'] += 1
+            delay = self._retry_delay(request.attempts, response)
+            logging.warning("%s, retry %s in %.2fs (%d/%d)", response.error,
+                            request.url, delay, request.attempts,
+                            self._RETRIES)
+            self._io_loop.add_timeout(time.time() + delay,
+                                      functools.partial(self._enqueue,
+                                                        request))
+        else:
+            self._finish(request, response)
+
+    def _should_retry(self, response):
+        # 599: connection error or timeout
+        return response.code == 429 or response.code >= 500
+
+    def _retry_delay(self, attempts, response):
+        if response.code == 429:
+            try:
+                return float(response.headers.get('Retry-After'))
+            except (TypeError, ValueError):
+                pass
+        return self._RETRY_DELAY * 2 ** (attempts - 1) * \
+            random.uniform(0.5, 1.5)
+
+    def _finish(self, request, response):
+        request.future.set_result(response)
+        if request.callback:
+            try:
+                request.callback(response)
+            except Exception:
+                logging.exception("Callback of %s failed.", request.url)
+        else:
+            self.queue_len = self.queue_len - 1
+            self.stop()
 
     def _fetching_urls(self, *args, **kwargs):
         raise NotImplementedError()
@@ -77,7 +336,7 @@ class Fetcher(object):
         pass
 
     def stop(self):
-        if self.queue_len == 0:
+        if self.queue_len == 0 and not self._shared:
             self._io_loop.stop()
 
 
@@ -79,10 +79,12 @@ class NasdaqListFetcher(Fetcher):
     _BASE_URL = "http://www.nasdaq.com/screening/companies-by-industry.aspx"
     
     def __init__(self, base_url=_BASE_URL,
-                 time_out=20, max_clients=10, request_size=100):
+                 time_out=20, max_clients=10, request_size=100,
+                 io_loop=None):
         assert request_size <= self._MAX_REQUEST_SIZE
         
-        super(NasdaqListFetcher, self).__init__(base_url, time_out, max_clients)
+        super(NasdaqListFetcher, self).__init__(base_url, time_out, max_clients,
+                                                io_loop)
         self._request_size = request_size
 
     def _fetching_urls(self, *args, **kwargs):
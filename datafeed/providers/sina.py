@@ -14,18 +14,24 @@ http://image.sinajs.cn/newchart/min/n/sh000001.gif
 http://image.sinajs.cn/newchart/daily/n/sh000001.gif
 """
 
+import datetime
 import functools
 import logging
 import sys
+import time
+
+import numpy as np
 
 from dateutil import parser
 
 from datafeed.exchange import *
 from datafeed.quote import *
 from datafeed.providers.http_fetcher import Fetcher
+from datafeed.utils import midnight_timestamp
 from tornado.escape import json_decode
 
-__all__ = ['SinaSecurity', 'SinaReport', 'SinaReportFetcher']
+__all__ = ['SinaSecurity', 'SinaReport', 'SinaReportFetcher',
+           'REPORT_DTYPE', 'parse_array']
 
 # Sina finance 
 _EXCHANGES = {
@@ -60,6 +66,131 @@ class SinaSecurity(Security):
         return klass()
         
 
+# Fields of quote line in order.
+_FIELDS = (
+    ("name", 'S32'),
+    ("open", 'f8'),
+    ("preclose", 'f8'),
+    ("price", 'f8'),
+    ("high", 'f8'),
+    ("low", 'f8'),
+    ("bid", 'f8'),
+    ("ask", 'f8'),
+    ("volume", 'i8'),
+    ("amount", 'f8'),
+    ("bid1", 'i8'),
+    ("bidp1", 'f8'),
+    ("bid2", 'i8'),
+    ("bidp2", 'f8'),
+    ("bid3", 'i8'),
+    ("bidp3", 'f8'),
+    ("bid4", 'i8'),
+    ("bidp4", 'f8'),
+    ("bid5", 'i8'),
+    ("bidp5", 'f8'),
+    ("ask1", 'i8'),
+    ("askp1", 'f8'),
+    ("ask2", 'i8'),
+    ("askp2", 'f8'),
+    ("ask3", 'i8'),
+    ("askp3", 'f8'),
+    ("ask4", 'i8'),
+    ("askp4", 'f8'),
+    ("ask5", 'i8'),
+    ("askp5", 'f8'),
+    )
+
+# symbol: eg SH600028, time: unix timestamp of date and time fields.
+REPORT_DTYPE = np.dtype([('symbol', 'S8')] + list(_FIELDS) + [('time', 'i4')])
+
+# sina id -> interned symbol
+_SYMBOLS = {}
+# symbol -> SinaSecurity
+_SECURITIES = {}
+
+
+def _symbol(idstr):
+    try:
+        return _SYMBOLS[idstr]
+    except KeyError:
+        symbol = intern(idstr[:2].upper() + idstr[2:])
+        _SYMBOLS[idstr] = symbol
+        return symbol
+
+
+def _security(symbol):
+    try:
+        return _SECURITIES[symbol]
+    except KeyError:
+        security = SinaSecurity.from_string(symbol)
+        _SECURITIES[symbol] = security
+        return security
+
+
+def _timestamps(dates, times):
+    """Timestamps of fixed format YYYY-MM-DD and HH:MM:SS strings, rows not
+    in the format fall back to dateutil.
+    """
+    dates = np.asarray(dates)
+    times = np.asarray(times)
+    uniq, inverse = np.unique(dates, return_inverse=True)
+    midnights = np.array([midnight_timestamp(d) for d in uniq],
+                         dtype=object)[inverse]
+
+    digits = times.astype('S8').view(np.uint8).reshape(-1, 8).astype('i4')
+    digits -= ord('0')
+    seconds = (digits[:, 0] * 10 + digits[:, 1]) * 3600 + \
+        (digits[:, 3] * 10 + digits[:, 4]) * 60 + \
+        digits[:, 6] * 10 + digits[:, 7]
+
+    numbers = digits[:, [0, 1, 3, 4, 6, 7]]
+    valid = (np.char.str_len(times) == 8) & (midnights != None)
+    valid &= (digits[:, [2, 5]] == ord(':') - ord('0')).all(axis=1)
+    valid &= ((numbers >= 0) & (numbers <= 9)).all(axis=1)
+
+    ret = np.zeros(len(times), dtype='i4')
+    ret[valid] = midnights[valid].astype('i4') + seconds[valid]
+    for i in np.flatnonzero(~valid):
+        dt = parser.parse("%s %s" % (dates[i], times[i]))
+        ret[i] = int(time.mktime(dt.timetuple()))
+    return ret
+
+
+def _to_array(symbols, rows):
+    """Structured array of split quote lines, see REPORT_DTYPE."""
+    ret = np.zeros(len(rows), dtype=REPORT_DTYPE)
+    if len(rows) == 0:
+        return ret
+
+    columns = zip(*rows)
+    ret['symbol'] = symbols
+    ret['name'] = columns[0]
+    for i, (name, dtype) in enumerate(_FIELDS[1:], 1):
+        # volumes may be formatted as float
+        ret[name] = np.array(columns[i]).astype('f8')
+    ret['time'] = _timestamps(columns[30], columns[31])
+    return ret
+
+
+def parse_array(rawdata):
+    """Parse hq.sinajs.cn response into structured array of REPORT_DTYPE.
+
+    Lines not in stock quote format(eg: s_sh000001) are skipped.
+    """
+    symbols = []
+    rows = []
+    for line in rawdata.splitlines():
+        head, sep, body = line.partition('="')
+        if not sep:
+            continue
+        fields = body.split('"', 1)[0].split(',')
+        if len(fields) < 32:
+            continue
+        symbols.append(_symbol(head[head.rfind('_') + 1:]))
+        rows.append(fields[:32])
+    return _to_array(symbols, rows)
+
+
 class SinaReport(Report):
 
     # Data example:
@@ -67,78 +198,48 @@ class SinaReport(Report):
     #   27761321,240634267,11289,8.68,759700,8.67,556338,8.66,455296,8.65,
     #   56600,8.64,143671,8.69,341859,8.70,361255,8.71,314051,8.72,342155,8.73,
     #   2011-05-03,15:03:11";'''
-    _DEFINITIONS = (
-        ("name", str),
-        ("open", float),
-        ("preclose", float),
-        ("price", float),
-        ("high", float),
-        ("low", float),
-        ("bid", float),
-        ("ask", float),
-        ("volume", int),
-        ("amount", float),
-        ("bid1", int),
-        ("bidp1", float),
-        ("bid2", int),
-        ("bidp2", float),
-        ("bid3", int),
-        ("bidp3", float),
-        ("bid4", int),
-        ("bidp4", float),
-        ("bid5", int),
-        ("bidp5", float),
-        ("ask1", int),
-        ("askp1", float),
-        ("ask2", int),
-        ("askp2", float),
-        ("ask3", int),
-        ("askp3", float),
-        ("ask4", int),
-        ("askp4", float),
-        ("ask5", int),
-        ("askp5", float),
-        ("date", lambda x: parser.parse(x).date()),
-        ("time", lambda x: parser.parse(x))
-        )
-    
+
     def __init__(self, security, raw_data):
-        assert len(raw_data) == 32
-
-        data = {}
-        i = 0
-        for conf in self._DEFINITIONS:
-            key, callback = conf
-            data[key] = callback(raw_data[i])
-            i += 1
-        
+        """
+        Arguments:
+          raw_data: 32 fields of quote line, or a record of REPORT_DTYPE.
+        """
+        if not isinstance(raw_data, np.void):
+            assert len(raw_data) == 32
+            raw_data = _to_array([_symbol(str(security))], [raw_data])[0]
+
+        data = dict([(name, raw_data[name].item()) for name, _ in _FIELDS])
+        data['time'] = datetime.datetime.fromtimestamp(raw_data['time'])
+        data['date'] = data['time'].date()
+
         super(SinaReport, self).__init__(security, data)
 
     @staticmethod
     def parse(rawdata):
-        from cStringIO import StringIO
-        
-        f = StringIO(rawdata)
-        return (SinaReport.parse_line(line) for line in f)
+        """Generator of SinaReport, see parse_array for batch parsing."""
+        return (SinaReport(_security(r['symbol']), r) \
+                    for r in parse_array(rawdata))
 
     @staticmethod
     def parse_line(line):
-        splited = line.split('"')
-        idstr = splited[0].split('_').pop()[:-1]
-        s = SinaSecurity.from_string(idstr)
-        return SinaReport(s, splited[1].split(','))
+        return SinaReport.parse(line).next()
 
 
 class SinaReportFetcher(Fetcher):
 
+    # requests per second
+    _RATE_LIMIT = 20
+
     # Maximum number of stocks we'll batch fetch.
     _MAX_REQUEST_SIZE = 100
     
     def __init__(self, base_url='http://hq.sinajs.cn',
-                 time_out=20, max_clients=10, request_size=100):
+                 time_out=20, max_clients=10, request_size=100,
+                 io_loop=None):
         assert request_size <= self._MAX_REQUEST_SIZE
         
-        super(SinaReportFetcher, self).__init__(base_url, time_out, max_clients)
+        super(SinaReportFetcher, self).__init__(base_url, time_out, max_clients,
+                                                io_loop)
         self._request_size = request_size
 
     def _fetching_urls(self, *args, **kwargs):
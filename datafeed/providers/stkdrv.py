@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 yinhm
+
+'''通视(Tongshi/网际风)数据结构解码
+
+Platform independent numpy decoder of stock.dll packets, see tongshi.py for
+the win32 receiver.
+
+分析家通视规范： http://www.51wjf.com/stkdrv.txt
+
+Each packet is a buffer of m_nPacketNum fixed size records, it is decoded
+at once by np.frombuffer instead of one ctypes structure per record.
+
+File data(history, minute) packets hold records of one or more symbols, a
+record whose time is EKE_HEAD_TAG is a head with market and label, data
+records of that symbol follow it.
+'''
+
+import datetime
+import logging
+
+import numpy as np
+
+from datafeed.utils import OHLC_DTYPE
+from datafeed.utils import MINUTE_DTYPE as SNAPSHOT_DTYPE
+
+
+__all__ = ['REPORT_DTYPE', 'HISTORY_DTYPE', 'MINUTE_DTYPE', 'HEAD_DTYPE',
+           'MARKET_SH', 'MARKET_SZ', 'EKE_HEAD_TAG',
+           'format_market', 'decode_reports', 'to_reports',
+           'decode_history', 'decode_minutes']
+
+
+STKLABEL_LEN = 10  # 股号数据长度,国内市场股号编码兼容钱龙
+STKNAME_LEN = 32   # 股名长度
+
+# 上海市场
+MARKET_SH = 18515
+# 深圳市场
+MARKET_SZ = 23123
+
+_MARKETS = {MARKET_SH: 'SH', MARKET_SZ: 'SZ'}
+
+# m_dwHeadTag of head records
+EKE_HEAD_TAG = 0xffffffff
+
+
+# tagRCV_REPORT_STRUCTExV3, packed(_pack_ = 1), 158 bytes
+REPORT_DTYPE = np.dtype([('cbsize', '<u2'),
+                         ('time', '<i4'),
+                         ('market', '<u2'),
+                         ('label', 'S%d' % STKLABEL_LEN),
+                         ('name', 'S%d' % STKNAME_LEN),
+                         ('preclose', '<f4'),
+                         ('open', '<f4'),
+                         ('high', '<f4'),
+                         ('low', '<f4'),
+                         ('price', '<f4'),
+                         ('volume', '<f4'),
+                         ('amount', '<f4'),
+                         ('bidp', '<f4', 3),
+                         ('bid', '<f4', 3),
+                         ('askp', '<f4', 3),
+                         ('ask', '<f4', 3),
+                         ('bidp4', '<f4'),
+                         ('bid4', '<f4'),
+                         ('askp4', '<f4'),
+                         ('ask4', '<f4'),
+                         ('bidp5', '<f4'),
+                         ('bid5', '<f4'),
+                         ('askp5', '<f4'),
+                         ('ask5', '<f4')])
+
+# RCV_HISTORY_STRUCTEx, also used by 1min/5min OHLCs, 32 bytes
+HISTORY_DTYPE = np.dtype([('time', '<i4'),
+                          ('open', '<f4'),
+                          ('high', '<f4'),
+                          ('low', '<f4'),
+                          ('close', '<f4'),
+                          ('volume', '<f4'),
+                          ('amount', '<f4'),
+                          ('advance', '<u2'),
+                          ('decline', '<u2')])
+
+# RCV_MINUTE_STRUCTEx, 16 bytes
+MINUTE_DTYPE = np.dtype([('time', '<i4'),
+                         ('price', '<f4'),
+                         ('volume', '<f4'),
+                         ('amount', '<f4')])
+
+# RCV_EKE_HEADEx, shares leading bytes with data records
+HEAD_DTYPE = np.dtype([('tag', '<u4'),
+                       ('market', '<u2'),
+                       ('label', 'S%d' % STKLABEL_LEN)])
+
+
+def format_market(value):
+    try:
+        return _MARKETS[value]
+    except KeyError:
+        raise Exception('Unknown market.')
+
+
+def _cstr(value):
+    '''Bytes before first NUL, fixed size fields are not cleared after it.'''
+    return value.split('\0', 1)[0]
+
+
+def decode_reports(buf, count=None):
+    '''Decode report packet to array of REPORT_DTYPE, no copy.
+
+    Arguments:
+      buf: str/buffer of packet data.
+      count: number of records, default to all records in buf.
+    '''
+    if count is None:
+        count = len(buf) // REPORT_DTYPE.itemsize
+    return np.frombuffer(buf, dtype=REPORT_DTYPE, count=count)
+
+
+def to_reports(reports, encoding='gbk'):
+    '''Convert reports array to dict of report dicts keyed by symbol, as
+    put_reports expects.
+
+    Reports of suspended(price is zero) or unknown market are skipped.
+    '''
+    known = np.in1d(reports['market'], _MARKETS.keys())
+    if not known.all():
+        logging.warning("Skip %d reports of unknown market.",
+                        np.count_nonzero(~known))
+    reports = reports[known & (reports['price'] > 0)]
+
+    ret = {}
+    if len(reports) == 0:
+        return ret
+
+    columns = dict((name, reports[name].tolist()) for name in \
+                       ('time', 'market', 'label', 'name', 'preclose',
+                        'open', 'high', 'low', 'price', 'volume', 'amount'))
+    for i in xrange(len(reports)):
+        timestamp = columns['time'][i]
+        symbol = _MARKETS[columns['market'][i]] + _cstr(columns['label'][i])
+        price = columns['price'][i]
+        ret[symbol] = {
+            'time'     : datetime.datetime.fromtimestamp(timestamp).strftime(
+                '%Y-%m-%d %H:%M:%S'),
+            'timestamp': timestamp,
+            'price'    : price,
+            'amount'   : columns['amount'][i],
+            'volume'   : columns['volume'][i],
+            'symbol'   : symbol,
+            'name'     : _cstr(columns['name'][i]).decode(encoding, 'ignore'),
+            'open'     : columns['open'][i],
+            'high'     : columns['high'][i],
+            'low'      : columns['low'][i],
+            'close'    : price,
+            'preclose' : columns['preclose'][i]
+            }
+    return ret
+
+
+def _split(buf, count, dtype, fields):
+    '''Split file data packet by head records.
+
+    Return:
+      list of (symbol, records) pairs, records are copies of fields.
+    '''
+    if count is None:
+        count = len(buf) // dtype.itemsize
+    records = np.frombuffer(buf, dtype=dtype, count=count)
+    if len(records) == 0:
+        return []
+
+    heads = np.frombuffer(buf, dtype=np.dtype({
+                'names': HEAD_DTYPE.names,
+                'formats': [HEAD_DTYPE.fields[n][0] for n in HEAD_DTYPE.names],
+                'offsets': [HEAD_DTYPE.fields[n][1] for n in HEAD_DTYPE.names],
+                'itemsize': dtype.itemsize}), count=count)
+
+    # first record is always a head
+    is_head = heads['tag'] == EKE_HEAD_TAG
+    is_head[0] = True
+    starts = np.flatnonzero(is_head)
+    ends = np.append(starts[1:], count)
+
+    ret = []
+    for start, end in zip(starts, ends):
+        try:
+            symbol = format_market(int(heads['market'][start])) + \
+                _cstr(heads['label'][start])
+        except Exception:
+            logging.warning("Skip %d records of unknown market %d.",
+                            end - start - 1, heads['market'][start])
+            continue
+
+        data = np.empty(end - start - 1, dtype=fields)
+        for name in fields.names:
+            data[name] = records[name][start + 1:end]
+        ret.append((symbol, data))
+    return ret
+
+
+def decode_history(buf, count=None):
+    '''Decode history(day, 1min and 5min OHLCs) packet.
+
+    Return:
+      list of (symbol, OHLC_DTYPE array) pairs, ready for put_days,
+      put_1minutes and put_5minutes.
+    '''
+    return _split(buf, count, HISTORY_DTYPE, OHLC_DTYPE)
+
+
+def decode_minutes(buf, count=None):
+    '''Decode minute snapshot packet.
+
+    Return:
+      list of (symbol, utils.MINUTE_DTYPE array) pairs, ready for
+      put_minutes.
+    '''
+    return _split(buf, count, MINUTE_DTYPE, SNAPSHOT_DTYPE)
@@ -3,9 +3,12 @@
 from __future__ import with_statement
 
 import os
+import tempfile
 import unittest
 from cStringIO import StringIO
 
+import numpy as np
+
 from datafeed.providers.dzh import *
 
 class DzhDayTest(unittest.TestCase):
@@ -34,6 +37,55 @@ class DzhDayTest(unittest.TestCase):
         self.assertFloatEqual(ohlc['volume'], 1260.0)
         self.assertFloatEqual(ohlc['amount'], 494000.0)
 
+    def _write(self, io, blocks, records):
+        """Write a dzh file with one symbol 000001 of given blocks."""
+        per_block = io._BLOCK_SIZE // 32
+        index = np.zeros(1, dtype=io.INDEX_DTYPE)
+        index['symbol'] = '000001'
+        index['count'] = len(records)
+        index['blocks'] = -1
+        index['blocks'][0, :len(blocks)] = blocks
+
+        area = np.zeros(max(blocks) + 1, dtype=(io.RECORD_DTYPE, per_block))
+        for i, block in enumerate(blocks):
+            rows = records[i * per_block:(i + 1) * per_block]
+            area[block][:len(rows)] = rows
+
+        data = '\x00' * io._INDEX_START + index.tostring()
+        data = data.ljust(io._BLOCK_START, '\x00') + area.tostring()
+
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, data)
+        os.close(fd)
+        self.addCleanup(os.remove, filename)
+        return filename
+
+    def test_read_blocks(self):
+        io = DzhDay()
+        records = np.zeros(300, dtype=io.RECORD_DTYPE)
+        records['time'] = np.arange(300) + 661564800
+        records['close'] = np.arange(300)
+        records['time'][10] = -1
+        filename = self._write(io, [2, 0], records)
+
+        symbol, ohlcs = io.read(filename, 'SH').next()
+        self.assertEqual(symbol, "SH000001")
+        # invalid and empty rows dropped
+        self.assertEqual(len(ohlcs), 299)
+        self.assertEqual(ohlcs.dtype, np.dtype(io._DTYPE))
+        self.assertEqual(ohlcs['time'][0], 661564800)
+        self.assertEqual(ohlcs['close'][10], 11)
+        self.assertEqual(ohlcs['time'][-1], 661564800 + 299)
+
+    def test_read_minute_time_fixed(self):
+        io = DzhFiveMinute()
+        records = np.zeros(1, dtype=io.RECORD_DTYPE)
+        records['time'] = 1300000000
+        filename = self._write(io, [0], records)
+
+        symbol, ohlcs = io.read(filename, 'SH').next()
+        self.assertEqual(ohlcs['time'][0], 1300000000 - 8 * 3600)
+
 
 class DzhDividendTest(unittest.TestCase):
 
@@ -51,6 +103,48 @@ class DzhDividendTest(unittest.TestCase):
         
 
 
+    def test_read_loaded(self):
+        record = np.array([(701308800, 0.5, 0.0, 0.0, 0.2)],
+                          dtype=[('time', np.int32),
+                                 ('split', np.float32),
+                                 ('purchase', np.float32),
+                                 ('purchase_price', np.float32),
+                                 ('dividend', np.float32)])
+        data = '\x00' * 12 + 'SZ000001'.ljust(16, '\x00') + \
+            record.tostring() + '\xff' * 4
+
+        io = DzhDividend()
+        io.load(data)
+        symbol, divs = io.read().next()
+
+        self.assertEqual(symbol, "SZ000001")
+        self.assertEqual(divs[0]['time'], 701308800)
+        self.assertEqual(divs[0]['split'], 0.5)
+
+    def test_decode(self):
+        io = DzhDividend()
+        records = np.zeros(3, dtype=io.DTYPE)
+        records['time'] = [701308800, 751308800, 801308800]
+        records['dividend'] = [0.2, 0.1, 0.3]
+        records['split'][1] = np.array(-1, dtype=np.int32).view(np.float32)
+
+        data = '\x00' * 12 + \
+            'SZ000001'.ljust(16, '\x00') + records.tostring() + '\xff' * 4 + \
+            'SZ000002'.ljust(16, '\x00') + '\xff' * 4 + \
+            'SZ000003'.ljust(16, '\x00') + records[:1].tostring()
+
+        ret = io.decode(data)
+        self.assertEqual([symbol for symbol, _ in ret],
+                         ['SZ000001', 'SZ000002', 'SZ000003'])
+        # \xff * 4 inside records is not a sentinel
+        self.assertEqual(len(ret[0][1]), 3)
+        self.assertEqual(ret[0][1]['time'][2], 801308800)
+        self.assertEqual(len(ret[1][1]), 0)
+        self.assertEqual(ret[2][1]['time'][0], 701308800)
+
+        self.assertEqual(io.decode('\x00' * 12), [])
+
+
 class DzhSectorTest(unittest.TestCase):
 
     def test_read_generator(self):
@@ -124,6 +124,26 @@ class GoogleDayTest(unittest.TestCase):
                 self.assertEqual(ohlc.volume, 2037378.0)
             i += 1
 
+    def test_parse_array(self):
+        path = os.path.dirname(os.path.realpath(__file__))
+        with open(os.path.join(path, 'google_data.csv'), 'r') as f:
+            data = f.read()
+
+        y = GoogleDay.parse_array(data)
+        self.assertEqual(str(date.fromtimestamp(y[-1]['time'])), "2011-04-28")
+        self.assertTrue(abs(y[-1]['close'] - 537.97) < 0.001)
+        self.assertEqual(y[-1]['volume'], 2037378)
+
+    def test_parse_array_slow_path(self):
+        data = 'Date,Open,High,Low,Close,Volume\n' \
+            '28-Apr-11,538.06,539.25,534.08,537.97,2037378\n' \
+            '27-Apr-11,-,538.11,534.35,537.76,"2,297,840"\n'
+
+        y = GoogleDay.parse_array(data)
+        self.assertEqual(str(date.fromtimestamp(y[0]['time'])), "2011-04-27")
+        self.assertEqual(y[0]['open'], 0)
+        self.assertEqual(y[0]['volume'], 2297840)
+
 
 class GoogleReportFetcherTest(unittest.TestCase):
 
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import unittest
+
+from tornado import web
+from tornado.testing import AsyncHTTPTestCase
+
+from datafeed.providers.http_fetcher import *
+
+
+class EchoHandler(web.RequestHandler):
+    def get(self, name):
+        self.write(name)
+
+
+class ThrottleHandler(web.RequestHandler):
+    """429 on first two requests of each name."""
+    counts = {}
+
+    def get(self, name):
+        self.counts[name] = self.counts.get(name, 0) + 1
+        if self.counts[name] <= 2:
+            self.set_status(429, 'Too Many Requests')
+        self.write(name)
+
+
+class EchoFetcher(Fetcher):
+    _RETRY_DELAY = 0.01
+
+    def _fetching_urls(self, *args, **kwargs):
+        return (self._base_url + name for name in args)
+
+    def _callback(self, name, **kwargs):
+        def callback(response):
+            self.queue_len = self.queue_len - 1
+            kwargs['callback'](response.body)
+            self.stop()
+        return callback
+
+
+class FetcherTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return web.Application([(r'/throttle/(\w+)', ThrottleHandler),
+                                (r'/(\w+)', EchoHandler)])
+
+    def _fetcher(self):
+        return EchoFetcher(self.get_url('/'), io_loop=self.io_loop)
+
+    def test_fetch_async(self):
+        f = self._fetcher()
+        futures = f.fetch_async('foo', 'bar')
+        self.assertEqual(len(futures), 2)
+
+        for future in futures:
+            self.io_loop.add_future(future, lambda _: self.stop())
+            self.wait()
+
+        self.assertEqual([future.result().body for future in futures],
+                         ['foo', 'bar'])
+        self.assertEqual(f.queue_len, 0)
+
+        stats = f.latencies()
+        host = self.get_url('/').split('/')[2]
+        self.assertEqual(stats[host]['count'], 2)
+        self.assertEqual(stats[host]['errors'], 0)
+        self.assertTrue(stats[host]['average'] <= stats[host]['max'])
+
+    def test_fetch_async_streaming(self):
+        received = []
+
+        def callback(body):
+            received.append(body)
+            if len(received) == 2:
+                self.stop()
+
+        f = self._fetcher()
+        f.fetch_async('foo', 'bar', callback=callback)
+        self.wait()
+        self.assertEqual(sorted(received), ['bar', 'foo'])
+        # one client for fetchers on the same loop
+        self.assertTrue(f.http_client is self._fetcher().http_client)
+
+    def test_retry_throttled(self):
+        f = EchoFetcher(self.get_url('/throttle/'), max_clients=4,
+                        io_loop=self.io_loop)
+        future = f.fetch_async('foo')[0]
+        self.io_loop.add_future(future, lambda _: self.stop())
+        self.wait()
+
+        self.assertEqual(future.result().code, 200)
+        stats = f.latencies().values()[0]
+        self.assertEqual(stats['retries'], 2)
+        self.assertEqual(stats['errors'], 2)
+        # halved twice, then increased by the success
+        self.assertEqual(stats['concurrency'], 2)
+
+    def test_retry_exhausted(self):
+        f = EchoFetcher(self.get_url('/throttle/'), io_loop=self.io_loop)
+        f._RETRIES = 1
+        future = f.fetch_async('bar')[0]
+        self.io_loop.add_future(future, lambda _: self.stop())
+        self.wait()
+        self.assertEqual(future.result().code, 429)
+
+    def test_concurrency_increase(self):
+        f = EchoFetcher(self.get_url('/'), max_clients=2, io_loop=self.io_loop)
+        futures = f.fetch_async(*['foo'] * 20)
+        for future in futures:
+            self.io_loop.add_future(future, lambda _: self.stop())
+            self.wait()
+        self.assertTrue(f.latencies().values()[0]['concurrency'] > 2)
+
+    def test_callback_error(self):
+        def callback(body):
+            raise ValueError(body)
+
+        f = EchoFetcher(self.get_url('/'), max_clients=1, io_loop=self.io_loop)
+        futures = f.fetch_async('foo', 'bar', callback=callback)
+        # bar still dispatched after callback of foo failed
+        self.io_loop.add_future(futures[1], lambda _: self.stop())
+        self.wait()
+        self.assertEqual(futures[1].result().body, 'bar')
+
+    def test_shared_rate_limit(self):
+        class LimitedFetcher(EchoFetcher):
+            _RATE_LIMIT = 5
+            _BUCKETS = {}
+
+        f1 = LimitedFetcher(self.get_url('/'), io_loop=self.io_loop)
+        f2 = LimitedFetcher(self.get_url('/'), io_loop=self.io_loop)
+        host = self.get_url('/').split('/')[2]
+        self.assertTrue(f1._host(self.get_url('/'))[1].bucket is \
+                            f2._host(self.get_url('/'))[1].bucket)
+        self.assertEqual(LimitedFetcher._BUCKETS.keys(), [host])
+
+    def test_blocking_fetch_on_shared_loop(self):
+        self.assertRaises(AssertionError, self._fetcher().fetch, 'foo')
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_consume(self):
+        bucket = TokenBucket(2, burst=2)
+        now = bucket.stamp
+        self.assertEqual(bucket.consume(now), 0)
+        self.assertEqual(bucket.consume(now), 0)
+        self.assertAlmostEqual(bucket.consume(now), 0.5)
+        self.assertEqual(bucket.consume(now + 0.5), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -51,6 +51,25 @@ var hq_str_sh600028="中国石化,8.64,8.64,8.68,8.71,8.58,8.68,8.69,27761321,24
                 self.assertEqual(str(r.date), "2011-05-03")
 
             i += 1
+        self.assertEqual(i, 2)
+
+    def test_parse_array(self):
+        rawdata = self._RAW_DATA + '\nvar hq_str_s_sh000001="上证指数,2932.188";'
+        ret = parse_array(rawdata)
+
+        self.assertEqual(ret.dtype, REPORT_DTYPE)
+        self.assertEqual(ret['symbol'].tolist(), ['SH000001', 'SH600028'])
+        self.assertEqual(ret[1]['name'], '中国石化')
+        self.assertEqual(ret[1]['volume'], 27761321)
+        self.assertEqual(ret[1]['askp5'], 8.73)
+        self.assertEqual(datetime.fromtimestamp(ret[1]['time']),
+                         datetime(2011, 5, 3, 15, 3, 11))
+
+    def test_parse_array_time_fallback(self):
+        rawdata = self._RAW_DATA.replace('15:03:11";\nvar',
+                                         '3:03:11 PM";\nvar')
+        ret = parse_array(rawdata)
+        self.assertEqual(ret['time'][0], ret['time'][1])
 
 
 class SinaReportFetcherTest(unittest.TestCase):
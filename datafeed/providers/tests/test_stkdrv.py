@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import struct
+import unittest
+
+import numpy as np
+
+from datafeed.providers.stkdrv import *
+
+
+def report(market, label, name, price, time=1300000000):
+    # cbsize, time, market, label, name, preclose..amount, 5 levels
+    values = [price] * 7 + [0.0] * 20
+    return struct.pack('<HiH10s32s27f', 158, time, market, label, name,
+                       *values)
+
+def head(market, label, itemsize):
+    buf = struct.pack('<IH10s', EKE_HEAD_TAG, market, label)
+    return buf + '\0' * (itemsize - len(buf))
+
+def history(time, close):
+    return struct.pack('<i6f2H', time, close, close + 1, close - 1, close,
+                       100.0, 1000.0, 1, 2)
+
+def minute(time, price):
+    return struct.pack('<i3f', time, price, 10.0, 100.0)
+
+
+class StkdrvTest(unittest.TestCase):
+
+    def test_dtypes(self):
+        self.assertEqual(REPORT_DTYPE.itemsize, 158)
+        self.assertEqual(HISTORY_DTYPE.itemsize, 32)
+        self.assertEqual(MINUTE_DTYPE.itemsize, 16)
+
+    def test_decode_reports(self):
+        buf = report(MARKET_SH, '600000', u'浦发银行'.encode('gbk'), 10.5) + \
+            report(MARKET_SZ, '000001\0junk', 'PAYH', 0.0) + \
+            report(MARKET_SZ, '000002', 'WKA', 8.25)
+
+        reports = decode_reports(buf, 3)
+        self.assertEqual(len(reports), 3)
+        self.assertEqual(reports[0]['label'], '600000')
+        self.assertAlmostEqual(reports[2]['price'], 8.25)
+
+        ret = to_reports(reports)
+        # suspended one is skipped
+        self.assertEqual(sorted(ret.keys()), ['SH600000', 'SZ000002'])
+
+        r = ret['SH600000']
+        self.assertEqual(r['symbol'], 'SH600000')
+        self.assertEqual(r['name'], u'浦发银行')
+        self.assertEqual(r['timestamp'], 1300000000)
+        self.assertAlmostEqual(r['close'], 10.5)
+        self.assertAlmostEqual(r['preclose'], 10.5)
+        self.assertTrue(isinstance(r['price'], float))
+
+    def test_to_reports_unknown_market(self):
+        buf = report(1, '600000', 'X', 10.0)
+        self.assertEqual(to_reports(decode_reports(buf)), {})
+
+    def test_decode_history(self):
+        buf = head(MARKET_SH, '600000', 32) + \
+            history(1300000000, 10.0) + \
+            history(1300086400, 11.0) + \
+            head(MARKET_SZ, '000001', 32) + \
+            history(1300000000, 20.0)
+
+        items = decode_history(buf, 5)
+        self.assertEqual([symbol for symbol, _ in items],
+                         ['SH600000', 'SZ000001'])
+
+        symbol, ohlcs = items[0]
+        self.assertEqual(ohlcs.dtype.names,
+                         ('time', 'open', 'high', 'low', 'close',
+                          'volume', 'amount'))
+        self.assertEqual(ohlcs['time'].tolist(), [1300000000, 1300086400])
+        self.assertEqual(ohlcs['close'].tolist(), [10.0, 11.0])
+        self.assertEqual(ohlcs['high'].tolist(), [11.0, 12.0])
+        self.assertEqual(items[1][1]['close'].tolist(), [20.0])
+
+    def test_decode_history_unknown_market(self):
+        buf = head(1, '600000', 32) + history(1300000000, 10.0) + \
+            head(MARKET_SZ, '000001', 32) + history(1300000000, 20.0)
+
+        items = decode_history(buf)
+        self.assertEqual(len(items), 1)
+        self.assertEqual(items[0][0], 'SZ000001')
+
+    def test_decode_minutes(self):
+        buf = head(MARKET_SH, '600000', 16) + \
+            minute(1300000000, 10.0) + \
+            minute(1300000060, 10.5)
+
+        items = decode_minutes(buf, 3)
+        self.assertEqual(len(items), 1)
+
+        symbol, minutes = items[0]
+        self.assertEqual(symbol, 'SH600000')
+        self.assertEqual(minutes.dtype.names,
+                         ('time', 'price', 'volume', 'amount'))
+        self.assertEqual(minutes['price'].tolist(), [10.0, 10.5])
+
+    def test_decode_empty(self):
+        self.assertEqual(decode_history(''), [])
+        self.assertEqual(len(decode_reports('')), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -87,6 +87,18 @@ class YahooDayTest(unittest.TestCase):
                 self.assertEqual(ohlc.adjclose, 533.89)
             i += 1
 
+    def test_parse_array(self):
+        path = os.path.dirname(os.path.realpath(__file__))
+        with open(os.path.join(path, 'yahoo_tables.csv'), 'r') as f:
+            data = f.read()
+
+        y = YahooDay.parse_array(data)
+        self.assertEqual(str(datetime.date.fromtimestamp(y[-1]['time'])),
+                         "2011-05-03")
+        self.assertTrue((y['time'][1:] > y['time'][:-1]).all())
+        self.assertTrue(abs(y[-1]['open'] - 537.13) < 0.001)
+        self.assertEqual(y[-1]['volume'], 2081500)
+
 
 class YahooReportFetcherTest(unittest.TestCase):
 
@@ -45,6 +45,7 @@ from datetime import datetime
 import numpy as np
 
 from datafeed.client import Client
+from datafeed.providers.stkdrv import *
 
 
 RCV_WORK_SENDMSG = 4
@@ -72,21 +73,6 @@ FILE_HTML_EX = 0x1004  # HTML文件,m_szFileName为URL
 
 FILE_SOFTWARE_EX = 0x2000  # 升级软件
 
-# 上海市场
-MARKET_SH = 18515
-# 深圳市场
-MARKET_SZ = 23123
-
-
-def format_market(value):
-    if value == MARKET_SH:
-        return 'SH'
-    elif value == MARKET_SZ:
-        return 'SZ'
-    else:
-        raise Exception('Unknown market.')
-
-
 class Report(Structure):
     '''tagRCV_REPORT_STRUCTExV3 data structure
     '''
@@ -121,41 +107,6 @@ class Report(Structure):
                 ('m_fSellVolume5', c_float)]
 
 
-    @property
-    def symbol(self):
-        return format_market(self.m_wMarket) + self.m_szLabel
-
-    def is_valid(self):
-        """Is this report data valid?
-
-        We seems get data full of zero if stock got suspended.
-        Use this method to detect is the data valid so you can filter it.
-        """
-        return self.m_fNewPrice > 0
-
-    def to_dict(self):
-        '''Convert to dict object.
-        '''
-        t = datetime.fromtimestamp(self.m_time)
-        t = t.strftime('%Y-%m-%d %H:%M:%S')
-
-        quote = {
-            'time'     : t,
-            'timestamp': self.m_time,
-            'price'    : self.m_fNewPrice,
-            'amount'   : self.m_fAmount,
-            'volume'   : self.m_fVolume,
-            'symbol'   : self.symbol,
-            'name'     : self.m_szName.decode('gbk'),
-            'open'     : self.m_fOpen,
-            'high'     : self.m_fHigh,
-            'low'      : self.m_fLow,
-            'close'    : self.m_fNewPrice,
-            'preclose' : self.m_fLastClose
-            }
-        return quote
-
-
 class Head(Structure):
     '''头数据'''
     _fields_ = [('m_dwHeadTag', DWORD),
@@ -176,21 +127,6 @@ class History(Structure):
                 ('m_wAdvance', WORD),
                 ('m_wDecline', WORD)]
 
-    def to_tuple(self):
-        """Convert ohlc to tuple.
-
-        Returns
-        -------
-        tuple
-        """
-        return (self.m_time,
-                self.m_fOpen,
-                self.m_fHigh,
-                self.m_fLow,
-                self.m_fClose,
-                self.m_fVolume,
-                self.m_fAmount)
-
 
 class HistoryUnion(Union):
     '''日线数据头 or 日线数据'''
@@ -198,20 +134,6 @@ class HistoryUnion(Union):
     _fields_ = [('data', History),
                 ('head', Head)]
 
-    DTYPE = [('time', '<i4'),
-             ('open', '<f4'),
-             ('high', '<f4'),
-             ('low', '<f4'),
-             ('close', '<f4'),
-             ('volume', '<f4'),
-             ('amount', '<f4')]
-
-    def market(self):
-        return format_market(self.head.m_wMarket)
-
-    def symbol(self):
-        return self.head.m_szLabel
-
 
 class Minute(Structure):
     _fields_ = [('m_time', c_int),
@@ -219,18 +141,6 @@ class Minute(Structure):
                 ('m_fVolume', c_float),
                 ('m_fAmount', c_float)]
 
-    def to_tuple(self):
-        """Convert Minute to tuple.
-
-        Returns
-        -------
-        tuple
-        """
-        return (self.m_time,
-                self.m_fPrice,
-                self.m_fVolume,
-                self.m_fAmount)
-
 
 class MinuteUnion(Union):
     '''补充分时数据'''
@@ -238,17 +148,6 @@ class MinuteUnion(Union):
     _fields_ = [('data', Minute),
                 ('head', Head)]
 
-    DTYPE = [('time', '<i4'),
-             ('price', '<f4'),
-             ('volume', '<f4'),
-             ('amount', '<f4')]
-
-    def market(self):
-        return format_market(self.head.m_wMarket)
-
-    def symbol(self):
-        return self.head.m_szLabel
-
 
 class Dividend(Union):
     pass
@@ -390,47 +289,27 @@ class MainWindow(object):
 
         if wparam == RCV_REPORT:
             # Report
-            records = {}
-            for i in xrange(header.m_nPacketNum):
-                r = Report.from_address(header.ptr + sizeof(Report) * i)
-                if r.is_valid():
-                    records[r.symbol] = r.to_dict()
+            buf = string_at(header.ptr, sizeof(Report) * header.m_nPacketNum)
+            records = to_reports(decode_reports(buf, header.m_nPacketNum))
 
-            self.client.put_reports(records)
+            self.client.put_report_deltas(records)
             print "%d report data sended" % header.m_nPacketNum
         elif wparam == RCV_FILEDATA:
             if header.m_wDataType in (FILE_HISTORY_EX, FILE_5MINUTE_EX, FILE_1MINUTE_EX):
-                # Daily history
-                history_head = HistoryUnion.from_address(header.ptr)
-
-                records = []
-                key = history_head.market() + history_head.symbol()
-                for i in xrange(header.m_nPacketNum - 1):
-                    # start from ptr + sizeof(History), first one was the header
-                    q = History.from_address(header.ptr + sizeof(History) * (i+1))
-                    records.append(q.to_tuple())
-
-                rec = np.array(records, dtype=HistoryUnion.DTYPE)
+                # Daily history, 5min and 1min OHLCs
+                buf = string_at(header.ptr, sizeof(HistoryUnion) * header.m_nPacketNum)
+                items = decode_history(buf, header.m_nPacketNum)
 
                 if header.m_wDataType == FILE_HISTORY_EX:
-                    self.client.put_day(key, rec)
+                    self.client.put_days(items)
                 elif header.m_wDataType == FILE_5MINUTE_EX:
-                    self.client.put_5minute(key, rec)
+                    self.client.put_5minutes(items)
                 elif header.m_wDataType == FILE_1MINUTE_EX:
-                    self.client.put_1minute(key, rec) # no implementation
+                    self.client.put_1minutes(items)
             elif header.m_wDataType == FILE_MINUTE_EX:
                 # Minute
-                minute_head = MinuteUnion.from_address(header.ptr)
-
-                records = []
-                key = minute_head.market() + minute_head.symbol()
-                for i in xrange(header.m_nPacketNum - 1):
-                    # start from ptr + sizeof(Minute), first one was the header
-                    q = Minute.from_address(header.ptr + sizeof(Minute) * (i+1))
-                    records.append(q.to_tuple())
-
-                rec = np.array(records, dtype=MinuteUnion.DTYPE)
-                self.client.put_minute(key, rec)
+                buf = string_at(header.ptr, sizeof(MinuteUnion) * header.m_nPacketNum)
+                self.client.put_minutes(decode_minutes(buf, header.m_nPacketNum))
             elif header.m_wDataType == FILE_POWER_EX:
                 print "power ex"
             elif header.m_wDataType == FILE_BASE_EX:
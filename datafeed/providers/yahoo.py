@@ -25,7 +25,7 @@ from datafeed.bidict import Bidict
 from datafeed.exchange import *
 from datafeed.quote import *
 from datafeed.providers.http_fetcher import *
-from datafeed.utils import json_decode
+from datafeed.utils import OHLC_DTYPE, json_decode, parse_ohlc_csv
 
 __all__ = ['YahooSecurity',
            'YahooReport', 'YahooReportFetcher',
@@ -149,9 +149,17 @@ class YahooDay(Day):
         r.next() # skip header
         return (YahooDay(security, line) for line in r)
 
+    @staticmethod
+    def parse_array(rawdata):
+        """Parse csv into numpy OHLCs ordered by time, ready for put_day."""
+        return parse_ohlc_csv(rawdata, OHLC_DTYPE)
+
 
 class YahooReportFetcher(Fetcher):
 
+    # requests per second
+    _RATE_LIMIT = 10
+
     # Live quotes tags format,
     # consistent with downloads link on the web page.
     _FORMAT = "sl1d1t1c1ohgv"
@@ -160,10 +168,12 @@ class YahooReportFetcher(Fetcher):
     _MAX_REQUEST_SIZE = 100
     
     def __init__(self, base_url='http://download.finance.yahoo.com/d/quotes.csv',
-                 time_out=20, max_clients=10, request_size=100):
+                 time_out=20, max_clients=10, request_size=100,
+                 io_loop=None):
         assert request_size <= self._MAX_REQUEST_SIZE
         
-        super(YahooReportFetcher, self).__init__(base_url, time_out, max_clients)
+        super(YahooReportFetcher, self).__init__(base_url, time_out, max_clients,
+                                                 io_loop)
         self._request_size = request_size
 
     def _fetching_urls(self, *args, **kwargs):
@@ -203,9 +213,13 @@ class YahooReportFetcher(Fetcher):
 
 class YahooDayFetcher(DayFetcher):
 
+    # requests per second
+    _RATE_LIMIT = 10
+
     def __init__(self, base_url='http://ichart.finance.yahoo.com/table.csv',
-                 time_out=20, max_clients=10):
-        super(YahooDayFetcher, self).__init__(base_url, time_out, max_clients)
+                 time_out=20, max_clients=10, io_loop=None):
+        super(YahooDayFetcher, self).__init__(base_url, time_out, max_clients,
+                                              io_loop)
 
     def _make_url(self, security, **kwargs):
         """Make url to fetch.
@@ -240,8 +254,10 @@ class YahooNewsFetcher(Fetcher):
     # Maximum number of stocks we'll batch fetch.
     _MAX_REQUEST_SIZE = 100
     
-    def __init__(self, base_url=_BASE_URL, time_out=10, max_clients=5):
-        super(YahooNewsFetcher, self).__init__(base_url, time_out, max_clients)
+    def __init__(self, base_url=_BASE_URL, time_out=10, max_clients=5,
+                 io_loop=None):
+        super(YahooNewsFetcher, self).__init__(base_url, time_out, max_clients,
+                                               io_loop)
 
     def _fetching_urls(self, *args, **kwargs):
         return (self._make_url(str(security)) for security in args)
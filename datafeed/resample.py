@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 yinhm
+
+'''Resample minute snapshots or report stream to OHLC bars.
+
+Minute snapshots hold last price, accumulated volume and amount of each
+trading minute. Bars are laid on the exchange session table, labeled by
+bar end time, eg: for SH 5 minutes bars are 09:35 ... 11:30, 13:05 ... 15:00.
+
+Snapshot taken at session open(opening auction) goes to the first bar of
+that session, snapshots within market break go to the next session.
+'''
+
+import time
+
+import numpy as np
+
+from datafeed.datastore import OHLC
+
+
+__all__ = ['INTERVALS', 'bar_times', 'resample', 'BarAggregator']
+
+
+# Supported bar intervals in minutes.
+INTERVALS = (1, 5, 15, 30, 60)
+
+
+def bar_times(exchange, interval, now):
+    '''Return bar end timestamps of the trading day of now.
+
+    Arguments:
+      exchange: StockExchange instance.
+      interval: bar interval in minutes.
+      now: any timestamp of the trading day.
+    '''
+    assert interval in INTERVALS, "Unsupported interval %s." % interval
+    step = interval * 60
+    times = [np.arange(start + step, end + 1, step) \
+                 for start, end in exchange.trading_sessions(now=now)]
+    return np.concatenate(times).astype('i4')
+
+
+def resample(data, exchange, interval):
+    '''Resample minute snapshots of a trading day to OHLC bars.
+
+    Arguments:
+      data: numpy minute snapshots, see Minute.DTYPE.
+      exchange: StockExchange instance.
+      interval: bar interval in minutes.
+
+    Return:
+      numpy OHLCs, one row per bar of the day, empty bars before first
+      trade left zeroed, empty bars after that carry previous close.
+    '''
+    data = data[(data['time'] > 0) & (data['price'] > 0)]
+    if len(data) == 0:
+        return np.zeros(0, dtype=OHLC.DTYPE)
+    data = data[np.argsort(data['time'], kind='mergesort')]
+
+    times = bar_times(exchange, interval, int(data['time'][0]))
+    bars = np.zeros(len(times), dtype=OHLC.DTYPE)
+
+    # bar index of each snapshot, snapshots after close go to last bar
+    index = np.searchsorted(times, data['time'], side='left')
+    index = np.minimum(index, len(times) - 1)
+
+    filled, first = np.unique(index, return_index=True)
+    last = np.append(first[1:], len(index)) - 1
+
+    price = data['price']
+    bars['time'][filled] = times[filled]
+    bars['open'][filled] = price[first]
+    bars['high'][filled] = np.maximum.reduceat(price, first)
+    bars['low'][filled] = np.minimum.reduceat(price, first)
+    bars['close'][filled] = price[last]
+
+    # volume and amount are accumulated through the day
+    for field in ('volume', 'amount'):
+        accumulated = data[field][last]
+        previous = np.append(0, accumulated[:-1])
+        bars[field][filled] = np.maximum(accumulated - previous, 0)
+
+    # carry previous close to empty bars
+    mask = np.zeros(len(times), dtype=bool)
+    mask[filled] = True
+    prev = np.maximum.accumulate(np.where(mask, np.arange(len(times)), -1))
+    empty = ~mask & (prev >= 0)
+    close = bars['close'][prev[empty]]
+    bars['time'][empty] = times[empty]
+    for field in ('open', 'high', 'low', 'close'):
+        bars[field][empty] = close
+
+    return bars
+
+
+class BarAggregator(object):
+    '''Aggregate forming OHLC bars of interval minutes from report stream.
+
+    Bars of all symbols are kept in preallocated arrays, rows are indexed by
+    symbol, a batch of reports touches only rows of symbols in that batch.
+
+    A bar is closed once time passed its end time, the forming bar of a
+    symbol is moved to closed bars when the next bar starts.
+    '''
+
+    def __init__(self, exchange, interval, capacity=4096):
+        assert interval in INTERVALS, "Unsupported interval %s." % interval
+        self.exchange = exchange
+        self.interval = interval
+
+        self._rows = {}
+        self._current = np.zeros(capacity, dtype=OHLC.DTYPE)
+        self._closed = np.zeros(capacity, dtype=OHLC.DTYPE)
+        # accumulated volume, amount at end of previous bar and last report
+        self._base = np.zeros((capacity, 2))
+        self._last = np.zeros((capacity, 2))
+
+        self._day = None
+        self._times = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def update(self, reports):
+        '''Update bars from a dict of reports keyed by symbol.'''
+        count = len(reports)
+        rows = np.empty(count, dtype='i4')
+        ts = np.empty(count, dtype='i8')
+        values = np.empty((count, 3))
+
+        i = 0
+        for symbol, report in reports.iteritems():
+            if 'timestamp' not in report:
+                continue
+            rows[i] = self._row(symbol)
+            ts[i] = report['timestamp']
+            values[i] = (report['price'], report['volume'], report['amount'])
+            i += 1
+
+        if i > 0:
+            self._update(rows[:i], ts[:i], values[:i])
+
+    def update_array(self, symbols, ts, values):
+        '''Update bars from aligned symbols, timestamps and
+        (price, volume, amount) values.'''
+        if len(symbols) == 0:
+            return
+        rows = np.array([self._row(symbol) for symbol in symbols], dtype='i4')
+        self._update(rows, np.asarray(ts, dtype='i8'),
+                     np.asarray(values, dtype='f8'))
+
+    def get(self, symbol, now=None):
+        '''Return last closed bar and forming bar of symbol.
+
+        Raise:
+          KeyError: if no reports of symbol received today.
+        '''
+        row = self._rows[symbol]
+        current = self._current[row:row + 1]
+        if current['time'][0] == 0:
+            raise KeyError(symbol)
+
+        if current['time'][0] < self._label(now or time.time()):
+            # no reports since bar closed
+            return current.copy()
+
+        closed = self._closed[row:row + 1]
+        if closed['time'][0] == 0:
+            return current.copy()
+        return np.concatenate((closed, current))
+
+    def _row(self, symbol):
+        try:
+            return self._rows[symbol]
+        except KeyError:
+            row = len(self._rows)
+            if row >= len(self._current):
+                self._grow()
+            self._rows[symbol] = row
+            return row
+
+    def _grow(self):
+        capacity = len(self._current) * 2
+        for name in ('_current', '_closed', '_base', '_last'):
+            arr = getattr(self, name)
+            newarr = np.zeros((capacity, ) + arr.shape[1:], dtype=arr.dtype)
+            newarr[:len(arr)] = arr
+            setattr(self, name, newarr)
+
+    def _bar_times(self, now):
+        day = self.exchange.change_time(0, 0, now=now)
+        if day != self._day:
+            self._day = day
+            self._times = bar_times(self.exchange, self.interval, now)
+        return self._times
+
+    def _label(self, now):
+        '''End time of the bar which now belongs to.'''
+        times = self._bar_times(now)
+        i = np.searchsorted(times, now, side='left')
+        if i == len(times):
+            # after market closed
+            return times[-1] + 1
+        return times[i]
+
+    def _update(self, rows, ts, values):
+        now = ts.max()
+        if self._day and now < self._day:
+            now = self._day
+        times = self._bar_times(now)
+
+        # skip stale reports of previous days, eg: suspended symbols
+        valid = (ts >= self._day) & (values[:, 0] > 0)
+        rows, ts, values = rows[valid], ts[valid], values[valid]
+
+        index = np.minimum(np.searchsorted(times, ts, side='left'),
+                           len(times) - 1)
+        label = times[index]
+
+        bars = self._current[rows]
+        # drop out of order reports of closed bars
+        valid = label >= bars['time']
+        rows, label, values, bars = \
+            rows[valid], label[valid], values[valid], bars[valid]
+
+        new = label > bars['time']
+        rolled = new & (bars['time'] > 0)
+        self._closed[rows[rolled]] = bars[rolled]
+        self._base[rows[new]] = self._last[rows[new]]
+        # accumulated volume restart every trading day
+        self._base[rows[new & (bars['time'] < self._day)]] = 0
+
+        price = values[:, 0].astype('f4')
+        bars['time'][new] = label[new]
+        bars['open'][new] = price[new]
+        bars['high'] = np.where(new, price, np.maximum(bars['high'], price))
+        bars['low'] = np.where(new, price, np.minimum(bars['low'], price))
+        bars['close'] = price
+
+        accumulated = values[:, 1:]
+        traded = np.maximum(accumulated - self._base[rows], 0)
+        bars['volume'] = traded[:, 0]
+        bars['amount'] = traded[:, 1]
+
+        self._last[rows] = accumulated
+        self._current[rows] = bars
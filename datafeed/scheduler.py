@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 yinhm
+
+'''Event driven job scheduler on top of tornado IOLoop.
+
+Instead of polling every second, each job computes its next fire time, the
+scheduler arms exactly one IOLoop timeout per job and rearms it after the job
+finished.
+
+Job execution time and missed runs are recorded, a run is missed if the job
+fired later than tolerance seconds, or fire times were skipped because the
+previous run took too long.
+
+TaskQueue holds background tasks which are consumed in time slices, so
+request latency stays bounded no matter how many tasks queued.
+'''
+
+import collections
+import functools
+import logging
+import time
+
+from tornado import ioloop
+
+
+__all__ = ['Scheduler', 'Job', 'TaskQueue']
+
+
+class Job(object):
+    '''A scheduled job.
+
+    next_time: callable returns next fire timestamp after given timestamp, or
+               None if the job should not be scheduled.
+    '''
+
+    # Upper bound of counting skipped fire times.
+    _MAX_SKIPPED = 10000
+
+    def __init__(self, name, callback, next_time):
+        self.name = name
+        self.callback = callback
+        self.next_time = next_time
+
+        self.deadline = None
+        self.timeout = None
+
+        self.runs = 0
+        self.missed = 0
+        self.errors = 0
+        self.last_run = None
+        self.last_duration = None
+        self.min = None
+        self.max = None
+        self.total = 0
+
+    @property
+    def armed(self):
+        return self.timeout is not None
+
+    def record(self, start_time, duration):
+        self.runs += 1
+        self.last_run = start_time
+        self.last_duration = duration
+        if self.min is None or duration < self.min:
+            self.min = duration
+        if self.max is None or duration > self.max:
+            self.max = duration
+        self.total += duration
+
+    def count_skipped(self, now):
+        '''Count fire times passed between current deadline and now.'''
+        skipped = 0
+        prev = self.deadline
+        ts = self.next_time(prev)
+        while ts is not None and prev < ts < now and \
+                skipped < self._MAX_SKIPPED:
+            skipped += 1
+            prev, ts = ts, self.next_time(ts)
+        return skipped
+
+    def to_dict(self):
+        return {'runs': self.runs,
+                'missed': self.missed,
+                'errors': self.errors,
+                'last_run': self.last_run,
+                'last_duration': self.last_duration,
+                'next_run': self.deadline,
+                'min': self.min,
+                'max': self.max,
+                'total': self.total}
+
+
+class Scheduler(object):
+
+    def __init__(self, io_loop=None, tolerance=5):
+        self.io_loop = io_loop or ioloop.IOLoop.instance()
+        self.tolerance = tolerance
+        self._jobs = {}
+        self._running = False
+
+    def add_job(self, name, callback, next_time):
+        assert name not in self._jobs, "Job %s exists." % name
+        job = Job(name, callback, next_time)
+        self._jobs[name] = job
+        if self._running:
+            self._arm(job, time.time())
+        return job
+
+    def get_job(self, name):
+        return self._jobs[name]
+
+    def start(self):
+        self._running = True
+        now = time.time()
+        for job in self._jobs.itervalues():
+            self._arm(job, now)
+
+    def stop(self):
+        self._running = False
+        for job in self._jobs.itervalues():
+            self._disarm(job)
+
+    def wakeup(self, name):
+        '''Arm a job which has no fire time scheduled.'''
+        job = self._jobs[name]
+        if self._running and not job.armed:
+            self._arm(job, time.time())
+
+    def stats(self):
+        return dict((name, job.to_dict()) for name, job in self._jobs.iteritems())
+
+    def log(self):
+        msg = ["\njob\truns\tmissed\terrors\tmin\tmax\ttotal"]
+        for name, job in self._jobs.iteritems():
+            msg.append("%s\t%d\t%d\t%d\t%.2f\t%.2f\t%.2f" % \
+                           (name, job.runs, job.missed, job.errors,
+                            job.min or 0, job.max or 0, job.total))
+        logging.info("\n".join(msg))
+
+    def _arm(self, job, now):
+        self._disarm(job)
+        job.deadline = job.next_time(now)
+        if job.deadline is None:
+            return
+        job.timeout = self.io_loop.add_timeout(job.deadline,
+                                               functools.partial(self._fire, job))
+
+    def _disarm(self, job):
+        if job.timeout is not None:
+            self.io_loop.remove_timeout(job.timeout)
+            job.timeout = None
+
+    def _fire(self, job):
+        job.timeout = None
+        start_time = time.time()
+
+        late = start_time - job.deadline
+        if late > self.tolerance:
+            job.missed += 1
+            logging.warning("Job %s fired %.2fs late." % (job.name, late))
+
+        try:
+            job.callback()
+        except Exception:
+            job.errors += 1
+            logging.exception("Job %s failed." % job.name)
+
+        end_time = time.time()
+        duration = end_time - start_time
+        job.record(start_time, duration)
+        logging.debug("Job %s finished in %.2fms." % (job.name, 1000.0 * duration))
+
+        skipped = job.count_skipped(end_time)
+        if skipped > 0:
+            job.missed += skipped
+            logging.warning("Job %s missed %d runs." % (job.name, skipped))
+
+        if self._running:
+            self._arm(job, end_time)
+
+
+class TaskQueue(object):
+    '''Priority task queue consumed in time budgeted slices.
+
+    Tasks are objects with a run() method, lower priority number runs first.
+    '''
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 1
+    PRIORITY_LOW = 2
+
+    def __init__(self, budget=0.005):
+        self.budget = budget
+        self._queues = [collections.deque() for i in xrange(self.PRIORITY_LOW + 1)]
+
+        self.processed = 0
+        self.errors = 0
+        self.max_slice = 0
+
+    def __len__(self):
+        return sum(len(q) for q in self._queues)
+
+    def __nonzero__(self):
+        return any(self._queues)
+
+    def put(self, task, priority=PRIORITY_NORMAL):
+        self._queues[priority].append((time.time(), task))
+
+    def reserve(self):
+        """Pop next task.
+
+        Raise:
+          IndexError: if queue is empty.
+        """
+        for queue in self._queues:
+            if queue:
+                return queue.popleft()[1]
+        raise IndexError("reserve from empty queue")
+
+    def run(self, budget=None):
+        """Run tasks until queue drained or time budget(seconds) exhausted.
+
+        At least one task runs each slice, return count of tasks ran.
+        """
+        if budget is None:
+            budget = self.budget
+
+        start_time = time.time()
+        deadline = start_time + budget
+        count = 0
+        while True:
+            try:
+                task = self.reserve()
+            except IndexError:
+                break
+
+            try:
+                task.run()
+            except Exception:
+                self.errors += 1
+                logging.exception("Task %r failed." % task)
+            count += 1
+
+            if time.time() >= deadline:
+                break
+
+        self.processed += count
+        self.max_slice = max(self.max_slice, time.time() - start_time)
+        return count
+
+    def oldest_age(self, now=None):
+        """Seconds since the oldest queued task was added."""
+        now = now or time.time()
+        times = [q[0][0] for q in self._queues if q]
+        if len(times) == 0:
+            return 0
+        return now - min(times)
+
+    def stats(self):
+        return {'depth': [len(q) for q in self._queues],
+                'age': self.oldest_age(),
+                'processed': self.processed,
+                'errors': self.errors,
+                'max_slice': self.max_slice}
@@ -20,15 +20,24 @@ Supported commands
     get_1minute
     get_5minute
     get_day
+    get_panel
+    get_bar
     get_dividend
     get_sector
     get_stats
     get_report
     put_reports
+    put_report_symbols
+    put_report_deltas
     put_minute
+    put_minutes
     put_1minute
     put_5minute
+    put_1minutes
+    put_5minutes
     put_day
+    put_days
+    bgsave
 
     
 Client Protocol
@@ -85,6 +94,7 @@ For more details: http://redis.io/topics/protocol
 '''
 import datetime
 import errno
+import functools
 import logging
 import marshal
 import os
@@ -105,6 +115,7 @@ except ImportError:
     from tornado.netutil import TCPServer # tornado 2.x
 
 from datafeed import datastore
+from datafeed.utils import REPORT_DELTA_DTYPE, REPORT_SYMBOL_DTYPE
 from datafeed.utils import json_encode
 
 
@@ -153,6 +164,13 @@ class Stats(dict):
         logging.info("\n".join(msg))
 
 
+def _resize(arr, size):
+    '''Grow object array to size, new items are None.'''
+    ret = np.empty(size, dtype=object)
+    ret[:len(arr)] = arr
+    return ret
+
+
 class Connection(object):
 
     def __init__(self, stream, address, stats, require_auth, auth_password, request_callback=None):
@@ -163,6 +181,9 @@ class Connection(object):
         self.auth_password = auth_password
         self.authenticated = False
         self.request_callback = request_callback
+        # symbol and name of report deltas by index, see put_report_symbols
+        self.report_symbols = np.empty(0, dtype=object)
+        self.report_names = np.empty(0, dtype=object)
         self._request = Request(connection=self)
         self._request_finished = False
 
@@ -294,7 +315,8 @@ class Application(object):
 
     def __init__(self, datadir, exchange, **kwargs):
         self.dbm = datastore.Manager(datadir, exchange)
-        self.exchange = exchange
+        # primary exchange
+        self.exchange = self.dbm.exchange
 
         if 'handler' in kwargs:
             self._handler = kwargs['handler']
@@ -319,15 +341,24 @@ class Handler(object):
                          'get_1minute',
                          'get_5minute',
                          'get_day',
+                         'get_panel',
+                         'get_bar',
                          'get_dividend',
                          'get_sector',
                          'get_stats',
                          'get_report',
                          'put_reports',
+                         'put_report_symbols',
+                         'put_report_deltas',
                          'put_minute',
+                         'put_minutes',
                          'put_1minute',
                          'put_5minute',
-                         'put_day')
+                         'put_1minutes',
+                         'put_5minutes',
+                         'put_day',
+                         'put_days',
+                         'bgsave')
 
     def __init__(self, application, request, **kwargs):
         self.application = application
@@ -400,9 +431,9 @@ class Handler(object):
         try:
             ts = int(timestamp)
             if ts > 0:
-                store = self.dbm.get_minutestore_at(ts)
+                store = self.dbm.get_market(symbol).get_minutestore_at(ts)
             else:
-                store = self.dbm.minutestore
+                store = self.dbm.get_market(symbol).minutestore
                 
             y = store.get(symbol)
 
@@ -429,7 +460,7 @@ class Handler(object):
             if isinstance(date, str):
                 date = datetime.datetime.strptime(date, '%Y%m%d').date()
 
-            y = self.dbm.oneminstore.get(symbol, date)
+            y = self.dbm.get_market(symbol).oneminstore.get(symbol, date)
 
             if format == 'npy':
                 memfile = StringIO()
@@ -454,7 +485,7 @@ class Handler(object):
             if isinstance(date, str):
                 date = datetime.datetime.strptime(date, '%Y%m%d').date()
 
-            y = self.dbm.fiveminstore.get(symbol, date)
+            y = self.dbm.get_market(symbol).fiveminstore.get(symbol, date)
 
             if format == 'npy':
                 memfile = StringIO()
@@ -495,24 +526,43 @@ class Handler(object):
             self.request.write("-ERR Sector %s not exists.\r\n" % name)
 
     def get_stats(self, name, format='json'):
-        stats = self.request.connection.stats
+        stats = dict(self.request.connection.stats)
+        stats['snapshot'] = self.dbm.save_stats()
         self._write_response(json_encode(stats))
 
-    def get_day(self, symbol, length_or_date, format='npy'):
+    def get_day(self, symbol, length_or_date, *args):
         """Get OHLCs quotes.
 
+        Arguments:
+          length_or_date: last n quotes, a single date 20101209, or date
+                          range like 20101201-20101231.
+          args: [adjust] format, adjust is none, forward or backward,
+                adjusted by dividends, format is npy or json.
+
         Return chronicle ordered quotes.
         """
+        format = args and args[-1] or 'npy'
+        adjust = len(args) > 1 and args[0] or 'none'
         try:
             if len(length_or_date) == 8: # eg: 20101209
                 date = datetime.datetime.strptime(length_or_date, '%Y%m%d').date()
                 y = self.dbm.daystore.get_by_date(symbol, date)
+            elif len(length_or_date) == 17: # eg: 20101201-20101231
+                start, end = [datetime.datetime.strptime(d, '%Y%m%d').date() \
+                                  for d in length_or_date.split('-')]
+                y = self.dbm.daystore.get_range(symbol, start, end)
             else:
                 length = length_or_date
                 y = self.dbm.daystore.get(symbol, int(length))
                 if length == 1:
                     y = y[0]
 
+            if adjust != 'none':
+                single = np.ndim(y) == 0
+                y = self.dbm.adjust_day(symbol, np.array(y, ndmin=1), adjust)
+                if single:
+                    y = y[0]
+
             if format == 'npy':
                 memfile = StringIO()
                 np.save(memfile, y)
@@ -523,6 +573,68 @@ class Handler(object):
             self._write_response(data)
         except KeyError:
             self.request.write("-ERR Symbol %s not exists.\r\n" % symbol)
+        except ValueError, e:
+            self.request.write_error(str(e))
+
+    def get_panel(self, symbols, field, length_or_range, interval='day',
+                  format='npy'):
+        """Get one field of multiple symbols aligned by time.
+
+        Arguments:
+          symbols: comma separated symbols.
+          field: OHLC field, eg: close.
+          length_or_range: last n trading days(day only), or date range like
+                           20101201-20101231, or a single date 20101209.
+          interval: day, 1min or 5min.
+          format: npy or json
+
+        npy response contains time index followed by 2-D array of values.
+        """
+        try:
+            if len(length_or_range) >= 8:
+                dates = [datetime.datetime.strptime(d, '%Y%m%d').date() \
+                             for d in length_or_range.split('-')]
+                length_or_range = (dates[0], dates[-1])
+
+            index, values = self.dbm.get_panel(symbols.split(','),
+                                               field,
+                                               length_or_range,
+                                               interval)
+        except ValueError, e:
+            return self.request.write_error(str(e))
+
+        if format == 'npy':
+            memfile = StringIO()
+            np.save(memfile, index)
+            np.save(memfile, values)
+            data = memfile.getvalue()
+        else:
+            data = json_encode({'time': index.tolist(),
+                                'values': values.tolist()})
+        self._write_response(data)
+
+    def get_bar(self, symbol, interval='1min', format='npy'):
+        """Get last closed bar and forming bar aggregated from reports.
+
+        Arguments:
+        symbol: String of security.
+        interval: 1min or 5min.
+        format: npy or json
+        """
+        try:
+            y = self.dbm.get_bar(symbol, interval)
+        except ValueError, e:
+            return self.request.write_error(str(e))
+        except KeyError:
+            return self.request.write("-ERR Symbol %s not exists.\r\n" % symbol)
+
+        if format == 'npy':
+            memfile = StringIO()
+            np.save(memfile, y)
+            data = memfile.getvalue()
+        else:
+            data = json_encode(y.tolist())
+        self._write_response(data)
 
     def _write_response(self, ret):
         self.request.write("$%s\r\n%s\r\n" % (len(ret), ret))
@@ -543,23 +655,133 @@ class Handler(object):
             return self.request.write("-ERR wrong data format\r\n")
         self.dbm.update_reports(data)
         self.request.write_ok()
-        
+
+    def put_report_symbols(self, data, format='npy'):
+        """Register symbols and names of report deltas on this connection.
+
+        Data Format:
+
+        npy serialized REPORT_SYMBOL_DTYPE array.
+        """
+        assert format == 'npy'
+
+        try:
+            table = np.load(StringIO(data))
+            assert table.dtype == REPORT_SYMBOL_DTYPE
+        except StandardError:
+            return self.request.write("-ERR wrong data format\r\n")
+
+        conn = self.request.connection
+        if len(table) > 0:
+            size = int(table['index'].max()) + 1
+            if size > len(conn.report_symbols):
+                conn.report_symbols = _resize(conn.report_symbols, size)
+                conn.report_names = _resize(conn.report_names, size)
+            conn.report_symbols[table['index']] = table['symbol'].tolist()
+            conn.report_names[table['index']] = \
+                [name.decode('utf-8', 'ignore') for name in table['name']]
+        self.request.write_ok()
+
+    def put_report_deltas(self, data, format='npy'):
+        """Update reports from fixed size rows, symbol and name of each
+        row are looked up in symbols registered by put_report_symbols.
+
+        Data Format:
+
+        npy serialized REPORT_DELTA_DTYPE array.
+        """
+        assert format == 'npy'
+
+        try:
+            rows = np.load(StringIO(data))
+            assert rows.dtype == REPORT_DELTA_DTYPE
+        except StandardError:
+            return self.request.write("-ERR wrong data format\r\n")
+
+        conn = self.request.connection
+        index = rows['index']
+        unknown = index >= len(conn.report_symbols)
+        if not unknown.any():
+            symbols = conn.report_symbols[index]
+            unknown = np.array([symbol is None for symbol in symbols],
+                               dtype=bool)
+        if unknown.any():
+            return self.request.write_error(
+                "unknown report symbol %d" % index[unknown][0])
+
+        self.dbm.update_report_rows(symbols, conn.report_names[index], rows)
+        self.request.write_ok()
+
     def put_minute(self, symbol, data, format='npy'):
         func = getattr(self.dbm, "update_minute")
         self._put(func, symbol, data, format)
         
     def put_1minute(self, symbol, data, format='npy'):
-        self.dbm.oneminstore.update(symbol, np.load(StringIO(data)))
+        store = self.dbm.get_market(symbol).oneminstore
+        store.update(symbol, np.load(StringIO(data)))
         self.request.write_ok()
 
     def put_5minute(self, symbol, data, format='npy'):
-        self.dbm.fiveminstore.update(symbol, np.load(StringIO(data)))
+        store = self.dbm.get_market(symbol).fiveminstore
+        store.update(symbol, np.load(StringIO(data)))
         self.request.write_ok()
 
+    def put_1minutes(self, data, format='npy'):
+        func = functools.partial(self.dbm.update_ohlcs, '1min')
+        self._put_multi(func, data, format)
+
+    def put_5minutes(self, data, format='npy'):
+        func = functools.partial(self.dbm.update_ohlcs, '5min')
+        self._put_multi(func, data, format)
+
     def put_day(self, symbol, data, format='npy'):
         func = getattr(self.dbm, "update_day")
         self._put(func, symbol, data, format)
         
+    def put_minutes(self, data, format='npy'):
+        func = getattr(self.dbm, "update_minutes")
+        self._put_multi(func, data, format)
+
+    def put_days(self, data, format='npy'):
+        func = getattr(self.dbm, "update_days")
+        self._put_multi(func, data, format)
+
+    def _put_multi(self, func, data, format):
+        """Bulk update of multiple symbols.
+
+        Data Format:
+
+        npy serialized symbol/offset index followed by npy serialized
+        concatenated data, see utils.pack_arrays.
+        """
+        assert format == 'npy'
+
+        start_time = time.time()
+
+        try:
+            memfile = StringIO(data)
+            index = np.load(memfile)
+            data = np.load(memfile)
+        except StandardError:
+            return self.request.write("-ERR wrong data format\r\n")
+
+        end_time = time.time()
+        parse_time = 1000.0 * (end_time - start_time)
+        logging.info("proto parse: %.2fms, %d symbols", parse_time, len(index))
+
+        func(index, data)
+
+        self.request.write("+OK\r\n")
+
+    def bgsave(self, *args):
+        """Snapshot in memory stores to disk in a forked process.
+        """
+        if self.dbm.bgsave_poll():
+            return self.request.write_error("Background save already in progress")
+
+        self.dbm.bgsave()
+        self.request.write_ok()
+
     def _put(self, func, symbol, data, format):
         assert format == 'npy'
         
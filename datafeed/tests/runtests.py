@@ -4,8 +4,13 @@ import unittest
 TEST_MODULES = [
     'datafeed.tests.test_client',
     'datafeed.tests.test_datastore',
+    'datafeed.tests.test_dividend',
     'datafeed.tests.test_exchange',
     'datafeed.tests.test_imiguserver',
+    'datafeed.tests.test_ingest',
+    'datafeed.tests.test_importer',
+    'datafeed.tests.test_resample',
+    'datafeed.tests.test_scheduler',
     'datafeed.tests.test_server',
 ]
 
@@ -20,7 +20,9 @@ import numpy as np
 from cStringIO import StringIO
 
 from datetime import datetime
-from datafeed.client import Client
+from datafeed.client import Client, ConnectionError
+
+from mock import Mock, patch
 
 class ClientTest(unittest.TestCase):
 
@@ -72,6 +74,62 @@ class ClientTest(unittest.TestCase):
         ret = self.client.put_reports({})
         self.assertEqual(ret, 'OK')
 
+    def test_put_report_deltas(self):
+        r = self.client.get_report('SH000001')
+        r['price'] = r['close'] = 2860.5
+        r['volume'] = r['volume'] + 100
+
+        ret = self.client.put_report_deltas({'SH000001': r})
+        self.assertEqual(ret, 'OK')
+
+        quote = self.client.get_report('SH000001')
+        self.assertEqual(quote['price'], 2860.5)
+        self.assertEqual(quote['volume'], r['volume'])
+        self.assertEqual(quote['name'], r['name'])
+
+        # unchanged reports are not sent
+        with patch.object(self.client, 'execute_command') as mock:
+            ret = self.client.put_report_deltas({'SH000001': r})
+            self.assertEqual(ret, 'OK')
+            self.assertFalse(mock.called)
+
+    def test_put_report_deltas_rename(self):
+        r = self.client.get_report('SH000001')
+
+        def report(symbol, price, name=u'TEST'):
+            ret = dict(r, symbol=symbol, name=name)
+            ret['price'] = ret['close'] = price
+            return ret
+
+        self.client.put_report_deltas({'SH900101': report('SH900101', 1.0),
+                                       'SH900102': report('SH900102', 2.0)})
+        # renamed symbol keeps its index, new symbols get new ones
+        self.client.put_report_deltas({'SH900101': report('SH900101', 1.0,
+                                                          u'RENAMED'),
+                                       'SH900103': report('SH900103', 3.0)})
+        self.client.put_report_deltas({'SH900104': report('SH900104', 4.0)})
+        self.client.put_report_deltas({'SH900103': report('SH900103', 3.5)})
+
+        indexes = [index for index, name in \
+                       self.client._report_symbols.itervalues()]
+        self.assertEqual(len(set(indexes)), len(indexes))
+
+        reports = self.client.get_reports('SH900101', 'SH900103', 'SH900104')
+        self.assertEqual(reports['SH900101']['name'], u'RENAMED')
+        self.assertEqual(reports['SH900103']['price'], 3.5)
+        self.assertEqual(reports['SH900104']['price'], 4.0)
+
+    def test_put_report_deltas_reconnect(self):
+        r = self.client.get_report('SH000001')
+        self.client.put_report_deltas({'SH000001': r})
+
+        # symbols are registered again on new connection
+        self.client.reconnect()
+        r['price'] = r['close'] = 2861.5
+        ret = self.client.put_report_deltas({'SH000001': r})
+        self.assertEqual(ret, 'OK')
+        self.assertEqual(self.client.get_report('SH000001')['price'], 2861.5)
+
     def test_get_list(self):
         stocks = self.client.get_list()
         self.assertTrue(isinstance(stocks, dict))
@@ -107,6 +165,161 @@ class ClientTest(unittest.TestCase):
         ret = self.client.get_minute(symbol, int(time.time()))
         self.assertEqual(data['price'].tolist(), ret['price'].tolist())
 
+    def test_put_days(self):
+        x = np.zeros(2, dtype=[('time', '<i4'), ('open', '<f4'),
+                               ('high', '<f4'), ('low', '<f4'),
+                               ('close', '<f4'), ('volume', '<f4'),
+                               ('amount', '<f4')])
+        x['time'] = [1316448000, 1316534400]
+        x['close'] = [10.0, 11.0]
+
+        ret = self.client.put_days({'SH999997': x, 'SH999998': x[1:]})
+        self.assertEqual(ret, 'OK')
+
+        y = self.client.get_day('SH999998', '20110921')
+        self.assertEqual(y['close'], 11.0)
+
+        y = self.client.get_day('SH999997', ('20110919', '20110921'),
+                                adjust='forward')
+        self.assertEqual(y['close'].tolist(), [10.0, 11.0])
+
+        self.assertRaises(Exception, self.client.get_day, 'SH999997', 2,
+                          adjust='sideways')
+
+    def test_put_1minutes(self):
+        x = np.zeros(2, dtype=[('time', '<i4'), ('open', '<f4'),
+                               ('high', '<f4'), ('low', '<f4'),
+                               ('close', '<f4'), ('volume', '<f4'),
+                               ('amount', '<f4')])
+        x['time'] = [1316482200, 1316482260]
+        x['close'] = [10.0, 11.0]
+
+        ret = self.client.put_1minutes({'SH999993': x, 'SH999994': x[1:]})
+        self.assertEqual(ret, 'OK')
+
+        y = self.client.get_1minute('SH999993', '20110920')
+        self.assertEqual(y[y['time'] > 0]['close'].tolist(), [10.0, 11.0])
+
+    def test_bgsave(self):
+        ret = self.client.bgsave()
+        self.assertEqual(ret, 'OK')
+
+        stats = self.client.get_stats()
+        self.assertTrue('snapshot' in stats)
+
+    def test_get_bar(self):
+        y = self.client.get_bar('SH000001', '1min')
+        self.assertTrue(abs(y[-1]['close'] - 2856.99) < 0.01)
+
+        self.assertRaises(Exception, self.client.get_bar, 'SH000001', '2min')
+
+    def test_get_panel(self):
+        x = np.zeros(2, dtype=[('time', '<i4'), ('open', '<f4'),
+                               ('high', '<f4'), ('low', '<f4'),
+                               ('close', '<f4'), ('volume', '<f4'),
+                               ('amount', '<f4')])
+        x['time'] = [1316448000, 1316534400]
+        x['close'] = [10.0, 11.0]
+        self.client.put_days({'SH999995': x, 'SH999996': x[1:]})
+
+        index, values = self.client.get_panel(['SH999995', 'SH999996'],
+                                              'close',
+                                              ('20110920', '20110921'))
+        self.assertEqual(index.tolist(), x['time'].tolist())
+        self.assertEqual(values.shape, (2, 2))
+        self.assertEqual(values[1].tolist(), [11.0, 11.0])
+        self.assertTrue(np.isnan(values[0, 1]))
+
+    def test_put_then_get_minutes(self):
+        path = os.path.dirname(os.path.realpath(__file__))
+        data = numpy.load(os.path.join(path, 'minute.npy'))
+
+        today = datetime.today()
+        for row in data:
+            day = datetime.fromtimestamp(int(row['time']))
+            t = time.mktime((today.year, today.month, today.day,
+                             day.hour, day.minute, 0, 0, 0, 0))
+            row['time'] = int(t)
+
+        ret = self.client.put_minutes([('SH999997', data),
+                                       ('SH999998', data)])
+        self.assertEqual(ret, 'OK')
+
+        ret = self.client.get_minute('SH999998', int(time.time()))
+        self.assertEqual(data['price'].tolist(), ret['price'].tolist())
+
+
+class ClientRetryTest(unittest.TestCase):
+    '''Offline tests, no server needed.'''
+
+    def setUp(self):
+        self.client = Client(retries=2, retry_delay=0)
+
+    def test_retry_idempotent_command(self):
+        self.client._execute_command = Mock(
+            side_effect=[ConnectionError('reset'), 1291167000])
+
+        ret = self.client.get_mtime()
+        self.assertEqual(ret, 1291167000)
+        self.assertEqual(self.client._execute_command.call_count, 2)
+
+    def test_retry_gives_up(self):
+        self.client._execute_command = Mock(side_effect=ConnectionError('down'))
+
+        self.assertRaises(ConnectionError, self.client.get_mtime)
+        self.assertEqual(self.client._execute_command.call_count, 3)
+
+    def test_no_retry_for_put(self):
+        self.client._execute_command = Mock(side_effect=ConnectionError('reset'))
+
+        self.assertRaises(ConnectionError, self.client.put_reports, {})
+        self.assertEqual(self.client._execute_command.call_count, 1)
+
+    def test_per_call_timeout(self):
+        self.client._execute_command = Mock(return_value=1)
+
+        self.client.get_mtime(timeout=5)
+        args = self.client._execute_command.call_args[0]
+        self.assertEqual(args[-1], 5)
+
+    def test_per_call_timeout_on_send(self):
+        # server accepts nothing, sendall stalls once buffers are full
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        try:
+            client = Client(port=server.getsockname()[1], retry_delay=0)
+            start = time.time()
+            self.assertRaises(ConnectionError, client.execute_command,
+                              'PUT_REPORTS', 'x' * (64 << 20), 'zip',
+                              timeout=0.2)
+            self.assertTrue(time.time() - start < 5)
+            self.assertEqual(client._sock, None)
+        finally:
+            server.close()
+
+    def test_send_reconnect_after_write_error(self):
+        sock1 = Mock()
+        sock1.sendall.side_effect = socket.error(32, 'Broken pipe')
+        sock2 = Mock()
+        self.client._sock = sock1
+
+        def reconnect(timeout=None):
+            self.client._sock = sock2
+            return sock2
+        self.client.reconnect = reconnect
+
+        self.client.send('data')
+        sock2.sendall.assert_called_with('data')
+
+    def test_read_error_disconnect(self):
+        self.client._sock = Mock()
+        self.client._fp = Mock()
+        self.client._fp.readline.side_effect = socket.timeout('timed out')
+
+        self.assertRaises(ConnectionError, self.client.read)
+        self.assertFalse(self.client.connected)
+
 
 if __name__ == '__main__':
     unittest.main()
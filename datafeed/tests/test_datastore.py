@@ -8,13 +8,14 @@ import unittest
 
 import numpy as np
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from mock import Mock, patch
 
-from datafeed.exchange import SH
+from datafeed.exchange import HK, SH
 from datafeed.datastore import *
 from datafeed.tests import helper
+from datafeed.utils import REPORT_DELTA_DTYPE, pack_arrays
 
 
 class ManagerTest(unittest.TestCase):
@@ -32,7 +33,7 @@ class ManagerTest(unittest.TestCase):
         self.assertTrue(isinstance(ret, Day))
 
     def test_not_inited_minutestore(self):
-        ret = self.manager._minutestore
+        ret = self.manager.markets[0]._minutestore
         self.assertEqual(ret, None)
 
     def test_init_manager_with_minute_store(self):
@@ -65,6 +66,110 @@ class ManagerTest(unittest.TestCase):
         dbm.rotate_minute_store()
         self.assertEqual('/minsnap/20101204', dbm.minutestore.pathname)
 
+    def test_rotate_minute_store_in_background(self):
+        dbm = self.manager
+        ts = int(time.time())
+        dbm.set_mtime(ts)
+        x = helper.sample_minutes()
+        dbm.minutestore.update('TS000001', x)
+        dbm.minutestore.update('TS000002', x)
+
+        dbm.set_mtime(ts + 86400)
+        dbm.rotate_minute_store()
+        self.assertTrue(dbm.rotating)
+
+        # old day still readable from cache while rotating
+        store = dbm.get_minutestore_at(ts)
+        self.assertTrue(isinstance(store.handle, MinuteSnapshotCache))
+
+        self.assertTrue(dbm.rotate_step(1))
+        progress = dbm.rotation_progress()
+        self.assertEqual(progress[0]['date'], store.pathname[-8:])
+        self.assertEqual(progress[0]['total'], 2)
+        self.assertEqual(progress[0]['done'], 1)
+
+        self.assertFalse(dbm.rotate_step(1))
+        self.assertFalse(dbm.rotating)
+
+        store = dbm.get_minutestore_at(ts, memory=False)
+        self.assertTrue(isinstance(store.handle, h5py.Group))
+        np.testing.assert_array_equal(store.get('TS000002'), x)
+
+    def test_rotation_resample_bars(self):
+        dbm = self.manager
+        ts = int(time.time())
+        dbm.set_mtime(ts)
+        x = helper.sample_minutes()
+        dbm.minutestore.update('TS000003', x)
+
+        dbm.set_mtime(ts + 86400)
+        dbm.rotate_minute_store()
+        while dbm.rotate_step():
+            pass
+
+        date = datetime.fromtimestamp(ts).date()
+        y = dbm.oneminstore.get('TS000003', date)
+        self.assertEqual(len(y), dbm.oneminstore.shape_x)
+        self.assertEqual(y[0]['open'], x[0]['price'])
+        self.assertEqual(len(dbm.oneminstore.get_range('TS000003', date, date)), 240)
+
+        y = dbm.fiveminstore.get('TS000003', date)
+        self.assertEqual(len(y), 48)
+        self.assertEqual(y[-1]['close'], x[-1]['price'])
+
+    def test_resume_rotation(self):
+        date = datetime.fromtimestamp(1291341180).date()
+        cache = MinuteSnapshotCache(self.manager._dstore, date)
+        cache['TS000001'] = np.zeros(242, Minute.DTYPE)
+
+        # restarted with new day data, cache left not rotated
+        self.manager.set_mtime(1291341180 + 86400)
+        self.assertTrue(self.manager.rotating)
+        while self.manager.rotate_step():
+            pass
+
+        cached = MinuteSnapshotCache.cached_dates(self.manager._dstore)
+        self.assertFalse(date in cached)
+
+    def test_migrate_flat_snapshot_cache(self):
+        ts = 1291341180
+        date = datetime.fromtimestamp(ts).date()
+        x = np.zeros(242, Minute.DTYPE)
+        x['time'][:2] = (ts - 60, ts)
+        x['price'][:2] = 10.0
+
+        # cached by old versions, not grouped by date
+        group = self.manager._dstore.require_group('minutesnapshotcache')
+        group['TS000011'] = x
+        group['TS000012'] = np.zeros(242, Minute.DTYPE)
+
+        cached = MinuteSnapshotCache.cached_dates(self.manager._dstore)
+        self.assertTrue(date in cached)
+        self.assertFalse('TS000011' in group)
+        self.assertFalse('TS000012' in group)
+
+        cache = MinuteSnapshotCache(self.manager._dstore, date)
+        np.testing.assert_array_equal(cache['TS000011'], x)
+        self.assertFalse(cache.has_key('TS000012'))
+
+    def test_rotation_step_failure(self):
+        date = datetime.fromtimestamp(1291341180).date()
+        cache = MinuteSnapshotCache(self.manager._dstore, date)
+        cache['TS000013'] = np.zeros(242, Minute.DTYPE)
+        cache['TS000014'] = np.zeros(242, Minute.DTYPE)
+
+        tostore = Mock()
+        tostore.date = date
+        tostore.update.side_effect = [KeyError('TS000013'), None]
+        rotation = MinuteRotation(cache, tostore)
+
+        rotation.step(1)
+        rotation.step(1)
+        self.assertTrue(rotation.finished)
+        self.assertEqual(tostore.update.call_count, 2)
+        self.assertEqual(rotation.progress()['done'], 2)
+        self.assertEqual(rotation.progress()['failed'], 1)
+
     def test_get_minutestore(self):
         store = self.manager.get_minutestore_at(1291341180)
         self.assertTrue(isinstance(store, Minute))
@@ -75,9 +180,10 @@ class ManagerTest(unittest.TestCase):
         data = [p1]
         store = Mock()
 
-        self.manager.get_minutestore_at = Mock(return_value=store)
+        market = self.manager.get_market("SH000001")
+        market.get_minutestore_at = Mock(return_value=store)
         self.manager.update_minute("SH000001", data)
-        self.manager.get_minutestore_at.assert_called_with(p1['time'])
+        market.get_minutestore_at.assert_called_with(p1['time'])
     
     def test_get_minutestore_force_cache(self):
         store = self.manager.get_minutestore_at(1291341180, memory=True)
@@ -97,6 +203,305 @@ class ManagerTest(unittest.TestCase):
         ret = self.manager.fiveminstore
         self.assertTrue(isinstance(ret, FiveMinute))
 
+    def test_update_days(self):
+        x1 = np.array([
+                (1316448000, 10.0, 11.0, 9.0, 10.5, 1000.0, 10500.0),
+                (1316534400, 10.5, 12.0, 10.0, 11.5, 2000.0, 23000.0)
+                ], dtype=Day.DTYPE)
+        x2 = np.array([
+                (1316534400, 5.0, 5.5, 4.5, 5.2, 3000.0, 15600.0)
+                ], dtype=Day.DTYPE)
+        index, data = pack_arrays([('SH900001', x1), ('SH900002', x2)])
+
+        self.manager.update_days(index, data)
+
+        y1 = self.manager.daystore._get_year_data('SH900001', 2011)
+        np.testing.assert_array_equal(y1, x1)
+        y2 = self.manager.daystore._get_year_data('SH900002', 2011)
+        np.testing.assert_array_equal(y2, x2)
+
+    def test_update_ohlcs(self):
+        ts = 1316482200 # 2011-09-20 09:30
+        x = np.zeros(2, dtype=OneMinute.DTYPE)
+        x['time'] = [ts, ts + 60]
+        x['close'] = [10.0, 10.5]
+        index, data = pack_arrays([('SH900001', x), ('SH900002', x[1:])])
+
+        self.manager.update_ohlcs('1min', index, data)
+
+        date = datetime.fromtimestamp(ts).date()
+        y = self.manager.oneminstore.get('SH900002', date)
+        self.assertEqual(y[y['time'] > 0]['close'].tolist(), [10.5])
+        self.assertRaises(ValueError, self.manager.update_ohlcs, '2min',
+                          index, data)
+
+    def test_get_panel(self):
+        x1 = np.array([
+                (1316448000, 10.0, 11.0, 9.0, 10.5, 1000.0, 10500.0),
+                (1316534400, 10.5, 12.0, 10.0, 11.5, 2000.0, 23000.0)
+                ], dtype=Day.DTYPE)
+        x2 = np.array([
+                (1316534400, 5.0, 5.5, 4.5, 5.2, 3000.0, 15600.0)
+                ], dtype=Day.DTYPE)
+        self.manager.update_day('SH900011', x1)
+        self.manager.update_day('SH900012', x2)
+
+        symbols = ['SH900011', 'SH900012', 'SH987654']
+        start = datetime.fromtimestamp(1316448000).date()
+        end = datetime.fromtimestamp(1316534400).date()
+        index, values = self.manager.get_panel(symbols, 'close', (start, end))
+
+        np.testing.assert_array_equal(index, x1['time'])
+        self.assertEqual(values.shape, (2, 3))
+        np.testing.assert_array_equal(values[:, 0], x1['close'])
+        self.assertTrue(np.isnan(values[0, 1]))
+        self.assertAlmostEqual(values[1, 1], 5.2, 5)
+        self.assertTrue(np.isnan(values[:, 2]).all())
+
+    def test_get_panel_wrong_field(self):
+        self.assertRaises(ValueError, self.manager.get_panel,
+                          ['SH000001'], 'time', 10)
+
+    def test_get_panel_suspended_day(self):
+        # 2011-09-20 and 2011-09-22, both suspended on 09-21
+        x = np.array([
+                (1316448000, 10.0, 11.0, 9.0, 10.5, 1000.0, 10500.0),
+                (1316620800, 10.5, 12.0, 10.0, 11.5, 2000.0, 23000.0)
+                ], dtype=Day.DTYPE)
+        self.manager.update_day('SH900013', x)
+        self.manager.update_day('SH900014', x[1:])
+
+        symbols = ['SH900013', 'SH900014']
+        start = datetime.fromtimestamp(1316448000).date()
+        end = datetime.fromtimestamp(1316620800).date()
+        index, values = self.manager.get_panel(symbols, 'close', (start, end))
+        self.assertEqual(index.tolist(), [1316448000, 1316534400, 1316620800])
+        self.assertTrue(np.isnan(values[1]).all())
+        self.assertAlmostEqual(values[2, 1], 11.5, 5)
+
+        # 2011-09-24/25 weekend skipped
+        end = datetime.fromtimestamp(1316620800 + 4 * 86400).date()
+        index, values = self.manager.get_panel(symbols, 'close', (start, end))
+        self.assertEqual(len(index), 5)
+
+    def test_get_panel_length_trading_days(self):
+        # tuesday, wednesday and thursday of last week, suspended on wednesday
+        today = datetime.today().date()
+        wednesday = today - timedelta(days=today.weekday() + 5)
+        times = [int(time.mktime((d.year, d.month, d.day, 0, 0, 0, 0, 0, -1)))
+                 for d in (wednesday - timedelta(days=1), wednesday,
+                           wednesday + timedelta(days=1))]
+        x = np.zeros(2, dtype=Day.DTYPE)
+        x['time'] = (times[0], times[2])
+        x['close'] = (10.0, 11.0)
+        self.manager.update_day('SH900016', x)
+
+        # counted by trading days, not rows
+        index, values = self.manager.get_panel(['SH900016'], 'close', 2)
+        self.assertEqual(index.tolist(), times[1:])
+        self.assertTrue(np.isnan(values[0, 0]))
+        self.assertEqual(values[1, 0], 11.0)
+
+    def test_get_panel_intraday(self):
+        ts = 1316482260 # 2011-09-20 09:31
+        x = np.zeros(1, dtype=OneMinute.DTYPE)
+        x['time'] = ts
+        x['close'] = 10.0
+        self.manager.oneminstore.update('SH900015', x)
+
+        date = datetime.fromtimestamp(ts).date()
+        index, values = self.manager.get_panel(['SH900015'], 'close',
+                                               (date, date), '1min')
+        # bars labelled by end time, 09:31 ... 11:30, 13:01 ... 15:00
+        self.assertEqual(len(index), 240)
+        self.assertEqual(index[0], ts)
+        self.assertEqual(values[0, 0], 10.0)
+        self.assertTrue(np.isnan(values[1, 0]))
+
+        index, values = self.manager.get_panel(['SH900015'], 'close',
+                                               (date, date), '5min')
+        self.assertEqual(len(index), 48)
+
+    def test_get_panel_resampled(self):
+        from datafeed.resample import resample
+
+        data = np.load(os.path.join(os.path.dirname(__file__), 'minute.npy'))
+        date = datetime.fromtimestamp(data[0]['time']).date()
+        symbols = ['SH900013', 'SH900014']
+        for interval, store in ((1, self.manager.oneminstore),
+                                (5, self.manager.fiveminstore)):
+            bars = resample(data, self.manager.exchange, interval)
+            for symbol in symbols:
+                store.update_date(symbol, date, bars)
+
+            index, values = self.manager.get_panel(symbols, 'close',
+                                                   (date, date),
+                                                   '%dmin' % interval)
+            self.assertEqual(len(index), len(bars))
+            self.assertFalse(np.isnan(values).all(axis=1).any())
+
+    def test_get_panel_wrong_arguments(self):
+        self.assertRaises(ValueError, self.manager.get_panel,
+                          ['SH000001'], 'close', 0)
+        self.assertRaises(ValueError, self.manager.get_panel,
+                          [], 'close', 10)
+
+    def test_get_bar(self):
+        ts = int(time.time())
+        report = {'timestamp': ts, 'price': 10.0,
+                  'volume': 100.0, 'amount': 1000.0}
+        self.manager.update_reports({'TS000004': report})
+
+        y = self.manager.get_bar('TS000004', '5min')
+        self.assertEqual(y[-1]['close'], 10.0)
+        self.assertRaises(ValueError, self.manager.get_bar, 'TS000004', '2min')
+        self.assertRaises(KeyError, self.manager.get_bar, 'TS000005')
+
+    def test_update_minutes(self):
+        x = helper.sample_minutes()
+        index, data = pack_arrays([('SH900001', x), ('SH900002', x[:10])])
+
+        self.manager.update_minutes(index, data)
+
+        store = self.manager.get_minutestore_at(x[0]['time'])
+        np.testing.assert_array_equal(store.get('SH900001'), x)
+        np.testing.assert_array_equal(store.get('SH900002')[:10], x[:10])
+
+
+class AdjustFactorTest(unittest.TestCase):
+    dtype = [('time', '<i4'),
+             ('split', '<f4'),
+             ('purchase', '<f4'),
+             ('purchase_price', '<f4'),
+             ('dividend', '<f4')]
+
+    def setUp(self):
+        self.manager = Manager(helper.datadir, SH())
+        self.day = np.array([
+                (1316448000, 10.0, 11.0, 9.0, 10.0, 1000.0, 10000.0),
+                (1316534400, 6.0, 6.0, 5.0, 5.5, 2000.0, 11000.0)
+                ], dtype=Day.DTYPE)
+        # 2011-09-21, 10 for 10 split and 0.5 cash dividend
+        self.divs = np.array([(1316534400, 1.0, 0.0, 0.0, 0.5)],
+                             dtype=self.dtype)
+
+    def test_update_dividend(self):
+        self.manager.update_dividend('SH900041', self.divs)
+        factors = self.manager.factorstore['SH900041']
+        self.assertEqual(len(factors), 1)
+        self.assertEqual(factors[0]['a'], 0.5)
+        self.assertEqual(factors[0]['b'], -0.25)
+
+        y = self.manager.adjust_day('SH900041', self.day)
+        self.assertAlmostEqual(y[0]['close'], 4.75, 5)
+        self.assertEqual(y[1]['close'], 5.5)
+
+        y = self.manager.adjust_day('SH900041', self.day, 'backward')
+        self.assertEqual(y[0]['close'], 10.0)
+        self.assertAlmostEqual(y[1]['close'], 11.5, 5)
+
+        self.assertRaises(ValueError, self.manager.adjust_day,
+                          'SH900041', self.day, 'sideways')
+
+    def test_adjust_day_without_dividends(self):
+        y = self.manager.adjust_day('SH900042', self.day)
+        np.testing.assert_array_equal(y, self.day)
+
+    def test_replace_dividends(self):
+        divstore = self.manager.divstore
+        divstore.replace({'SH900043': self.divs, 'SH900044': self.divs})
+        factorstore = self.manager.factorstore
+        self.assertTrue(factorstore.has_key('SH900044'))
+
+        divs = self.divs.copy()
+        divs['dividend'] = 1.0
+        with patch('datafeed.datastore.compose_many') as compose:
+            compose.return_value = {}
+            divstore.replace({'SH900043': self.divs, 'SH900045': divs})
+            # only new or changed symbols recomputed
+            compose.assert_called_once_with({'SH900045': divs})
+        self.assertFalse(factorstore.has_key('SH900044'))
+
+
+class MultiMarketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = Manager(helper.datadir, [SH(), HK()])
+        self.sh, self.hk = self.manager.markets
+
+    def test_get_market(self):
+        self.assertTrue(self.manager.get_market('SH000001') is self.sh)
+        self.assertTrue(self.manager.get_market('SZ000001') is self.sh)
+        self.assertTrue(self.manager.get_market('HK00001') is self.hk)
+        self.assertTrue(self.manager.get_market('HK') is self.hk)
+
+    def test_stores_sized_by_market(self):
+        self.hk.set_mtime(int(time.time()))
+        self.assertEqual(self.sh.oneminstore.shape_x, 242)
+        self.assertEqual(self.hk.oneminstore.shape_x, 272)
+        self.assertEqual(self.hk.fiveminstore.shape_x, 54)
+        self.assertEqual(self.hk.minutestore.shape_x, 272)
+
+    def test_update_reports(self):
+        ts = int(time.time())
+        report = {'timestamp': ts, 'price': 10.0,
+                  'volume': 100.0, 'amount': 1000.0}
+        self.manager.update_reports({'HK00011': report})
+
+        self.assertEqual(self.hk.mtime, ts)
+        self.assertEqual(self.sh.mtime, None)
+        self.assertEqual(self.manager.mtime, ts)
+        self.assertEqual(self.manager.get_bar('HK00011')[-1]['close'], 10.0)
+        self.assertRaises(KeyError, self.sh.bars['1min'].get, 'HK00011')
+
+        reports = dict(self.manager.get_market_reports(self.hk))
+        self.assertEqual(reports.keys(), ['HK00011'])
+
+    def test_update_report_rows(self):
+        ts = int(time.time())
+        rows = np.zeros(2, dtype=REPORT_DELTA_DTYPE)
+        rows['timestamp'] = ts
+        rows['price'] = (10.0, 20.0)
+        rows['volume'] = 100.0
+        self.manager.update_report_rows(['HK00012', 'SH900012'],
+                                        [u'A', u'B'], rows)
+
+        self.assertEqual(self.hk.mtime, ts)
+        self.assertEqual(self.sh.mtime, ts)
+        report = self.manager.get_report('SH900012')
+        self.assertEqual(report['name'], u'B')
+        self.assertEqual(report['close'], 20.0)
+        self.assertEqual(report['timestamp'], ts)
+        self.assertEqual(self.manager.get_bar('HK00012')[-1]['close'], 10.0)
+        self.assertRaises(KeyError, self.sh.bars['1min'].get, 'HK00012')
+
+    def test_rotate_market(self):
+        ts = int(time.time())
+        x = helper.sample_minutes()
+        self.sh.set_mtime(ts)
+        self.hk.set_mtime(ts)
+        self.sh.minutestore.update('SH900021', x)
+        self.hk.minutestore.update('HK00021', x)
+
+        # HK crossed a day, SH not
+        self.hk.set_mtime(ts + 86400)
+        self.manager.rotate_minute_store()
+        self.assertTrue(self.hk.rotating)
+        self.assertFalse(self.sh.rotating)
+        self.assertEqual(self.manager.rotation_progress()[0]['market'], 'HK')
+
+        while self.manager.rotate_step():
+            pass
+
+        date = datetime.fromtimestamp(ts).date()
+        dstore = self.manager._dstore
+        self.assertFalse(date in MinuteSnapshotCache.cached_dates(dstore, 'HK'))
+        self.assertTrue(date in MinuteSnapshotCache.cached_dates(dstore))
+        np.testing.assert_array_equal(self.sh.minutestore.get('SH900021'), x)
+
+        store = self.hk.get_minutestore_at(ts, memory=False)
+        self.assertEqual(len(store.get('HK00021')), 272)
+
 
 class DictStoreTest(unittest.TestCase):
 
@@ -118,6 +523,38 @@ class DictStoreTest(unittest.TestCase):
         r1 = ds['r1']
         self.assertTrue(r1, 'v1')
 
+    def test_flush_stats(self):
+        filename = '%s/dstore_flush.dump' % helper.datadir
+
+        ds = DictStore(filename, {'r1': 'v1'})
+        ds.flush()
+
+        stats = ds.stats()
+        self.assertEqual(stats['saves'], 1)
+        self.assertEqual(stats['last_status'], 'ok')
+        self.assertEqual(stats['last_size'], os.path.getsize(filename))
+        self.assertFalse(os.path.exists('%s.%d.tmp' % (filename, os.getpid())))
+
+    def test_bgsave(self):
+        filename = '%s/dstore_bgsave.dump' % helper.datadir
+
+        ds = DictStore(filename, {'r1': 'v1'})
+        pid = ds.bgsave()
+        self.assertTrue(pid > 0)
+        self.assertTrue(ds.bgsave_in_progress)
+
+        # parent keeps serving, changes not in snapshot
+        ds['r2'] = 'v2'
+        self.assertEqual(ds.bgsave(), None)
+
+        self.assertFalse(ds.bgsave_poll(block=True))
+        self.assertFalse(ds.bgsave_in_progress)
+        self.assertEqual(ds.stats()['last_status'], 'ok')
+
+        ds = DictStore.open(filename)
+        self.assertEqual(ds['r1'], 'v1')
+        self.assertFalse(ds.has_key('r2'))
+
 
 class DictStoreNamespaceTest(unittest.TestCase):
 
@@ -136,6 +573,14 @@ class DictStoreNamespaceTest(unittest.TestCase):
         self.impl['k12'] = 'v21'
         self.assertEqual(self.impl['k12'], 'v21')
 
+    def test_replace(self):
+        self.impl['k1'] = 'v1'
+        self.impl.replace({'k2': 'v2'})
+
+        self.assertFalse(self.impl.has_key('k1'))
+        self.assertEqual(self.impl['k2'], 'v2')
+        self.assertEqual(self.store['impl'], {'k2': 'v2'})
+
     def test_set_and_get_item2(self):
         self.impl['k12'] = 'v21'
         self.assertEqual(self.impl.get('k12'), 'v21')
@@ -333,9 +778,12 @@ class FiveMinuteTest(unittest.TestCase):
         y1 = store.get(key, date)
         np.testing.assert_array_equal(y1[196], data[0])
 
+        # 03:35 missing, rows after the hole keep their time slot
         date = datetime.fromtimestamp(data[-1]['time']).date()
         y2 = store.get(key, date)
-        np.testing.assert_array_equal(y2[206], data[-1])
+        self.assertEqual(y2[43]['time'], 0)
+        np.testing.assert_array_equal(y2[44], data[92 + 43])
+        np.testing.assert_array_equal(y2[207], data[-1])
 
     def test_update_multi_hold_data(self):
         market_minutes = 1440 # 5min data
@@ -405,7 +853,7 @@ class MinuteSnapshotCacheTest(unittest.TestCase):
         self.mstore[symbol] = x
 
         dbm = Manager(helper.datadir, SH())
-        tostore = dbm._minutestore_at(self.date, memory=False)
+        tostore = dbm.markets[0]._minutestore_at(self.date, memory=False)
 
         # rewrite
         self.mstore.rotate(tostore)
@@ -423,6 +871,18 @@ class MinuteSnapshotCacheTest(unittest.TestCase):
         # testing reopen data
         self.assertRaises(KeyError, mstore.get, symbol)
 
+    def test_cached_by_date(self):
+        x = helper.sample_minutes()
+
+        symbol = 'TS123456'
+        self.mstore[symbol] = x
+
+        yesterday = self.date - timedelta(days=1)
+        mstore = MinuteSnapshotCache(self.store, yesterday)
+        self.assertRaises(KeyError, mstore.get, symbol)
+        self.assertEqual(MinuteSnapshotCache.cached_dates(self.store),
+                         [yesterday, self.date])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -6,23 +6,109 @@ import datetime
 import numpy as np
 import time
 
-from pandas import DataFrame, lib
-from pandas import TimeSeries
+try:
+    import pandas
+    from pandas import DataFrame
+except ImportError:
+    pandas = None
 
 from datafeed.datastore import Day
-from datafeed.dividend import Dividend, adjust
+from datafeed.dividend import *
+from datafeed.utils import pack_arrays
 
 
 def date2unixtime(date):
     return int(time.mktime(date.timetuple()))
 
 
+DIVIDEND_DTYPE = [('time', '<i4'),
+                  ('split', '<f4'),
+                  ('purchase', '<f4'),
+                  ('purchase_price', '<f4'),
+                  ('dividend', '<f4')]
+
+
+class AdjustTest(unittest.TestCase):
+    dtype = DIVIDEND_DTYPE
+
+    def setUp(self):
+        self.ohlcs = np.array([
+                (date2unixtime(datetime.date(2003, 2, 13)),
+                 46.99, 46.99, 46.99, 46.99, 675114.0, 758148608.0),
+                (date2unixtime(datetime.date(2003, 2, 14)),
+                 48.30, 48.30, 48.30, 48.30, 675114.0, 758148608.0),
+                (date2unixtime(datetime.date(2003, 2, 18)),
+                 24.96, 24.96, 24.96, 24.96, 675114.0, 758148608.0),
+                (date2unixtime(datetime.date(2003, 2, 19)),
+                 24.53, 24.53, 24.53, 24.53, 675114.0, 758148608.0),
+                ], dtype=Day.DTYPE)
+
+        # ex-dividend time at 08:00, ex date still counts from midnight
+        self.dividends = np.array([
+                (date2unixtime(datetime.date(2003, 2, 18)) + 8 * 3600,
+                 1.0, 0.0, 0.0, 0.0), # Split 2:1
+                (date2unixtime(datetime.date(2003, 2, 19)),
+                 0.0, 0.0, 0.0, 0.08), # 0.08 cash dividend
+                ], dtype=self.dtype)
+
+    def test_adjust_factors(self):
+        factors = adjust_factors(self.ohlcs['time'], self.ohlcs['close'],
+                                 self.dividends)
+        adjclose = self.ohlcs['close'] * factors
+        np.testing.assert_almost_equal(adjclose, [23.415, 24.07, 24.88, 24.53], 4)
+
+    def test_adjust_quotes(self):
+        y = adjust_quotes(self.ohlcs, self.dividends)
+        self.assertAlmostEqual(y[0]['open'], 23.415, 4)
+        self.assertAlmostEqual(y[0]['volume'], 675114.0 * 46.99 / 23.415, -1)
+        self.assertEqual(y[0]['amount'], self.ohlcs[0]['amount'])
+        self.assertEqual(y[-1]['close'], self.ohlcs[-1]['close'])
+
+    def test_adjust_purchase_and_unordered(self):
+        y = np.array([
+                (1216915200, 24.89, 25.45, 24.71, 25.0, 486284.0, 1216462208.0)
+                ], dtype=Day.DTYPE)
+        dividends = np.array([
+                (1307664000, 0.0, 0.0, 0.0, 0.29),
+                (1268611200, 0.0, 0.13, 8.85, 0.0),
+                (1246579200, 0.3, 0.0, 0.0, 0.1),
+                (1217203200, 0.0, 0.0, 0.0, 0.28),
+                (1116000000, 0.0, 0.0, 0.0, 0.0), # empty record
+                ], dtype=self.dtype)
+
+        y = adjust_quotes(y, dividends)
+        expected = ((25.0 - 0.28 - 0.1) / 1.3 + 0.13 * 8.85) / 1.13 - 0.29
+        self.assertAlmostEqual(y[0]['close'], expected, 4)
+
+    def test_not_mature(self):
+        today = date2unixtime(datetime.date(2003, 2, 18))
+        factors = adjust_factors(self.ohlcs['time'], self.ohlcs['close'],
+                                 self.dividends, today=today)
+        np.testing.assert_almost_equal(factors[:2], [0.5, 0.5])
+        np.testing.assert_almost_equal(factors[2:], [1.0, 1.0])
+
+    def test_no_dividends(self):
+        y = adjust_quotes(self.ohlcs, np.zeros(0, dtype=self.dtype))
+        np.testing.assert_array_equal(y, self.ohlcs)
+
+    def test_adjust_many(self):
+        index, data = pack_arrays([('SH600001', self.ohlcs),
+                                   ('SH600002', self.ohlcs[:2]),
+                                   ('SH600003', self.ohlcs)])
+        dividends = {'SH600001': self.dividends,
+                     'SH600002': self.dividends[1:]}
+
+        y = adjust_many(index, data, dividends)
+        np.testing.assert_array_equal(y[:4],
+                                      adjust_quotes(self.ohlcs, self.dividends))
+        np.testing.assert_array_equal(y[4:6],
+                                      adjust_quotes(self.ohlcs[:2], self.dividends[1:]))
+        np.testing.assert_array_equal(y[6:], self.ohlcs)
+
+
+@unittest.skipUnless(pandas, "pandas not installed")
 class DividendTest(unittest.TestCase):
-    dtype = [('time', '<i4'),
-             ('split', '<f4'),
-             ('purchase', '<f4'),
-             ('purchase_price', '<f4'),
-             ('dividend', '<f4')]
+    dtype = DIVIDEND_DTYPE
 
     def floatEqual(self, x, y):
         if (x - y) < 0.05:
@@ -1,7 +1,11 @@
 from __future__ import with_statement
 
+import os
+import time
 import unittest
 
+import numpy as np
+
 from datetime import datetime
 from datafeed.exchange import *
 
@@ -56,6 +60,87 @@ class ExchangeTest(unittest.TestCase):
         self.assertEqual(ret.hour, 15)
         self.assertEqual(ret.minute, 0)
 
+    def test_trading_sessions(self):
+        sessions = SH.trading_sessions(now=1291341180)
+        self.assertEqual(sessions, [(1291339800, 1291347000),
+                                    (1291352400, 1291359600)])
+
+    def test_trading_sessions_without_break(self):
+        sessions = NYSE.trading_sessions(now=1291341180)
+        self.assertEqual(len(sessions), 1)
+
+
+class SessionCalendarTest(unittest.TestCase):
+
+    def setUp(self):
+        self.calendar = SH.calendar()
+        self.open_time = 1291339800 # 2010-12-03 09:30
+
+    def test_market_minutes(self):
+        self.assertEqual(self.calendar.market_minutes, SH.market_minutes)
+
+    def test_minute_index(self):
+        ts = self.open_time + np.array([-60, 0, 59, 60, 7200, 7260,
+                                        12600, 12660, 19800, 30000])
+        y = self.calendar.minute_index(ts)
+        np.testing.assert_array_equal(y, [-1, 0, 0, 1, 120, 120,
+                                          121, 122, 241, 241])
+
+    def test_minute_index_scalar(self):
+        self.assertEqual(self.calendar.minute_index(self.open_time + 120), 2)
+
+    def test_day_ids(self):
+        ts = [self.open_time, self.open_time + 86400, self.open_time - 86400 * 400]
+        y = self.calendar.day_ids(ts)
+        self.assertEqual(y[0], datetime.fromtimestamp(ts[0]).toordinal())
+        self.assertEqual(y[1] - y[0], 1)
+        self.assertEqual(y[0] - y[2], 400)
+
+    def test_minute_times(self):
+        y = self.calendar.minute_times(self.open_time)
+        self.assertEqual(len(y), 242)
+        self.assertEqual(y[0], self.open_time)
+        self.assertEqual(y[121], self.open_time + 12600)
+
+    def test_change_time(self):
+        self.assertEqual(SH.open_time(now=self.open_time + 3600), self.open_time)
+        self.assertEqual(SH.close_time(now=self.open_time - 3600),
+                         self.open_time + 19800)
+
+
+class SessionCalendarDSTTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/New_York'
+        time.tzset()
+        self.calendar = SessionCalendar((((9, 30), (16, 0)), ))
+
+    def tearDown(self):
+        if self._tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self._tz
+        time.tzset()
+
+    def _ts(self, *args):
+        return int(time.mktime(args + (0, 0, 0, -1)))
+
+    def test_minute_index_fall_back(self):
+        # 2011-11-06 is 25 hours long
+        ts = [self._ts(2011, 11, 6, 10, 0), self._ts(2011, 11, 6, 23, 30)]
+        y = self.calendar.minute_index(ts)
+        np.testing.assert_array_equal(y, [30, 390])
+
+        y = self.calendar.time_index(ts)
+        np.testing.assert_array_equal(y, [600, 1410])
+
+    def test_minute_index_spring_forward(self):
+        # 2011-03-13 is 23 hours long
+        ts = self._ts(2011, 3, 13, 10, 0)
+        self.assertEqual(self.calendar.minute_index(ts), 30)
+        self.assertEqual(self.calendar.time_index(ts, 300), 120)
+
 
 if __name__ == '__main__':
     unittest.main()
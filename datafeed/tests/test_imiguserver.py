@@ -5,19 +5,20 @@ import re
 import time
 import unittest
 
-from datafeed.exchange import SH
+from datafeed.exchange import HK, SH
 from datafeed.imiguserver import ImiguApplication, ImiguHandler, SnapshotIndexError
 from datafeed.server import Request
 from datafeed.tests import helper
 
 from mock import Mock, patch
+from tornado import ioloop
 
 
 class ImiguApplicationTest(unittest.TestCase):
 
     def setUp(self):
         self.application = ImiguApplication(helper.datadir, SH())
-        self.application.dbm._mtime = 1291167000
+        self.application.dbm.markets[0]._mtime = 1291167000
         self.open_time = 1291167000
         self.close_time = 1291186800
 
@@ -39,7 +40,7 @@ class ImiguApplicationTest(unittest.TestCase):
     def test_archive_day_15_05_no_data(self, mock_time):
         mock_time.return_value = self.close_time + 300
         
-        self.application.dbm._mtime = self.close_time - 86400
+        self.application.dbm.markets[0]._mtime = self.close_time - 86400
 
         today = datetime.datetime.today()
         ret = self.application.scheduled_archive_day(today)
@@ -49,7 +50,7 @@ class ImiguApplicationTest(unittest.TestCase):
     def test_archive_day_15_05_01(self, mock_time):
         mock_time.return_value = self.close_time + 181 # closed more than 3 minutes
 
-        self.application.dbm._mtime = self.close_time + 180 + 1
+        self.application.dbm.markets[0]._mtime = self.close_time + 180 + 1
 
         today = datetime.datetime.today()
         ret = self.application.scheduled_archive_day(today)
@@ -158,6 +159,77 @@ class ImiguApplicationTest(unittest.TestCase):
         ret = self.application.scheduled_crontab_daily(today)
         self.assertFalse(ret)
 
+    def test_next_archive_minute_time_before_open(self):
+        ts = self.application.next_archive_minute_time(self.open_time - 3600)
+        self.assertEqual(ts, self.open_time)
+
+    def test_next_archive_minute_time_in_session(self):
+        ts = self.application.next_archive_minute_time(self.open_time + 90)
+        self.assertEqual(ts, self.open_time + 120)
+
+    def test_next_archive_minute_time_closed(self):
+        ts = self.application.next_archive_minute_time(self.close_time + 300)
+        self.assertEqual(ts, self.open_time + 86400)
+
+    def test_next_archive_day_time(self):
+        ts = self.application.next_archive_day_time(self.open_time)
+        self.assertEqual(ts, self.close_time + 181)
+
+    def test_next_archive_day_time_recheck_if_not_archived(self):
+        now = self.close_time + 600
+        ts = self.application.next_archive_day_time(now)
+        self.assertEqual(ts, now + 60)
+
+    def test_next_archive_day_time_archived(self):
+        self.application.archive_day_time = self.close_time + 181
+        ts = self.application.next_archive_day_time(self.close_time + 600)
+        self.assertEqual(ts, self.close_time + 86400 + 181)
+
+    def test_next_crontab_daily_time(self):
+        crontab_time = self.open_time - 3600 - 1800
+        ts = self.application.next_crontab_daily_time(self.open_time)
+        self.assertEqual(ts, crontab_time + 86400)
+
+    def test_next_bgsave_check_time(self):
+        now = self.open_time
+        self.assertEqual(self.application.next_bgsave_check_time(now), None)
+
+        self.application.bgsave()
+        self.assertEqual(self.application.next_bgsave_check_time(now), now + 1)
+
+        self.application.dbm._dstore.bgsave_poll(block=True)
+        self.assertEqual(self.application.next_bgsave_check_time(now), None)
+
+    def test_sync(self):
+        io_loop = ioloop.IOLoop()
+        self.application.io_loop = io_loop
+
+        io = Mock()
+        io.fetch_async.side_effect = lambda callback, io_loop: callback(None)
+        io.read.return_value = iter([('SZ000001', 1), ('SZ000002', 2)])
+        store = Mock()
+
+        ret = self.application.sync('test', io, store, callback=io_loop.stop)
+        self.assertTrue(ret)
+        # in progress
+        self.assertFalse(self.application.sync('test', io, store))
+
+        io_loop.add_timeout(time.time() + 5, io_loop.stop)
+        io_loop.start()
+        io_loop.close()
+
+        store.replace.assert_called_once_with({'SZ000001': 1, 'SZ000002': 2})
+        self.assertFalse('test' in self.application._syncing)
+
+    def test_sync_fetch_failed(self):
+        io = Mock()
+        io.fetch_async.side_effect = lambda callback, io_loop: callback(IOError())
+        store = Mock()
+
+        self.application.sync('test', io, store)
+        self.assertFalse(store.replace.called)
+        self.assertFalse('test' in self.application._syncing)
+
     def test_archive_day(self):
         r = {
             'amount': 84596203520.0,
@@ -203,7 +275,7 @@ class ImiguApplicationTest(unittest.TestCase):
         day = datetime.datetime.today()
         ts = time.mktime((day.year, day.month, day.day,
                           15, 30, 0, 0, 0, 0))
-        mock_index.return_value = (ts, 360)
+        mock_index.return_value = (ts, 241)
         
         r = {
             'amount': 84596203520.0,
@@ -300,16 +372,80 @@ class ImiguApplicationTest(unittest.TestCase):
                           self.application,
                           request)
 
+    def test_rotation_in_background(self):
+        dbm = self.application.dbm
+        ts = int(time.time())
+        dbm.set_mtime(ts)
+        dbm.minutestore.update('TS000001', helper.sample_minutes())
+
+        dbm.set_mtime(ts + 86400)
+        dbm.rotate_minute_store()
+        self.application.rotation_add()
+        self.application.rotation_add()
+        self.assertEqual(len(self.application._tasks), 1)
+
+        while self.application._tasks:
+            self.application.task_run()
+        self.assertFalse(dbm.rotating)
+        self.assertEqual(self.application._rotation_task, None)
+
+    def test_scheduler_jobs_per_exchange(self):
+        application = ImiguApplication(helper.datadir, [SH(), HK()])
+        io_loop = ioloop.IOLoop()
+        scheduler = application.start_scheduler(io_loop=io_loop)
+        scheduler.stop()
+        io_loop.close()
+
+        for name in ('archive_minute:SH', 'archive_day:SH',
+                     'archive_minute:HK', 'archive_day:HK'):
+            self.assertTrue(scheduler.get_job(name))
+
+        hk_open = HK.open_time(now=self.open_time)
+        ts = application.next_archive_minute_time(self.open_time,
+                                                  exchange=HK())
+        self.assertEqual(ts, hk_open)
+
+    @patch.object(ImiguHandler, 'get_snapshot_index')
+    def test_archive_minute_per_exchange(self, mock_index):
+        application = ImiguApplication(helper.datadir, [SH(), HK()])
+        dbm = application.dbm
+        day = datetime.datetime.today()
+        ts = time.mktime((day.year, day.month, day.day,
+                          10, 10, 0, 0, 0, 0))
+        mock_index.return_value = (ts, 10)
+
+        r = {'price': 10.0, 'volume': 100.0, 'amount': 1000.0,
+             'timestamp': ts}
+        dbm.update_reports({'HK00031': dict(r), 'SH900031': dict(r)})
+
+        request = Request(None, 'archive_minute', 'HK')
+        application(request)
+
+        hk, sh = dbm.get_market('HK'), dbm.get_market('SH')
+        self.assertEqual(hk.minutestore.get('HK00031')[10]['price'], 10.0)
+        self.assertFalse(hk.minutestore.has_key('SH900031'))
+        self.assertTrue('HK' in application.archive_minute_times)
+        self.assertFalse('SH' in application.archive_minute_times)
+
     @patch.object(time, 'time')
     def test_get_snapshot_index(self, mock_time):
         mock_time.return_value = 1309829400
         report_time = 1309829160
 
-        mintime, index = ImiguHandler.get_snapshot_index(1309829400, report_time)
+        mintime, index = ImiguHandler.get_snapshot_index(SH.calendar(), report_time)
 
         self.assertEqual(mintime, 1309829400)
         self.assertEqual(index, 0)
 
+    @patch.object(time, 'time')
+    def test_get_snapshot_index_in_break(self, mock_time):
+        mock_time.return_value = 1309829400 + 3 * 3600 + 5 # 12:30:05
+
+        mintime, index = ImiguHandler.get_snapshot_index(SH.calendar(), 0)
+
+        self.assertEqual(mintime, 1309829400 + 3 * 3600)
+        self.assertEqual(index, 120)
+
 
 if __name__ == '__main__':
     unittest.main()
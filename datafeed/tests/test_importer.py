@@ -0,0 +1,115 @@
+from __future__ import with_statement
+
+import datetime
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from mock import Mock
+
+from datafeed.datastore import Manager
+from datafeed.exchange import SH
+from datafeed.importer import *
+from datafeed.providers.dzh import DzhDay
+from datafeed.tests import helper
+from datafeed.utils import unpack_arrays
+
+
+def write_day_file(symbols, rows=3):
+    '''DZH day file of symbols, one block each.'''
+    io = DzhDay()
+    per_block = io._BLOCK_SIZE // 32
+
+    index = np.zeros(len(symbols), dtype=io.INDEX_DTYPE)
+    index['symbol'] = symbols
+    index['count'] = rows
+    index['blocks'] = -1
+    index['blocks'][:, 0] = np.arange(len(symbols))
+
+    area = np.zeros((len(symbols), per_block), dtype=io.RECORD_DTYPE)
+    area['time'][:, :rows] = 1316448000 + np.arange(rows) * 86400
+    area['close'][:, :rows] = np.arange(len(symbols))[:, np.newaxis] + 1
+
+    data = '\x00' * io._INDEX_START + index.tostring()
+    data = data.ljust(io._BLOCK_START, '\x00') + area.tostring()
+
+    fd, filename = tempfile.mkstemp(dir=helper.datadir)
+    os.write(fd, data)
+    os.close(fd)
+    return filename
+
+
+class DzhImporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.symbols = ['8%05d' % i for i in xrange(5)]
+        self.filename = write_day_file(self.symbols)
+        self.manager = Manager(helper.datadir, SH())
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_run(self):
+        importer = DzhImporter(StoreWriter(self.manager), processes=2,
+                               chunksize=2)
+        stats = importer.run(self.filename, 'day', 'SH')
+
+        self.assertEqual(stats['symbols'], 5)
+        self.assertEqual(stats['rows'], 15)
+        self.assertTrue(stats['rows_per_second'] > 0)
+
+        y = self.manager.daystore.get_range('SH800004',
+                                            datetime.date(2011, 9, 20),
+                                            datetime.date(2011, 9, 22))
+        self.assertEqual(y['close'].tolist(), [5.0, 5.0, 5.0])
+
+    def test_resume(self):
+        fd, journal = tempfile.mkstemp(dir=helper.datadir)
+        os.close(fd)
+
+        writer = Mock()
+        importer = DzhImporter(writer, processes=1, chunksize=2,
+                               journal=Journal(journal))
+        importer.run(self.filename, 'day', 'SH')
+        self.assertEqual(writer.write.call_count, 3)
+
+        # every shard done, even with other chunksize
+        writer = Mock()
+        importer = DzhImporter(writer, processes=1, chunksize=3,
+                               journal=Journal(journal))
+        stats = importer.run(self.filename, 'day', 'SH')
+        self.assertEqual(writer.write.call_count, 0)
+        self.assertEqual(stats['skipped'], 5)
+        os.remove(journal)
+
+    def test_resume_partial(self):
+        fd, journal = tempfile.mkstemp(dir=helper.datadir)
+        os.close(fd)
+        key = ':'.join(['day', os.path.abspath(self.filename), 'SH', '1', '3'])
+        Journal(journal).add(key)
+
+        writer = Mock()
+        importer = DzhImporter(writer, processes=1, chunksize=10,
+                               journal=Journal(journal))
+        stats = importer.run(self.filename, 'day', 'SH')
+        written = [list(call[0][1]['symbol']) \
+                       for call in writer.write.call_args_list]
+        self.assertEqual(written, [['SH800000'], ['SH800003', 'SH800004']])
+        self.assertEqual(stats['skipped'], 2)
+        os.remove(journal)
+
+    def test_client_writer(self):
+        client = Mock()
+        importer = DzhImporter(ClientWriter(client), processes=1)
+        importer.run(self.filename, 'day', 'SH')
+
+        command, index, data = client._put_packed.call_args[0]
+        self.assertEqual(command, 'PUT_DAYS')
+        self.assertEqual([symbol for symbol, _ in unpack_arrays(index, data)],
+                         ['SH' + s for s in self.symbols])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from __future__ import with_statement
+
+import unittest
+
+from mock import Mock
+from tornado import web
+from tornado.testing import AsyncHTTPTestCase
+
+from datafeed.exchange import SH
+from datafeed.ingest import *
+from datafeed.providers.sina import SinaReportFetcher, SinaSecurity
+
+
+_LINE = 'var hq_str_%s="%s,8.64,8.64,%s,8.71,8.58,8.68,8.69,%s,240634267,' \
+    '11289,8.68,759700,8.67,556338,8.66,455296,8.65,56600,8.64,143671,8.69,' \
+    '341859,8.70,361255,8.71,314051,8.72,342155,8.73,2011-05-03,15:03:11";'
+
+
+class SinaStubHandler(web.RequestHandler):
+    # sina id -> (price, volume)
+    quotes = {}
+
+    def get(self, ids):
+        lines = [_LINE % (i, '中国石化'.decode('utf-8').encode('gbk'),
+                          self.quotes[i][0], self.quotes[i][1]) \
+                     for i in str(ids).split(',')]
+        self.write('\n'.join(lines))
+
+
+class ReportIngesterTest(AsyncHTTPTestCase):
+
+    def get_app(self):
+        return web.Application([(r'/list=([\w,]+)', SinaStubHandler)])
+
+    def setUp(self):
+        super(ReportIngesterTest, self).setUp()
+        SinaStubHandler.quotes = {'sh600028': (8.68, 27761321),
+                                  'sh600029': (5.12, 1000),
+                                  'sh600030': (0.00, 0)}
+        self.client = Mock()
+        fetcher = SinaReportFetcher(base_url=self.get_url(''), request_size=2,
+                                    io_loop=self.io_loop)
+        securities = [SinaSecurity(SH(), s) \
+                          for s in ('600028', '600029', '600030')]
+        self.ingester = ReportIngester(fetcher, securities, self.client,
+                                       batch_size=1)
+
+    def _poll(self):
+        self.ingester.poll(self.stop)
+        return self.wait()
+
+    def test_poll(self):
+        metrics = self._poll()
+
+        self.assertEqual(metrics['quotes'], 3)
+        # suspended one skipped
+        self.assertEqual(metrics['changed'], 2)
+        self.assertEqual(metrics['batches'], 2)
+        self.assertTrue(metrics['total'] >= metrics['fetch'])
+
+        reports = self.client.put_report_deltas.call_args_list[0][0][0]
+        report = reports['SH600028']
+        self.assertEqual(report['price'], 8.68)
+        self.assertEqual(report['volume'], 27761321)
+        self.assertEqual(report['name'], u'中国石化')
+        self.assertEqual(report['time'], '2011-05-03 15:03:11')
+
+    def test_poll_changed_only(self):
+        self._poll()
+        self.client.reset_mock()
+
+        metrics = self._poll()
+        self.assertEqual(metrics['changed'], 0)
+        self.assertFalse(self.client.put_report_deltas.called)
+
+        SinaStubHandler.quotes['sh600029'] = (5.13, 1200)
+        self._poll()
+        reports = self.client.put_report_deltas.call_args[0][0]
+        self.assertEqual(reports.keys(), ['SH600029'])
+
+    def test_send_failed(self):
+        self.client.put_report_deltas.side_effect = StandardError('down')
+        metrics = self._poll()
+        self.assertEqual(metrics['batches'], 0)
+
+        # resent on next poll
+        self.client.put_report_deltas.side_effect = None
+        metrics = self._poll()
+        self.assertEqual(metrics['changed'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+from __future__ import with_statement
+
+import datetime
+import unittest
+
+import numpy as np
+
+from datafeed.exchange import SH
+from datafeed.resample import BarAggregator, bar_times, resample
+from datafeed.tests import helper
+
+
+class ResampleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = helper.sample_minutes()
+        self.exchange = SH()
+
+    def test_bar_times(self):
+        now = int(self.data['time'][0])
+        times = bar_times(self.exchange, 5, now)
+        self.assertEqual(len(times), 48)
+
+        ts = [datetime.datetime.fromtimestamp(t).strftime('%H:%M') \
+                  for t in times[[0, 23, 24, -1]]]
+        self.assertEqual(ts, ['09:35', '11:30', '13:05', '15:00'])
+
+    def test_bar_times_interval(self):
+        now = int(self.data['time'][0])
+        for interval, count in ((1, 240), (15, 16), (30, 8), (60, 4)):
+            self.assertEqual(len(bar_times(self.exchange, interval, now)), count)
+
+        self.assertRaises(AssertionError, bar_times, self.exchange, 7, now)
+
+    def test_resample_1min(self):
+        x = self.data
+        y = resample(x, self.exchange, 1)
+        self.assertEqual(len(y), 240)
+
+        # opening auction merged to first bar
+        self.assertEqual(y[0]['time'], x[1]['time'])
+        self.assertEqual(y[0]['open'], x[0]['price'])
+        self.assertEqual(y[0]['close'], x[1]['price'])
+        self.assertEqual(y[0]['volume'], x[1]['volume'])
+
+        # 13:00 snapshot opens afternoon session
+        self.assertEqual(y[120]['time'], x[122]['time'])
+        self.assertEqual(y[120]['open'], x[121]['price'])
+        self.assertEqual(y[120]['volume'], x[122]['volume'] - x[120]['volume'])
+
+    def test_resample_5min(self):
+        x = self.data
+        y = resample(x, self.exchange, 5)
+        self.assertEqual(len(y), 48)
+
+        self.assertEqual(y[0]['open'], x[0]['price'])
+        self.assertEqual(y[0]['high'], x['price'][:6].max())
+        self.assertEqual(y[0]['low'], x['price'][:6].min())
+        self.assertEqual(y[0]['close'], x[5]['price'])
+        self.assertEqual(y[-1]['close'], x[-1]['price'])
+        self.assertAlmostEqual(y['volume'].sum() / x[-1]['volume'], 1.0, 6)
+
+    def test_resample_missing_snapshots(self):
+        x = self.data.copy()
+        x[:11] = 0      # no trade before 09:41
+        x[31:41] = 0    # no snapshots 10:01 - 10:10
+
+        y = resample(x, self.exchange, 5)
+        self.assertEqual(len(y), 48)
+
+        # empty bars before first trade
+        self.assertEqual(y[0]['time'], 0)
+        self.assertEqual(y[1]['time'], 0)
+
+        # empty bar carry previous close
+        self.assertEqual(y[6]['open'], y[5]['close'])
+        self.assertEqual(y[6]['close'], y[5]['close'])
+        self.assertEqual(y[6]['volume'], 0)
+        self.assertEqual(y[7]['volume'], 0)
+        self.assertEqual(y[8]['volume'], x[45]['volume'] - x[30]['volume'])
+
+    def test_resample_empty(self):
+        x = np.zeros(242, dtype=self.data.dtype)
+        y = resample(x, self.exchange, 5)
+        self.assertEqual(len(y), 0)
+
+
+class BarAggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.open_time = 1291339800 # 2010-12-03 09:30
+        self.aggregator = BarAggregator(SH(), 1, capacity=2)
+
+    def report(self, offset, price, volume):
+        return {'timestamp': self.open_time + offset,
+                'price': price,
+                'volume': volume,
+                'amount': volume * price}
+
+    def test_forming_bar(self):
+        agg = self.aggregator
+        agg.update({'SH000001': self.report(10, 10.0, 100),
+                    'SH000002': self.report(10, 5.0, 100)})
+        agg.update({'SH000001': self.report(20, 11.0, 150)})
+        agg.update({'SH000001': self.report(30, 9.0, 170)})
+
+        y = agg.get('SH000001', now=self.open_time + 40)
+        self.assertEqual(len(y), 1)
+        self.assertEqual(y[0]['time'], self.open_time + 60)
+        self.assertEqual(tuple(y[0])[1:5], (10.0, 11.0, 9.0, 9.0))
+        self.assertEqual(y[0]['volume'], 170)
+
+        y = agg.get('SH000002', now=self.open_time + 40)
+        self.assertEqual(y[0]['close'], 5.0)
+
+    def test_close_bar_at_minute_boundary(self):
+        agg = self.aggregator
+        agg.update({'SH000001': self.report(10, 10.0, 100)})
+        agg.update({'SH000001': self.report(70, 10.5, 130)})
+
+        y = agg.get('SH000001', now=self.open_time + 80)
+        self.assertEqual(len(y), 2)
+        self.assertEqual(y[0]['time'], self.open_time + 60)
+        self.assertEqual(y[0]['close'], 10.0)
+        self.assertEqual(y[1]['open'], 10.5)
+        self.assertEqual(y[1]['volume'], 30)
+
+        # no reports since
+        y = agg.get('SH000001', now=self.open_time + 130)
+        self.assertEqual(len(y), 1)
+        self.assertEqual(y[0]['time'], self.open_time + 120)
+
+    def test_skip_stale_reports(self):
+        agg = self.aggregator
+        agg.update({'SH000001': self.report(70, 10.0, 100)})
+        agg.update({'SH000001': self.report(10, 9.0, 90),
+                    'SH000002': self.report(-86400, 5.0, 100)})
+
+        y = agg.get('SH000001', now=self.open_time + 80)
+        self.assertEqual(y[-1]['low'], 10.0)
+        self.assertRaises(KeyError, agg.get, 'SH000003')
+        self.assertRaises(KeyError, agg.get, 'SH000002')
+
+    def test_grow(self):
+        reports = dict(('SH%06d' % i, self.report(10, 1.0 + i, 100)) \
+                           for i in xrange(5))
+        self.aggregator.update(reports)
+        self.assertEqual(len(self.aggregator), 5)
+
+        y = self.aggregator.get('SH000004', now=self.open_time + 10)
+        self.assertEqual(y[0]['close'], 5.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
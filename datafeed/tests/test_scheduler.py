@@ -0,0 +1,160 @@
+from __future__ import with_statement
+
+import time
+import unittest
+
+from datafeed.scheduler import Scheduler, TaskQueue
+
+from mock import Mock, patch
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.io_loop = Mock()
+        self.scheduler = Scheduler(io_loop=self.io_loop, tolerance=5)
+        self.callback = Mock()
+        self.every_minute = lambda now: (int(now) // 60 + 1) * 60
+
+    def fire(self, job):
+        '''Fire timeout callback armed for job.'''
+        callback = self.io_loop.add_timeout.call_args[0][1]
+        callback()
+
+    @patch.object(time, 'time')
+    def test_arm_one_timeout_per_job(self, mock_time):
+        mock_time.return_value = 1291167030
+        self.scheduler.add_job('minute', self.callback, self.every_minute)
+        self.scheduler.start()
+
+        self.assertEqual(self.io_loop.add_timeout.call_count, 1)
+        deadline = self.io_loop.add_timeout.call_args[0][0]
+        self.assertEqual(deadline, 1291167060)
+
+    @patch.object(time, 'time')
+    def test_fire_and_rearm(self, mock_time):
+        mock_time.return_value = 1291167030
+        job = self.scheduler.add_job('minute', self.callback, self.every_minute)
+        self.scheduler.start()
+
+        mock_time.return_value = 1291167060
+        self.fire(job)
+
+        self.assertEqual(self.callback.call_count, 1)
+        self.assertEqual(job.runs, 1)
+        self.assertEqual(job.missed, 0)
+        self.assertEqual(job.deadline, 1291167120)
+
+    @patch.object(time, 'time')
+    def test_missed_runs(self, mock_time):
+        mock_time.return_value = 1291167030
+        job = self.scheduler.add_job('minute', self.callback, self.every_minute)
+        self.scheduler.start()
+
+        # fired 3 minutes late
+        mock_time.return_value = 1291167060 + 180
+        self.fire(job)
+
+        self.assertEqual(job.missed, 1 + 2)
+        self.assertEqual(job.deadline, 1291167300)
+
+    @patch.object(time, 'time')
+    def test_job_error_recorded(self, mock_time):
+        mock_time.return_value = 1291167030
+        self.callback.side_effect = ValueError
+        job = self.scheduler.add_job('minute', self.callback, self.every_minute)
+        self.scheduler.start()
+
+        mock_time.return_value = 1291167060
+        self.fire(job)
+
+        self.assertEqual(job.errors, 1)
+        self.assertTrue(job.armed)
+
+    def test_unscheduled_job_wakeup(self):
+        job = self.scheduler.add_job('task', self.callback, lambda now: None)
+        self.scheduler.start()
+        self.assertFalse(job.armed)
+
+        job.next_time = lambda now: now
+        self.scheduler.wakeup('task')
+        self.assertTrue(job.armed)
+
+    def test_stop(self):
+        job = self.scheduler.add_job('minute', self.callback, self.every_minute)
+        self.scheduler.start()
+        self.scheduler.stop()
+
+        self.assertFalse(job.armed)
+        self.assertEqual(self.io_loop.remove_timeout.call_count, 1)
+
+
+class TaskQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = TaskQueue(budget=0.005)
+
+    def test_fifo(self):
+        t1, t2 = Mock(), Mock()
+        self.queue.put(t1)
+        self.queue.put(t2)
+        self.assertEqual(len(self.queue), 2)
+        self.assertEqual(self.queue.reserve(), t1)
+        self.assertEqual(self.queue.reserve(), t2)
+        self.assertRaises(IndexError, self.queue.reserve)
+
+    def test_priority(self):
+        low, high = Mock(), Mock()
+        self.queue.put(low, TaskQueue.PRIORITY_LOW)
+        self.queue.put(high, TaskQueue.PRIORITY_HIGH)
+        self.assertEqual(self.queue.reserve(), high)
+
+    def test_run_drain(self):
+        tasks = [Mock() for i in xrange(10)]
+        for task in tasks:
+            self.queue.put(task)
+
+        ret = self.queue.run()
+        self.assertEqual(ret, 10)
+        self.assertFalse(self.queue)
+        for task in tasks:
+            task.run.assert_called_once_with()
+
+    @patch.object(time, 'time')
+    def test_run_within_budget(self, mock_time):
+        # every task costs 2ms
+        self.now = 1291167000.0
+        def tick():
+            self.now += 0.002
+            return self.now
+        mock_time.side_effect = tick
+
+        for i in xrange(10):
+            self.queue.put(Mock())
+
+        ret = self.queue.run()
+        self.assertTrue(ret < 10)
+        self.assertEqual(len(self.queue), 10 - ret)
+
+    def test_task_error(self):
+        task = Mock()
+        task.run.side_effect = ValueError
+        self.queue.put(task)
+        self.queue.put(Mock())
+
+        self.assertEqual(self.queue.run(), 2)
+        self.assertEqual(self.queue.errors, 1)
+
+    @patch.object(time, 'time')
+    def test_stats(self, mock_time):
+        mock_time.return_value = 1291167000
+        self.queue.put(Mock(), TaskQueue.PRIORITY_LOW)
+
+        mock_time.return_value = 1291167010
+        stats = self.queue.stats()
+        self.assertEqual(stats['depth'], [0, 0, 1])
+        self.assertEqual(stats['age'], 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
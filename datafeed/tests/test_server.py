@@ -1,17 +1,83 @@
+# -*- coding: utf-8 -*-
 from __future__ import with_statement
 
 import re
 import time
 import unittest
 
+import numpy as np
+
+from cStringIO import StringIO
+
 from datafeed.client import Client
+from datafeed.exchange import SH
 from datafeed.server import Server, Application, Request, Handler
+from datafeed.utils import REPORT_DELTA_DTYPE, REPORT_SYMBOL_DTYPE
+from datafeed.tests import helper
 
 from mock import Mock, patch
 
 
+def npy(data):
+    memfile = StringIO()
+    np.save(memfile, data)
+    return memfile.getvalue()
+
+
 class HandlerTest(unittest.TestCase):
-    pass
+
+    def setUp(self):
+        self.application = Application(helper.datadir, SH())
+        self.connection = Mock()
+        self.connection.require_auth = False
+        self.connection.report_symbols = np.empty(0, dtype=object)
+        self.connection.report_names = np.empty(0, dtype=object)
+
+    def _request(self, *args):
+        request = Request(self.connection, *args)
+        self.application(request)
+        return self.connection.write.call_args[0][0]
+
+    def test_put_report_deltas(self):
+        table = np.array([(0, 'SH600000', u'浦发银行'.encode('utf-8')),
+                          (1, 'SH600028', u'中国石化'.encode('utf-8'))],
+                         dtype=REPORT_SYMBOL_DTYPE)
+        ret = self._request('put_report_symbols', npy(table), 'npy')
+        self.assertEqual(ret, "+OK\r\n")
+
+        timestamp = int(time.time())
+        rows = np.array([(1, timestamp, 8.68, 8.6, 8.7, 8.5, 8.62, 2e7, 1.7e8)],
+                        dtype=REPORT_DELTA_DTYPE)
+        ret = self._request('put_report_deltas', npy(rows), 'npy')
+        self.assertEqual(ret, "+OK\r\n")
+
+        report = self.application.dbm.get_report('SH600028')
+        self.assertEqual(report['name'], u'中国石化')
+        self.assertEqual(report['symbol'], 'SH600028')
+        self.assertEqual(report['timestamp'], timestamp)
+        self.assertEqual(report['price'], 8.68)
+        self.assertEqual(report['close'], 8.68)
+        self.assertEqual(report['preclose'], 8.62)
+        self.assertEqual(report['volume'], 2e7)
+
+    def test_put_report_deltas_unknown_symbol(self):
+        rows = np.array([(3, int(time.time()), 1, 1, 1, 1, 1, 1, 1)],
+                        dtype=REPORT_DELTA_DTYPE)
+        ret = self._request('put_report_deltas', npy(rows), 'npy')
+        self.assertTrue(ret.startswith("-ERR unknown report symbol"))
+
+    def test_put_report_symbols_truncated_name(self):
+        # multi-byte name cut by client
+        name = u'浦发银行'.encode('utf-8')[:-1]
+        table = np.array([(0, 'SH600000', name)], dtype=REPORT_SYMBOL_DTYPE)
+        ret = self._request('put_report_symbols', npy(table), 'npy')
+        self.assertEqual(ret, "+OK\r\n")
+        self.assertEqual(self.connection.report_names[0], u'浦发银')
+
+    def test_put_report_deltas_wrong_format(self):
+        ret = self._request('put_report_deltas', 'garbage', 'npy')
+        self.assertEqual(ret, "-ERR wrong data format\r\n")
+
 
 if __name__ == '__main__':
     unittest.main()
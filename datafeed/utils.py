@@ -3,8 +3,11 @@
 #
 # Copyright 2010 yinhm
 
+import codecs
+import csv
 import datetime
 import json
+import time
 
 import numpy as np
 
@@ -12,7 +15,11 @@ from json import encoder
 encoder.FLOAT_REPR = lambda f: format(f, '.2f')
 
 
-__all__ = ['print2f', 'json_encode', 'json_decode']
+__all__ = ['print2f', 'json_encode', 'json_decode',
+           'PACK_INDEX_DTYPE', 'pack_arrays', 'unpack_arrays',
+           'REPORT_SYMBOL_DTYPE', 'REPORT_DELTA_DTYPE',
+           'OHLC_DTYPE', 'MINUTE_DTYPE',
+           'midnight_timestamp', 'parse_ohlc_csv']
 
 
 class print2f(float):
@@ -34,3 +41,149 @@ def json_encode(value):
 def json_decode(value):
     """Returns Python objects for the given JSON string."""
     return json.loads(value)
+
+
+# OHLC quotes of day, 1min and 5min stores, see datastore.OHLC.
+OHLC_DTYPE = np.dtype({'names': ('time', 'open', 'high', 'low', 'close',
+                                 'volume', 'amount'),
+                       'formats': ('i4', 'f4', 'f4', 'f4', 'f4', 'f4', 'f4')})
+
+# Minute snapshots, see datastore.Minute.
+MINUTE_DTYPE = np.dtype({'names': ('time', 'price', 'volume', 'amount'),
+                         'formats': ('i4', 'f4', 'f4', 'f4')})
+
+
+# Index of a packed multi-symbol payload, see pack_arrays.
+PACK_INDEX_DTYPE = np.dtype({'names': ('symbol', 'offset', 'length'),
+                             'formats': ('S16', 'i4', 'i4')})
+
+
+def pack_arrays(items):
+    """Pack (symbol, numpy data) pairs into one symbol/offset index and one
+    concatenated array.
+
+    Arguments:
+      items: dict or sequence of (symbol, numpy data) pairs, all data should
+             share the same dtype.
+
+    Return:
+      tuple of (index, data)
+    """
+    if hasattr(items, 'iteritems'):
+        items = items.iteritems()
+
+    symbols = []
+    arrays = []
+    for symbol, data in items:
+        symbols.append(symbol)
+        arrays.append(data)
+
+    index = np.zeros(len(symbols), dtype=PACK_INDEX_DTYPE)
+    if len(arrays) == 0:
+        return index, np.zeros(0)
+
+    lengths = [len(data) for data in arrays]
+    index['symbol'] = symbols
+    index['length'] = lengths
+    index['offset'][1:] = np.cumsum(lengths)[:-1]
+    return index, np.concatenate(arrays)
+
+
+def unpack_arrays(index, data):
+    """Generator of (symbol, numpy data) pairs from packed index and data.
+
+    Data yield are views of the packed array, no copy made.
+    """
+    for symbol, offset, length in index:
+        yield symbol, data[offset:offset + length]
+
+
+# Symbol table entry of report deltas, names are utf-8 encoded. Entries are
+# registered once per connection, see Client.put_report_deltas.
+REPORT_SYMBOL_DTYPE = np.dtype({'names': ('index', 'symbol', 'name'),
+                                'formats': ('u4', 'S16', 'S64')})
+
+# Fixed size report row, symbol and name are looked up by index.
+REPORT_DELTA_DTYPE = np.dtype({'names': ('index', 'timestamp', 'price',
+                                         'open', 'high', 'low', 'preclose',
+                                         'volume', 'amount'),
+                               'formats': ('u4', 'i4', 'f8', 'f8', 'f8',
+                                           'f8', 'f8', 'f8', 'f8')})
+
+
+# YYYY-MM-DD -> local midnight timestamp
+_MIDNIGHTS = {}
+
+
+def midnight_timestamp(datestr):
+    """Local midnight timestamp of a YYYY-MM-DD string, cached.
+
+    Return None if datestr not in the format.
+    """
+    try:
+        return _MIDNIGHTS[datestr]
+    except KeyError:
+        if len(datestr) != 10 or datestr[4] != '-' or datestr[7] != '-':
+            return None
+        try:
+            ret = int(time.mktime((int(datestr[:4]), int(datestr[5:7]),
+                                   int(datestr[8:]), 0, 0, 0, 0, 0, -1)))
+        except ValueError:
+            return None
+        _MIDNIGHTS[datestr] = ret
+        return ret
+
+
+def _to_float(value):
+    """Slow path of numeric csv fields, eg: 12,313.66, 102.5M or -."""
+    value = value.replace(',', '')
+    if value[-1:] == 'M':
+        return float(value[:-1]) * 10**6
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
+
+
+def parse_ohlc_csv(rawdata, dtype):
+    """Parse daily history csv into structured array of dtype.
+
+    Csv should have a header line and columns of date, open, high, low,
+    close, volume, other columns ignored, eg: Yahoo/Google historical
+    downloads. Fields of dtype not in csv are left zero.
+
+    Return:
+      numpy data ordered by time.
+    """
+    if rawdata.startswith(codecs.BOM_UTF8):
+        rawdata = rawdata[len(codecs.BOM_UTF8):]
+    lines = rawdata.splitlines()[1:]
+    if '"' in rawdata:
+        rows = list(csv.reader(lines))
+    else:
+        rows = [line.split(',') for line in lines]
+    rows = [row for row in rows if len(row) >= 6]
+
+    ret = np.zeros(len(rows), dtype=dtype)
+    if len(rows) == 0:
+        return ret
+
+    columns = zip(*rows)
+
+    dates, inverse = np.unique(columns[0], return_inverse=True)
+    times = []
+    for datestr in dates:
+        ts = midnight_timestamp(datestr)
+        if ts is None:
+            from dateutil import parser
+            ts = int(time.mktime(parser.parse(datestr).timetuple()))
+        times.append(ts)
+    ret['time'] = np.array(times)[inverse]
+
+    for i, name in enumerate(('open', 'high', 'low', 'close', 'volume'), 1):
+        try:
+            ret[name] = np.array(columns[i]).astype('f8')
+        except ValueError:
+            ret[name] = [_to_float(v) for v in columns[i]]
+
+    return ret[np.argsort(ret['time'], kind='mergesort')]
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 yinhm
+
+'''Import DZH history files into the archive.
+
+    python dzh_import.py --kind=day --market=SH var/dzh/sh/DAY.DAT
+
+Writes into data.h5 under --datadir by default, stop server first. Use
+--remote to upload to a running server instead.
+'''
+import logging
+import os
+import sys
+
+import tornado
+
+from tornado.options import define, options
+
+from datafeed import exchange
+from datafeed.client import Client
+from datafeed.datastore import Manager
+from datafeed.importer import *
+
+
+DATA_DIR = os.path.join(os.path.realpath(os.path.dirname(__file__)),
+                        'var')
+
+define("kind", default="day", help="one of day, 1min, 5min", type=str)
+define("market", default="SH", help="exchange of file, eg: SH, SZ", type=str)
+define("datadir", default=DATA_DIR, help="default data dir", type=str)
+define("remote", default=None, help="upload to server host:port", type=str)
+define("processes", default=None, help="parsing processes", type=int)
+define("chunksize", default=200, help="symbols of each shard", type=int)
+define("journal", default=None, help="journal file for resuming", type=str)
+
+
+def main():
+    filenames = tornado.options.parse_command_line()
+    if len(filenames) == 0 or options.kind not in PARSERS:
+        tornado.options.print_help()
+        sys.exit(1)
+
+    if options.remote:
+        host, port = options.remote.split(':')
+        try:
+            import config
+            password = config.AUTH_PASSWORD
+        except ImportError:
+            password = None
+        writer = ClientWriter(Client(host, int(port), password=password))
+    else:
+        dbm = Manager(options.datadir, getattr(exchange, options.market)())
+        writer = StoreWriter(dbm)
+
+    journal = options.journal and Journal(options.journal) or None
+    importer = DzhImporter(writer, processes=options.processes,
+                           chunksize=options.chunksize, journal=journal)
+    for filename in filenames:
+        stats = importer.run(filename, options.kind, options.market)
+        logging.info("==> %s: %d symbols, %d rows in %.2fs, %.0f rows/s",
+                     filename, stats['symbols'], stats['rows'],
+                     stats['seconds'], stats['rows_per_second'])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 yinhm
+'''Benchmark of decoding a full DZH dividend(PWR) file.
+
+Compares DzhDividend.decode with the record by record reader it replaced.
+'''
+import os
+import sys
+import timeit
+
+from cStringIO import StringIO
+from struct import unpack
+
+import numpy as np
+
+ROOT_PATH = os.path.join(os.path.realpath(os.path.dirname(__file__)), '..')
+sys.path[0:0] = [ROOT_PATH]
+
+from datafeed.providers.dzh import DzhDividend
+
+
+def full_pwr(symbols=3000, dividends=20):
+    '''PWR data of symbols with dividends each.'''
+    records = np.zeros(dividends, dtype=DzhDividend.DTYPE)
+    records['time'] = np.arange(dividends) * 86400 * 365 + 701308800
+    records['split'] = 0.5
+    records['dividend'] = 0.2
+
+    chunks = ['\x00' * 12]
+    for i in xrange(symbols):
+        chunks.append(('SZ%06d' % i).ljust(16, '\x00'))
+        chunks.append(records.tostring())
+        chunks.append('\xff' * 4)
+    return ''.join(chunks)
+
+
+def legacy_read(data):
+    '''Record by record reader.'''
+    f = StringIO(data)
+    f.seek(12, 0)
+
+    dt = DzhDividend.DTYPE
+    ret = []
+    while True:
+        rawsymbol = f.read(16)
+        if rawsymbol == '':
+            break
+        symbol = unpack('16s', rawsymbol)[0].replace('\x00', '')
+
+        dividends = []
+        rawdate = f.read(4)
+        while rawdate != "\xff" * 4:
+            dividends.append(np.frombuffer(rawdate + f.read(16), dtype=dt))
+            rawdate = f.read(4)
+            if rawdate == '':
+                break
+        ret.append((symbol, np.fromiter(dividends, dtype=dt)))
+    return ret
+
+
+if __name__ == '__main__':
+    data = full_pwr()
+    io = DzhDividend()
+    assert len(legacy_read(data)) == len(io.decode(data))
+
+    for name, func in (('legacy', legacy_read), ('decode', io.decode)):
+        timer = timeit.Timer(lambda: func(data))
+        print "%s, %d bytes: %.2fms" % (name, len(data),
+                                         min(timer.repeat(3, 1)) * 1000)
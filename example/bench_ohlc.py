@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 yinhm
+'''Benchmark of archiving a year of 1 minute OHLCs.
+
+Full day markets(1440 minutes) go through OHLC._update_multi, SH like
+markets go through OHLC._update.
+'''
+import os
+import sys
+import tempfile
+import time
+import timeit
+
+import h5py
+import numpy as np
+
+ROOT_PATH = os.path.join(os.path.realpath(os.path.dirname(__file__)), '..')
+sys.path[0:0] = [ROOT_PATH]
+
+from datafeed.datastore import OHLC, OneMinute
+from datafeed.exchange import SH
+
+
+def year_of_minutes(minute_times, holes=0):
+    '''One year of weekday 1 minute bars with minute times of each day.'''
+    start = time.mktime((2011, 1, 3, 0, 0, 0, 0, 0, 0))
+    days = [start + 86400 * i for i in xrange(365) \
+                if time.localtime(start + 86400 * i).tm_wday < 5]
+
+    times = (np.array(days)[:, np.newaxis] + minute_times * 60).ravel()
+    if holes:
+        keep = np.ones(len(times), dtype=bool)
+        keep[np.random.randint(0, len(times), holes)] = False
+        times = times[keep]
+
+    data = np.zeros(len(times), dtype=OHLC.DTYPE)
+    data['time'] = times
+    data['close'] = np.random.random(len(times)) * 10
+    return data
+
+
+def bench(market_minutes, data):
+    fd, filename = tempfile.mkstemp(suffix='.h5')
+    os.close(fd)
+    try:
+        f = h5py.File(filename)
+        store = OneMinute(f, market_minutes)
+        timer = timeit.Timer(lambda: store.update('SH000001', data))
+        result = timer.timeit(number=1)
+        f.close()
+    finally:
+        os.remove(filename)
+    return result
+
+
+if __name__ == '__main__':
+    full_day = year_of_minutes(np.arange(1440))
+    print "full day, %d bars: %.2fs" % (len(full_day), bench(1440, full_day))
+
+    holes = year_of_minutes(np.arange(1440), holes=10000)
+    print "full day with holes, %d bars: %.2fs" % (len(holes), bench(1440, holes))
+
+    sh = year_of_minutes(SH.calendar().minutes)
+    print "SH, %d bars: %.2fs" % (len(sh), bench(SH.market_minutes, sh))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 yinhm
+'''Benchmark of report upload payloads, marshal + zlib dicts of put_reports
+vs fixed size rows of put_report_deltas.
+
+Deltas are measured on a poll where 10% of symbols changed.
+'''
+import marshal
+import os
+import sys
+import time
+import timeit
+import zlib
+
+from cStringIO import StringIO
+
+import numpy as np
+
+ROOT_PATH = os.path.join(os.path.realpath(os.path.dirname(__file__)), '..')
+sys.path[0:0] = [ROOT_PATH]
+
+from datafeed.utils import REPORT_DELTA_DTYPE
+
+
+def reports(count):
+    timestamp = int(time.time())
+    ret = {}
+    for i in xrange(count):
+        symbol = 'SH%06d' % (600000 + i)
+        price = 10.0 + i % 100 * 0.01
+        ret[symbol] = {
+            'time'     : '2011-05-03 15:03:11',
+            'timestamp': timestamp,
+            'price'    : price,
+            'amount'   : 1.7e8 + i,
+            'volume'   : 2e7 + i,
+            'symbol'   : symbol,
+            'name'     : u'中国石化',
+            'open'     : price,
+            'high'     : price + 0.1,
+            'low'      : price - 0.1,
+            'close'    : price,
+            'preclose' : price - 0.05
+            }
+    return ret
+
+
+def deltas(data):
+    rows = [(i, r['timestamp'], r['price'], r['open'], r['high'], r['low'],
+             r['preclose'], r['volume'], r['amount']) \
+                for i, r in enumerate(data.itervalues())]
+    memfile = StringIO()
+    np.save(memfile, np.array(rows, dtype=REPORT_DELTA_DTYPE))
+    return memfile.getvalue()
+
+
+def decode(payload):
+    rows = np.load(StringIO(payload))
+    columns = dict((name, rows[name].tolist()) for name in rows.dtype.names)
+    return [dict(zip(columns.keys(), values)) \
+                for values in zip(*columns.values())]
+
+
+if __name__ == '__main__':
+    data = reports(3000)
+    full = zlib.compress(marshal.dumps(data))
+    changed = dict(data.items()[:300])
+    delta = deltas(changed)
+
+    print "put_reports: %d bytes, decode %.2fms" % \
+        (len(full), 1000 * timeit.Timer(
+            lambda: marshal.loads(zlib.decompress(full))).timeit(10) / 10)
+    print "put_report_deltas: %d bytes, decode %.2fms" % \
+        (len(delta), 1000 * timeit.Timer(
+            lambda: decode(delta)).timeit(10) / 10)
@@ -30,8 +30,6 @@ for symbol, ohlcs in io.read(filename, 'SH'):
 filename = os.path.join(var_path, "dzh/sh/MIN1.DAT")
 io = DzhMinute()
 for symbol, ohlcs in io.read(filename, 'SH'):
-    for ohlc in ohlcs:
-        ohlc['time'] = ohlc['time'] - 8 * 3600
     print symbol
     #client.put_1minute(symbol, ohlcs)
     store.oneminstore.update(symbol, ohlcs)
@@ -40,8 +38,6 @@ for symbol, ohlcs in io.read(filename, 'SH'):
 filename = os.path.join(var_path, "dzh/sh/MIN.DAT")
 io = DzhFiveMinute()
 for symbol, ohlcs in io.read(filename, 'SH'):
-    for ohlc in ohlcs:
-        ohlc['time'] = ohlc['time'] - 8 * 3600
     print symbol
     client.put_5minute(symbol, ohlcs)
     # store.fiveminstore.update(symbol, ohlcs)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2011 yinhm
+
+'''Poll Sina quotes of the whole universe into a datafeed server.
+
+    python ingest.py --server=localhost:8082 --interval=5
+
+Universe defaults to SH/SZ symbols known by server, or --symbols=SH600028,...
+'''
+import logging
+import signal
+
+import tornado
+
+from tornado import ioloop
+from tornado.options import define, options
+
+from datafeed.client import Client
+from datafeed.ingest import ReportIngester
+from datafeed.providers.sina import SinaReportFetcher, SinaSecurity
+
+
+define("server", default="localhost:8082", help="datafeed server host:port",
+       type=str)
+define("symbols", default=None, help="comma separated symbols", type=str)
+define("interval", default=5, help="seconds between polls", type=int)
+define("batch_size", default=500, help="reports of each upload",
+       type=int)
+
+
+def main():
+    tornado.options.parse_command_line()
+
+    host, port = options.server.split(':')
+    try:
+        import config
+        password = config.AUTH_PASSWORD
+    except ImportError:
+        password = None
+    client = Client(host, int(port), password=password)
+
+    if options.symbols:
+        symbols = options.symbols.split(',')
+    else:
+        symbols = [s for s in client.get_list() if s[:2] in ('SH', 'SZ')]
+    securities = [SinaSecurity.from_string(s) for s in sorted(symbols)]
+    logging.info("==> Polling %d symbols every %ds.", len(securities),
+                 options.interval)
+
+    io_loop = ioloop.IOLoop.instance()
+    fetcher = SinaReportFetcher(io_loop=io_loop)
+    ingester = ReportIngester(fetcher, securities, client,
+                              interval=options.interval,
+                              batch_size=options.batch_size)
+
+    def shutdown(signum, frame):
+        ingester.stop()
+        io_loop.stop()
+        logging.info("==> Exiting ingest, %d polls, last: %s",
+                     ingester.polls, ingester.last_metrics)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    ingester.start()
+    io_loop.start()
+
+if __name__ == "__main__":
+    main()
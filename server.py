@@ -15,7 +15,7 @@ import tornado
 from tornado import ioloop
 from tornado.options import define, options
 
-from datafeed.exchange import SH
+from datafeed import exchange
 from datafeed.imiguserver import ImiguApplication
 from datafeed.server import Server
 
@@ -25,32 +25,32 @@ DATA_DIR = os.path.join(os.path.realpath(os.path.dirname(__file__)),
 
 define("port", default=8082, help="run on the given port", type=int)
 define("datadir", default=DATA_DIR, help="default data dir", type=str)
+define("exchanges", default="SH", help="comma separated exchanges, eg: SH,HK",
+       type=str)
 
 
 def main():
     tornado.options.parse_command_line()
 
-    app = ImiguApplication(options.datadir, SH())
+    exchanges = [getattr(exchange, name)() \
+                     for name in options.exchanges.split(',')]
+    app = ImiguApplication(options.datadir, exchanges)
     server = Server(app, auth_password=config.AUTH_PASSWORD)
     server.listen(options.port)
     io_loop = tornado.ioloop.IOLoop.instance()
 
-    check_time = 1 * 1000  # every second
-    scheduler = ioloop.PeriodicCallback(app.periodic_job,
-                                        check_time,
-                                        io_loop=io_loop)
-
     def shutdown(signum, frame):
         print 'Signal handler called with signal', signum
         io_loop.stop()
         scheduler.stop()
         server.log_stats()
+        scheduler.log()
         logging.info("==> Exiting datafeed.")
 
     signal.signal(signal.SIGTERM, shutdown)
     signal.signal(signal.SIGINT, shutdown)
 
-    scheduler.start()
+    scheduler = app.start_scheduler(io_loop=io_loop)
     io_loop.start()
 
 if __name__ == "__main__":